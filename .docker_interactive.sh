@@ -1 +1 @@
-docker run -it --rm -v `pwd`:/io quay.io/pypa/manylinux1_x86_64
+docker run -it --rm -v `pwd`:/io quay.io/pypa/manylinux2014_x86_64
@@ -19,9 +19,27 @@
 #include "Python.h"
 #define NPY_NO_DEPRECATED_API NPY_1_14_API_VERSION
 #include "numpy/arrayobject.h"
+#include "structmember.h"
 
 #include <iostream>
+#include <sstream>
 #include <vector>
+#include <stdexcept>
+#include <algorithm>
+#include <mutex>
+#include <unordered_map>
+#include <cstring>
+#include <cmath>
+#include <memory>
+#include <atomic>
+#include <thread>
+#include <chrono>
+#ifdef _WIN32
+#include <process.h>
+#define getpid _getpid
+#else
+#include <unistd.h>
+#endif
 
 #include "inc_libCZI.h"
 
@@ -75,14 +93,72 @@ std::ostream& operator<<(std::ostream& out, const libCZI::DimensionIndex value){
 // .... Python callable extensions ..................
 
 static PyObject *cziread_meta(PyObject *self, PyObject *args);
-static PyObject *cziread_scene(PyObject *self, PyObject *args);
-static PyObject *cziread_allsubblocks(PyObject *self, PyObject *args);
+static PyObject *cziread_scene(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *cziread_allsubblocks(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *cziread_boxes(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *cziread_polygons(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *cziread_subblock_index(PyObject *self, PyObject *args);
+static PyObject *cziread_attachments(PyObject *self, PyObject *args);
+static PyObject *cziread_attachment(PyObject *self, PyObject *args);
+static PyObject *cziread_stats(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *cziread_subblocks_raw(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *decode(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *downsample(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *convert(PyObject *self, PyObject *args, PyObject *kwds);
 
 /* ==== Set up the methods table ====================== */
 static PyMethodDef _pylibcziMethods[] = {
     {"cziread_meta", cziread_meta, METH_VARARGS, "Read czi meta data"},
-    {"cziread_scene", cziread_scene, METH_VARARGS, "Read czi scene image"},
-    {"cziread_allsubblocks", cziread_allsubblocks, METH_VARARGS, "Read czi image containing all scenes"},
+    {"cziread_scene", (PyCFunction) cziread_scene, METH_VARARGS | METH_KEYWORDS,
+        "Read czi scene image. Subblocks are read in file order, with readahead > 0 neighbouring subblocks are "
+        "fetched in sequential reads of up to readahead bytes. channel selects the plane C (0 by default). "
+        "Raises MemoryError without reading if the image and the buffers of the read (with ds > 1 or "
+        "order='directory') would be larger than max_bytes (if not None). Pass a ReadProgress as progress to "
+        "follow or cancel the read. order='directory' composes with the libCZI tile accessor instead (subblocks "
+        "in directory order, full resolution bitmap, no readahead or progress), for comparison."},
+    {"cziread_allsubblocks", (PyCFunction) cziread_allsubblocks, METH_VARARGS | METH_KEYWORDS,
+        "Read czi image containing all scenes. With zero_copy=True the subblocks are returned as Bitmaps. "
+        "Subblocks are read in file order, with readahead > 0 neighbouring subblocks are fetched in sequential "
+        "reads of up to readahead bytes. indices selects which subblocks are read (by subblock index). progress "
+        "as for cziread_scene."},
+    {"cziread_boxes", (PyCFunction) cziread_boxes, METH_VARARGS | METH_KEYWORDS,
+        "Read many boxes (N x 4 array of x, y, w, h) at once, each subblock is decoded only once. Returns an "
+        "N x h x w array if all boxes have the same size, otherwise a list. Decodes with threads (0 for all "
+        "cpus), channel selects the plane C. progress as for cziread_scene."},
+    {"cziread_polygons", (PyCFunction) cziread_polygons, METH_VARARGS | METH_KEYWORDS,
+        "Read tight crops around polygons (list of n x 2 point arrays of finite x, y). Pixels are in a polygon "
+        "if their center is inside or on the boundary, as with skimage.draw.polygon. With mask=True only "
+        "subblocks touching the polygons are read and pixels outside are zero. Returns the crops, masks and crop "
+        "corners. threads, channel and progress as for cziread_boxes."},
+    {"cziread_subblock_index", cziread_subblock_index, METH_VARARGS,
+        "Read the subblock directory as a dict of int64 arrays with one element per subblock"},
+    {"cziread_attachments", cziread_attachments, METH_VARARGS,
+        "List czi attachments as (name, content_file_type, content_guid) tuples, ordered by attachment index"},
+    {"cziread_attachment", cziread_attachment, METH_VARARGS,
+        "Read the raw data of czi attachment index as bytes"},
+    {"cziread_stats", (PyCFunction) cziread_stats, METH_VARARGS | METH_KEYWORDS,
+        "Per channel intensity statistics of a box (x, y, w, h) without composing the image: dict with count, "
+        "min, max, mean, std, a fine histogram (one bin per value for integer images, nbins for float) with "
+        "bin_edges and integer (True for one bin per value). Only pixels covered by subblocks are counted, every "
+        "step-th row and column. Without a range the subblocks of float images are read and decoded twice, first "
+        "for the min and max that bound the histogram. Decodes with threads, channel selects the plane C. "
+        "progress as for cziread_scene."},
+    {"cziread_subblocks_raw", (PyCFunction) cziread_subblocks_raw, METH_VARARGS | METH_KEYWORDS,
+        "Read the raw (compressed) data of the subblocks as a list of bytes without decoding, in directory order "
+        "or in the order of indices (by subblock index). Read in file order as with cziread_allsubblocks. The "
+        "pixel type, stored size and compression of each subblock are in cziread_subblock_index."},
+    {"decode", (PyCFunction) decode, METH_VARARGS | METH_KEYWORDS,
+        "decode(raw, pixel_type, shape, compression=0): Decode the raw data of a subblock (any buffer) with its "
+        "pixel_type, stored shape (h, w) and compression from cziread_subblock_index. Returns the same image as "
+        "cziread_allsubblocks, decodes without holding the GIL."},
+    {"downsample", (PyCFunction) downsample, METH_VARARGS | METH_KEYWORDS,
+        "Downsample a uint8, uint16 or float32 image (m x n or m x n x channels) by an integer factor ds with "
+        "reduce mean, max (same as skimage block_reduce followed by astype, float32 means are summed in double "
+        "instead of float32 and so differ by rounding) or stride, in a single pass."},
+    {"convert", (PyCFunction) convert, METH_VARARGS | METH_KEYWORDS,
+        "Convert a uint8, uint16 or float32 image to dtype in a single pass, optionally mapping the intensity "
+        "window (lo, hi) to the output range (0..1 for float32) or applying a lookup table, rgb reverses the "
+        "channels."},
 
     {NULL, NULL, 0, NULL}        /* Sentinel */
 };
@@ -105,6 +181,154 @@ static struct PyModuleDef moduledef = {
 // generic exception for any errors encountered here
 static PyObject *PylibcziError;
 
+// default for the largest gap between two subblocks in the file that is read over instead of seeking.
+static unsigned long long const default_max_gap = 1 << 20;
+
+/* #### Bitmap type ################################# */
+
+// Python object that keeps a libCZI bitmap alive and exports its pixel memory through the buffer protocol.
+// The bitmap is locked while any buffer is exported and unlocked when the last buffer is released, so
+//   np.asarray(bitmap) gives a (strided) view on the decoded data without any copy.
+typedef struct {
+    PyObject_HEAD
+    std::shared_ptr<libCZI::IBitmapData> *bitmap;
+    libCZI::BitmapLockInfo lock_info;
+    int nexports;
+    int channels;
+    Py_ssize_t itemsize;
+    char const *format;
+    Py_ssize_t shape[3];
+    Py_ssize_t strides[3];
+} PylibcziBitmap;
+
+static void PylibcziBitmap_dealloc(PylibcziBitmap *self);
+static int PylibcziBitmap_getbuffer(PylibcziBitmap *self, Py_buffer *view, int flags);
+static void PylibcziBitmap_releasebuffer(PylibcziBitmap *self, Py_buffer *view);
+static PyObject *PylibcziBitmap_get_shape(PylibcziBitmap *self, void *closure);
+static PyObject *PylibcziBitmap_get_stride(PylibcziBitmap *self, void *closure);
+static PyObject *PylibcziBitmap_get_pixel_type(PylibcziBitmap *self, void *closure);
+
+static PyBufferProcs PylibcziBitmap_as_buffer = {
+    (getbufferproc) PylibcziBitmap_getbuffer,
+    (releasebufferproc) PylibcziBitmap_releasebuffer,
+};
+
+static PyGetSetDef PylibcziBitmap_getset[] = {
+    {(char*) "shape", (getter) PylibcziBitmap_get_shape, NULL,
+        (char*) "Shape of the bitmap (rows, columns[, channels])", NULL},
+    {(char*) "stride", (getter) PylibcziBitmap_get_stride, NULL, (char*) "Row stride of the bitmap in bytes",
+        NULL},
+    {(char*) "pixel_type", (getter) PylibcziBitmap_get_pixel_type, NULL, (char*) "libCZI pixel type name", NULL},
+    {NULL}  /* Sentinel */
+};
+
+static PyTypeObject PylibcziBitmapType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_pylibczi.Bitmap",                         /* tp_name */
+    sizeof(PylibcziBitmap),                     /* tp_basicsize */
+    0,                                          /* tp_itemsize */
+    (destructor) PylibcziBitmap_dealloc,        /* tp_dealloc */
+};
+
+/* #### Reader type ################################# */
+
+class CziSource;
+
+// Python object holding an open libCZI reader, so that a file, buffer or python stream only needs to be opened
+//   (and its directory parsed) once for many reads. The cziread functions accept it in place of a filename.
+// The reader pickles as its source and is (re)opened on first use in the process that uses it, so a reader that
+//   is lazy, unpickled in a worker or inherited by a forked worker never shares the file state of the parent.
+//   A reader on a python file-like object can neither be pickled nor used in a forked process.
+typedef struct {
+    PyObject_HEAD
+    std::shared_ptr<CziSource> *czi;
+    PyObject *source;
+    long pid;
+    int closed;
+} PylibcziReader;
+
+static PyObject *PylibcziReader_new(PyTypeObject *type, PyObject *args, PyObject *kwds);
+static void PylibcziReader_dealloc(PylibcziReader *self);
+static PyObject *PylibcziReader_close(PylibcziReader *self, PyObject *args);
+static PyObject *PylibcziReader_enter(PylibcziReader *self, PyObject *args);
+static PyObject *PylibcziReader_exit(PylibcziReader *self, PyObject *args);
+static PyObject *PylibcziReader_reduce(PylibcziReader *self, PyObject *args);
+static void release_inherited(PylibcziReader *self);
+static bool reopenable(PyObject *source);
+
+static PyMethodDef PylibcziReader_methods[] = {
+    {"close", (PyCFunction) PylibcziReader_close, METH_NOARGS, "Close the reader and release the source"},
+    {"__reduce__", (PyCFunction) PylibcziReader_reduce, METH_NOARGS,
+        "Pickle as the source, the reader is opened again lazily where it is unpickled"},
+    {"__enter__", (PyCFunction) PylibcziReader_enter, METH_NOARGS, NULL},
+    {"__exit__", (PyCFunction) PylibcziReader_exit, METH_VARARGS, NULL},
+    {NULL}  /* Sentinel */
+};
+
+static PyMemberDef PylibcziReader_members[] = {
+    {(char*) "source", T_OBJECT, offsetof(PylibcziReader, source), READONLY,
+        (char*) "The object the reader was opened on"},
+    {NULL}  /* Sentinel */
+};
+
+static PyTypeObject PylibcziReaderType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_pylibczi.CziReader",                      /* tp_name */
+    sizeof(PylibcziReader),                     /* tp_basicsize */
+    0,                                          /* tp_itemsize */
+    (destructor) PylibcziReader_dealloc,        /* tp_dealloc */
+};
+
+/* #### Progress type ############################### */
+
+class ReadMonitor;
+
+// exception for reads that were stopped by ReadProgress.cancel (subclass of pylibczi.error)
+static PyObject *PylibcziCancelled;
+
+// Python object to follow and cancel native reads, any of the reading cziread functions accepts it as progress.
+//   The counters are updated by the reading threads without the GIL, so they can be polled from other threads.
+typedef struct {
+    PyObject_HEAD
+    std::shared_ptr<ReadMonitor> *monitor;
+} PylibcziProgress;
+
+static PyObject *PylibcziProgress_new(PyTypeObject *type, PyObject *args, PyObject *kwds);
+static void PylibcziProgress_dealloc(PylibcziProgress *self);
+static PyObject *PylibcziProgress_cancel(PylibcziProgress *self, PyObject *args);
+static PyObject *PylibcziProgress_reset(PylibcziProgress *self, PyObject *args);
+static PyObject *PylibcziProgress_get_counter(PylibcziProgress *self, void *closure);
+static PyObject *PylibcziProgress_get_cancelled(PylibcziProgress *self, void *closure);
+
+static PyMethodDef PylibcziProgress_methods[] = {
+    {"cancel", (PyCFunction) PylibcziProgress_cancel, METH_NOARGS,
+        "Stop all reads using this progress before their next subblock, they raise pylibczi.cancelled. Later "
+        "reads are cancelled at their first subblock until reset is called"},
+    {"reset", (PyCFunction) PylibcziProgress_reset, METH_NOARGS,
+        "Clear the counters and the cancellation, to use the progress again for new reads"},
+    {NULL}  /* Sentinel */
+};
+
+static PyGetSetDef PylibcziProgress_getset[] = {
+    {(char*) "done", (getter) PylibcziProgress_get_counter, NULL, (char*) "Number of subblocks decoded",
+        (void*) 0},
+    {(char*) "total", (getter) PylibcziProgress_get_counter, NULL, (char*) "Number of subblocks to decode",
+        (void*) 1},
+    {(char*) "bytes", (getter) PylibcziProgress_get_counter, NULL,
+        (char*) "Size of the decoded subblocks in bytes", (void*) 2},
+    {(char*) "cancelled", (getter) PylibcziProgress_get_cancelled, NULL, (char*) "Whether cancel was called",
+        NULL},
+    {NULL}  /* Sentinel */
+};
+
+static PyTypeObject PylibcziProgressType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_pylibczi.ReadProgress",                   /* tp_name */
+    sizeof(PylibcziProgress),                   /* tp_basicsize */
+    0,                                          /* tp_itemsize */
+    (destructor) PylibcziProgress_dealloc,      /* tp_dealloc */
+};
+
 extern "C" {
 PyMODINIT_FUNC PyInit__pylibczi(void)
 {
@@ -117,56 +341,611 @@ PyMODINIT_FUNC PyInit__pylibczi(void)
     Py_INCREF(PylibcziError);
     PyModule_AddObject(module, "_pylibczi_exception", PylibcziError);
 
+    PylibcziBitmapType.tp_flags = Py_TPFLAGS_DEFAULT;
+    PylibcziBitmapType.tp_doc = "Decoded libCZI bitmap exported without copy through the buffer protocol";
+    PylibcziBitmapType.tp_as_buffer = &PylibcziBitmap_as_buffer;
+    PylibcziBitmapType.tp_getset = PylibcziBitmap_getset;
+    if (PyType_Ready(&PylibcziBitmapType) < 0)
+        return NULL;
+    Py_INCREF(&PylibcziBitmapType);
+    PyModule_AddObject(module, "Bitmap", (PyObject *) &PylibcziBitmapType);
+
+    PylibcziReaderType.tp_flags = Py_TPFLAGS_DEFAULT;
+    PylibcziReaderType.tp_doc = "CziReader(source, lazy=False)\n\n"
+        "Open czi reader on a filename, a buffer (bytes, memoryview, mmap) or a file-like object with readinto.\n"
+        "With lazy the source is only opened on first use. The reader is opened again in forked child processes\n"
+        "and pickles as its source, except on a file-like object.";
+    PylibcziReaderType.tp_new = PylibcziReader_new;
+    PylibcziReaderType.tp_methods = PylibcziReader_methods;
+    PylibcziReaderType.tp_members = PylibcziReader_members;
+    if (PyType_Ready(&PylibcziReaderType) < 0)
+        return NULL;
+    Py_INCREF(&PylibcziReaderType);
+    PyModule_AddObject(module, "CziReader", (PyObject *) &PylibcziReaderType);
+
+    PylibcziCancelled = PyErr_NewException("pylibczi.cancelled", PylibcziError, NULL);
+    Py_INCREF(PylibcziCancelled);
+    PyModule_AddObject(module, "_pylibczi_cancelled", PylibcziCancelled);
+
+    PylibcziProgressType.tp_flags = Py_TPFLAGS_DEFAULT;
+    PylibcziProgressType.tp_doc = "ReadProgress(callback=None, interval=0.1)\n\n"
+        "Progress and cancellation of native reads, pass it as progress to the cziread functions. done, total\n"
+        "and bytes count over all reads using it and can be polled from any thread, cancel stops the reads\n"
+        "between subblocks until reset. callback(done, total, bytes) is called from a reading thread at most\n"
+        "every interval seconds and at the end of each read, returning True cancels. An exception in the\n"
+        "callback stops the read with it. reset clears the counters and the cancellation.";
+    PylibcziProgressType.tp_new = PylibcziProgress_new;
+    PylibcziProgressType.tp_methods = PylibcziProgress_methods;
+    PylibcziProgressType.tp_getset = PylibcziProgress_getset;
+    if (PyType_Ready(&PylibcziProgressType) < 0)
+        return NULL;
+    Py_INCREF(&PylibcziProgressType);
+    PyModule_AddObject(module, "ReadProgress", (PyObject *) &PylibcziProgressType);
+
     import_array();  // Must be present for NumPy.  Called first after above line.
 
     return module;
 }
 }
 
+/* #### Streams and reader helpers ########################## */
+
+// Releases the GIL for the lifetime of the object, also when leaving the scope through an exception.
+class GILRelease {
+public:
+    GILRelease() : state(PyEval_SaveThread()) {}
+    ~GILRelease() { PyEval_RestoreThread(state); }
+private:
+    PyThreadState *state;
+};
+
+// Takes the GIL for the lifetime of the object, for calling back into python from code running with GILRelease.
+class GILAcquire {
+public:
+    GILAcquire() : state(PyGILState_Ensure()) {}
+    ~GILAcquire() { PyGILState_Release(state); }
+private:
+    PyGILState_STATE state;
+};
+
+// Progress and cancellation of a native read, shared with a python ReadProgress object if one was passed.
+//   The reading threads count the decoded subblocks and check for cancellation between subblocks. At most every
+//   interval one of them takes the GIL to check for signals (e.g. KeyboardInterrupt) and to call the callback.
+class ReadMonitor : public std::enable_shared_from_this<ReadMonitor> {
+public:
+    ReadMonitor(PyObject *callback=NULL, double interval=0.1);
+    ~ReadMonitor();
+    void begin(std::uint64_t nsubblocks) { total += nsubblocks; }
+    void update(std::uint64_t nbytes) { done++; bytes += nbytes; }
+    // throws ReadCancelled if the read should stop.
+    void check();
+    // calls the callback for the finished read, only throws for an error in the callback.
+    void finish();
+    void cancel() { cancelled = true; }
+    // clear the counters, the cancellation and a pending error, requires the GIL.
+    void reset();
+    // raise the error that stopped the read in python, requires the GIL.
+    void set_error();
+
+    std::atomic<std::uint64_t> done, total, bytes;
+    std::atomic<bool> cancelled;
+private:
+    void poll();
+
+    PyObject *callback;
+    std::int64_t interval_ns;
+    std::atomic<std::int64_t> next_poll;
+    std::atomic<bool> failed;
+    std::mutex mutex;
+    PyObject *error_type, *error_value, *error_traceback;
+};
+
+// Thrown between subblocks to stop a read, converted to the python error by set_error_from_exception.
+class ReadCancelled : public std::runtime_error {
+public:
+    ReadCancelled(std::shared_ptr<ReadMonitor> monitor) : std::runtime_error("Read was cancelled"),
+        monitor(monitor) {}
+    std::shared_ptr<ReadMonitor> monitor;
+};
+
+// libCZI subblock on the raw (compressed) data of a subblock passed from python, so that it is decoded by the
+//   same libCZI code as the subblocks read from a file. The data is not copied, it must outlive the subblock and
+//   its bitmap.
+class RawSubBlock : public libCZI::ISubBlock {
+public:
+    RawSubBlock(void const *data, size_t size, libCZI::SubBlockInfo const &info) : data(data), size(size),
+        info(info) {}
+    virtual const libCZI::SubBlockInfo& GetSubBlockInfo() const { return info; }
+    virtual void DangerousGetRawData(MemBlkType type, const void*& ptr, size_t& size) const {
+        ptr = (type == MemBlkType::Data) ? data : nullptr;
+        size = (type == MemBlkType::Data) ? this->size : 0;
+    }
+    virtual std::shared_ptr<const void> GetRawData(MemBlkType type, size_t* ptrSize) const {
+        const void *ptr; size_t size;
+        DangerousGetRawData(type, ptr, size);
+        if( ptrSize != nullptr ) *ptrSize = size;
+        // uncompressed bitmaps are created on this pointer, the caller keeps the data alive.
+        return std::shared_ptr<const void>(ptr, [](const void*) {});
+    }
+    virtual std::shared_ptr<libCZI::IBitmapData> CreateBitmap(const libCZI::CreateBitmapOptions* options) {
+        return libCZI::CreateBitmapFromSubBlock(this, options);
+    }
+private:
+    void const *data;
+    size_t size;
+    libCZI::SubBlockInfo info;
+};
+
+// libCZI stream reading from any python object exporting a contiguous buffer (bytes, memoryview, mmap, ...).
+//   Reads are plain memcpys and do not need the GIL.
+class PyBufferStream : public libCZI::IStream {
+public:
+    PyBufferStream(PyObject *obj) {
+        if( PyObject_GetBuffer(obj, &view, PyBUF_SIMPLE) < 0 )
+            throw std::invalid_argument("could not get a contiguous buffer from czi source");
+    }
+    virtual ~PyBufferStream() {
+        PyGILState_STATE gstate = PyGILState_Ensure();
+        PyBuffer_Release(&view);
+        PyGILState_Release(gstate);
+    }
+    virtual void Read(std::uint64_t offset, void *pv, std::uint64_t size, std::uint64_t *ptrBytesRead) {
+        std::uint64_t len = view.len;
+        std::uint64_t nread = (offset >= len) ? 0 : std::min(size, len - offset);
+        if( nread > 0 ) std::memcpy(pv, (char*)view.buf + offset, nread);
+        if( ptrBytesRead != nullptr ) *ptrBytesRead = nread;
+    }
+private:
+    Py_buffer view;
+};
+
+// libCZI stream reading from a python file-like object using seek and readinto.
+//   The GIL is taken for each read. The GIL alone does not serialize the seek / readinto pairs (readinto may
+//   release it), so reads also hold a mutex, which is only waited for without holding the GIL.
+class PyFileStream : public libCZI::IStream {
+public:
+    PyFileStream(PyObject *obj) : file(obj) { Py_INCREF(file); }
+    virtual ~PyFileStream() {
+        PyGILState_STATE gstate = PyGILState_Ensure();
+        Py_DECREF(file);
+        PyGILState_Release(gstate);
+    }
+    virtual void Read(std::uint64_t offset, void *pv, std::uint64_t size, std::uint64_t *ptrBytesRead) {
+        PyGILState_STATE gstate = PyGILState_Ensure();
+        std::unique_lock<std::mutex> lock(mutex, std::defer_lock);
+        Py_BEGIN_ALLOW_THREADS
+        lock.lock();
+        Py_END_ALLOW_THREADS
+        std::uint64_t nread = 0;
+        bool ok = true;
+        PyObject *res = PyObject_CallMethod(file, "seek", "K", (unsigned long long) offset);
+        if( res == NULL ) ok = false;
+        Py_XDECREF(res);
+        while( ok && nread < size ) {
+            PyObject *mem = PyMemoryView_FromMemory((char*)pv + nread, size - nread, PyBUF_WRITE);
+            res = (mem == NULL) ? NULL : PyObject_CallMethod(file, "readinto", "O", mem);
+            Py_XDECREF(mem);
+            if( res == NULL ) { ok = false; break; }
+            // readinto returns None for non-blocking streams without data, treat as end of stream.
+            Py_ssize_t n = (res == Py_None) ? 0 : PyLong_AsSsize_t(res);
+            Py_DECREF(res);
+            if( n < 0 ) { ok = false; break; }
+            if( n == 0 ) break;
+            nread += n;
+        }
+        std::string msg;
+        if( !ok ) msg = fetch_python_error("reading czi source failed");
+        lock.unlock();
+        PyGILState_Release(gstate);
+
+        if( !ok ) throw std::runtime_error(msg);
+        if( ptrBytesRead != nullptr ) *ptrBytesRead = nread;
+    }
+private:
+    // the python error can not propagate through libCZI (and maybe another thread), convert it to a message.
+    static std::string fetch_python_error(char const *prefix) {
+        PyObject *type, *value, *traceback;
+        PyErr_Fetch(&type, &value, &traceback);
+        std::string msg(prefix);
+        PyObject *str = (value == NULL) ? NULL : PyObject_Str(value);
+        if( str != NULL ) {
+            char const *cstr = PyUnicode_AsUTF8(str);
+            if( cstr != NULL ) { msg += ": "; msg += cstr; }
+            Py_DECREF(str);
+        }
+        PyErr_Clear();
+        Py_XDECREF(type); Py_XDECREF(value); Py_XDECREF(traceback);
+        return msg;
+    }
+    PyObject *file;
+    std::mutex mutex;
+};
+
+// A buffered range of the czi file, loaded with one sequential read.
+struct ReadaheadChunk {
+    std::uint64_t offset;
+    std::vector<char> data;
+};
+
+// libCZI stream wrapper that serves reads from the chunks loaded by the read planner and passes anything else
+//   through to the underlying stream. Chunks are only registered while a planned read is working on them.
+class ReadaheadStream : public libCZI::IStream {
+public:
+    ReadaheadStream(std::shared_ptr<libCZI::IStream> base) : base(base) {}
+    virtual void Read(std::uint64_t offset, void *pv, std::uint64_t size, std::uint64_t *ptrBytesRead) {
+        std::shared_ptr<ReadaheadChunk> hit;
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            for( auto const &chunk : chunks ) {
+                if( offset >= chunk->offset && offset + size <= chunk->offset + chunk->data.size() ) {
+                    hit = chunk; break;
+                }
+            }
+        }
+        if( !hit ) {
+            base->Read(offset, pv, size, ptrBytesRead);
+            return;
+        }
+        std::memcpy(pv, hit->data.data() + (offset - hit->offset), size);
+        if( ptrBytesRead != nullptr ) *ptrBytesRead = size;
+    }
+    std::shared_ptr<ReadaheadChunk> load(std::uint64_t offset, std::uint64_t size) {
+        auto chunk = std::make_shared<ReadaheadChunk>();
+        chunk->offset = offset; chunk->data.resize(size);
+        std::uint64_t nread = 0;
+        base->Read(offset, chunk->data.data(), size, &nread);
+        chunk->data.resize(nread);
+        std::lock_guard<std::mutex> lock(mutex);
+        chunks.push_back(chunk);
+        return chunk;
+    }
+    void release(std::shared_ptr<ReadaheadChunk> const &chunk) {
+        std::lock_guard<std::mutex> lock(mutex);
+        chunks.erase(std::remove(chunks.begin(), chunks.end(), chunk), chunks.end());
+    }
+    libCZI::IStream* base_stream() { return base.get(); }
+private:
+    std::shared_ptr<libCZI::IStream> base;
+    std::mutex mutex;
+    std::vector<std::shared_ptr<ReadaheadChunk>> chunks;
+};
+
+// Location of a subblock segment in the czi file. size is zero if the location is not known.
+struct SubBlockExtent {
+    std::uint64_t position;
+    std::uint64_t size;
+};
+
+// An open czi file: the libCZI reader, the stream it reads through and the (lazily parsed) subblock locations.
+class CziSource {
+public:
+    std::shared_ptr<libCZI::ICZIReader> reader;
+    std::shared_ptr<ReadaheadStream> stream;
+
+    // subblock extents indexed by the libCZI subblock index, empty if the directory could not be parsed.
+    std::vector<SubBlockExtent> const& extents();
+private:
+    std::mutex mutex;
+    bool extents_parsed = false;
+    std::vector<SubBlockExtent> subblock_extents;
+};
+
+// Get a reader for a czi source passed from python. An open CziReader is shared and stays open, anything else
+//   (filename, buffer, file-like) is opened here and closed again when the handle goes out of scope.
+class ReaderHandle {
+public:
+    ReaderHandle() : owned(false) {}
+    ~ReaderHandle() { if( owned && czi ) czi->reader->Close(); }
+    bool open(PyObject *source);
+    libCZI::ICZIReader* operator->() const { return czi->reader.get(); }
+
+    std::shared_ptr<CziSource> czi;
+private:
+    bool owned;
+};
+
+/* #### Read planning and composition ####################### */
+
+// A subblock selected for a read, with what is needed to plan the read order and to compose it.
+struct SubBlockEntry {
+    int index;
+    libCZI::IntRect rect;
+    int m_index;
+    SubBlockExtent extent;
+};
+
+// One sequential read covering consecutive subblocks in file order (positions begin to end in the read order).
+struct ReadRange {
+    std::uint64_t offset;
+    std::uint64_t size;
+    size_t begin, end;
+};
+
+// Receives the composed rows of an output region instead of them being copied into a full resolution image.
+class RowSink {
+public:
+    virtual ~RowSink() {}
+    // n pixels of row y starting at column x (relative to the region top-left corner)
+    virtual void write(int y, int x, int n, char const *src) = 0;
+};
+
+class PixelConversion;
+
+// Reduces an image by an integer factor while its rows are written, the full resolution image is never stored.
+//   Mean and Max give the same result as skimage.measure.block_reduce with block_size (ds, ds) followed by astype
+//   to the image type (incomplete blocks at the right and bottom are padded with zeros), except for float means,
+//   which are summed in double and not in float as by numpy, and so differ by the float rounding errors.
+//   Stride is image[::ds,::ds].
+//   Pixels that are never written count as zero. Not thread-safe, neighboring rows share the same output pixels.
+//   With a conversion the reduced rows are converted into out, which then has the output type of the conversion.
+class Downsampler : public RowSink {
+public:
+    enum Reduce { Mean, Max, Stride };
+    Downsampler(int numpy_type, int channels, int size_x, int size_y, int ds, Reduce reduce, void *out,
+        PixelConversion const *conversion=nullptr);
+    void write(int y, int x, int n, char const *src);
+    // write the reduced image into out, call once after all the rows were written.
+    void finish();
+
+    static bool parse_reduce(char const *name, Reduce &reduce);
+    static int reduced_size(int size, int ds) { return (size + ds - 1)/ds; }
+    // bytes allocated besides the output image, for limiting the memory of a read.
+    static std::uint64_t state_bytes(int numpy_type, int channels, int size_x, int size_y, int ds, Reduce reduce,
+        bool convert);
+private:
+    template<typename T> void write_type(int y, int x, int n, T const *src);
+    template<typename T, typename A> void accumulate(A *dst, int x, int n, T const *src);
+    template<typename T> void finish_type();
+    template<typename T, typename A> void mean_row(A const *sums, T *dst);
+    // size in bytes of the block sums of integer images, the smallest type that can not overflow.
+    static int sum_bytes(int numpy_type, int ds);
+
+    int numpy_type, channels, size_x, size_y, ds, out_x, out_y;
+    Reduce reduce;
+    char *out;
+    PixelConversion const *conversion;
+    // reduced image of the image type, out without conversion.
+    char *img;
+    // block sums for Mean, one of them is used
+    std::vector<std::uint16_t> sum16;
+    std::vector<std::uint32_t> sum32;
+    std::vector<double> sum;
+    // block maximums with a conversion, number of written pixels per block for float Max
+    std::vector<char> state;
+    std::vector<std::uint32_t> count;
+    // one reduced row before it is converted
+    std::vector<char> row;
+};
+
+// Converts pixels while they are copied: an optional lookup table or intensity window, conversion to the output
+//   type and reversed channel order (BGR to RGB). Only reads its settings, so it can be used from several
+//   threads.
+class PixelConversion {
+public:
+    PixelConversion() : out_type(NPY_NOTYPE), out_pixel_size_bytes(0), numpy_type(NPY_NOTYPE), channels(1),
+        requested_type(NPY_NOTYPE), lut_type(NPY_NOTYPE), rgb(false), window(false), lo(0), hi(0) {}
+    // parse the python conversion arguments, needs the GIL. returns false with the python error set.
+    bool parse(PyObject *dtype_obj, PyObject *window_obj, PyObject *lut_obj, int rgb);
+    // prepare the conversion of images of numpy_type with channels, does not need the GIL.
+    void setup(int numpy_type, int channels);
+    // whether any conversion is requested, valid after setup
+    bool active() const { return out_type != numpy_type || window || !lut.empty() || (rgb && channels > 1); }
+    void convert(char const *src, char *dst, std::size_t n) const;
+    // fill n output pixels with the converted value of zero, the value of pixels without any subblock.
+    void fill_background(char *dst, std::size_t n) const;
+
+    int out_type, out_pixel_size_bytes;
+private:
+    double map(double v, bool use_window) const;
+    template<typename U> static U saturate(double v);
+    template<typename T> void convert_from(T const *src, char *dst, std::size_t n) const;
+    // integer images are converted with the table, float images pixel by pixel
+    template<typename T, typename U> void convert_row(T const *src, U *dst, std::size_t n) const;
+    template<typename U> void convert_row(float const *src, U *dst, std::size_t n) const;
+    template<typename U> void fill_table();
+
+    int numpy_type, channels, requested_type, lut_type;
+    bool rgb, window;
+    double lo, hi;
+    std::vector<double> lut;
+    // output value for every value of integer images
+    std::vector<char> table;
+};
+
+// Writes converted rows into a C-order output image.
+class ConvertSink : public RowSink {
+public:
+    ConvertSink(PixelConversion const &conversion, int size_x, void *out) :
+        conversion(conversion), size_x(size_x), out((char*) out) {}
+    void write(int y, int x, int n, char const *src) {
+        conversion.convert(src, out + ((std::size_t) y*size_x + x)*conversion.out_pixel_size_bytes, n);
+    }
+private:
+    PixelConversion const &conversion;
+    int size_x;
+    char *out;
+};
+
+// Accumulates per channel intensity statistics of the rows written to it, rows can be written from several
+//   threads. Integer images get a histogram with one bin per value, float images nbins bins between lo and hi
+//   (values outside are counted in the first or last bin), nbins zero only accumulates the moments and the min
+//   and max. Only every step-th row and column is used. The mean and the sum of squared deviations (m2) of each
+//   row are merged into the accumulators with the pairwise update of Chan et al., which stays accurate for large
+//   values with a small variance (unlike the sum of squares).
+class StatsSink : public RowSink {
+public:
+    struct Accumulator {
+        Accumulator(int channels, std::size_t nbins);
+        void add(Accumulator const &other);
+        // merge the count, mean and m2 of a batch of values of channel c
+        void merge(int c, std::uint64_t n, double mean, double m2);
+        std::vector<std::uint64_t> count, hist;
+        std::vector<double> mean, m2, min, max;
+    };
+
+    StatsSink(int numpy_type, int channels, int step, std::size_t nbins=0, double lo=0, double hi=0);
+    void write(int y, int x, int n, char const *src);
+    // the accumulated statistics of all threads
+    Accumulator result() const;
+
+    int numpy_type, channels, step;
+    std::size_t nbins;
+    double lo, hi;
+private:
+    template<typename T> void write_type(Accumulator &acc, int x, int n, T const *src);
+    Accumulator &accumulator();
+
+    std::mutex mutex;
+    std::unordered_map<std::thread::id, std::unique_ptr<Accumulator>> accumulators;
+};
+
+// Composes subblocks into a C-order output image with top-left corner at rect.x, rect.y.
+//   Each output pixel is taken from the covering subblock with the highest M-index, which is the order the libCZI
+//   tile accessor draws in, but independent of the order the subblocks are drawn here. This lets the subblocks be
+//   decoded in the order they are stored in the file instead of in M-index order.
+class Compositor {
+public:
+    // with a sink the rows are written to the sink instead of into out.
+    Compositor(std::vector<SubBlockEntry> const &entries, libCZI::IntRect const &rect,
+        libCZI::PixelType pixel_type, void *out, int pixel_size_bytes, RowSink *sink=nullptr);
+    // draw the decoded bitmap of entries[i]
+    void draw(size_t i, libCZI::IBitmapData *bitmap);
+private:
+    std::vector<SubBlockEntry> const &entries;
+    libCZI::IntRect rect;
+    libCZI::PixelType pixel_type;
+    char *out;
+    int pixel_size_bytes;
+    RowSink *sink;
+    // for each entry, the overlapping entries that are drawn on top of it
+    std::vector<std::vector<size_t>> occluders;
+};
+
+// locks a libCZI bitmap for the lifetime of the object
+class BitmapLock {
+public:
+    BitmapLock(libCZI::IBitmapData *bitmap) : bitmap(bitmap), info(bitmap->Lock()) {}
+    ~BitmapLock() { bitmap->Unlock(); }
+    libCZI::IBitmapData *bitmap;
+    libCZI::BitmapLockInfo info;
+};
+
+// Composes the layer 0 subblocks of several output regions, for each region the same subblocks the libCZI single
+//   channel tile accessor would draw. Each subblock is read and decoded once, also if several regions need it.
+//   needed optionally restricts which of the intersecting subblocks are read for a region (given subblock rect).
+class RegionComposer {
+public:
+    RegionComposer(CziSource &czi, std::vector<libCZI::IntRect> const &rects,
+        std::function<bool(size_t, libCZI::IntRect const&)> const &needed = nullptr, int channel = 0);
+    // set the C-order output image (the size of the region) for region i, or a sink for the rows of region i.
+    void set_output(size_t i, void *out, int pixel_size_bytes, RowSink *sink=nullptr);
+    // read, decode and compose all the subblocks, does not need the GIL. use one thread with sinks that are not
+    //   thread-safe.
+    void read(std::uint64_t readahead, std::uint64_t max_gap, int nthreads,
+        std::shared_ptr<ReadMonitor> const &monitor=nullptr);
+
+    // pixel type of the subblocks (of the first subblock in the file if no subblocks are needed)
+    libCZI::PixelType pixel_type;
+private:
+    CziSource &czi;
+    std::vector<libCZI::IntRect> rects;
+    std::vector<SubBlockEntry> entries;
+    // (region, index in the region entries) that each entry is drawn into
+    std::vector<std::vector<std::pair<size_t, size_t>>> users;
+    std::vector<std::vector<SubBlockEntry>> region_entries;
+    std::vector<std::unique_ptr<Compositor>> compositors;
+};
+
 /* #### Helper prototypes ################################### */
 
-std::shared_ptr<libCZI::ICZIReader> open_czireader_from_cfilename(char const *fn);
+std::shared_ptr<CziSource> open_czisource_from_pyobject(PyObject *source);
+bool read_subblock_extents(libCZI::IStream *stream, std::vector<SubBlockExtent> &extents,
+    std::vector<libCZI::IntRect> &rects);
+void set_error_from_exception(std::exception const &e);
+bool get_read_monitor(PyObject *progress, std::shared_ptr<ReadMonitor> &monitor);
+void fill_subblock_extents(CziSource &czi, std::vector<SubBlockEntry> &entries);
+std::vector<ReadRange> plan_sequential_reads(std::vector<SubBlockEntry> const &entries,
+    std::vector<size_t> const &order, std::uint64_t readahead, std::uint64_t max_gap);
+void read_in_file_order(CziSource &czi, std::vector<SubBlockEntry> const &entries, std::uint64_t readahead,
+    std::uint64_t max_gap,
+    std::function<std::uint64_t(size_t, std::shared_ptr<libCZI::ISubBlock> const&)> const &func,
+    int nthreads=1, std::shared_ptr<ReadMonitor> const &monitor=nullptr);
+void decode_in_file_order(CziSource &czi, std::vector<SubBlockEntry> const &entries, std::uint64_t readahead,
+    std::uint64_t max_gap, std::function<void(size_t, std::shared_ptr<libCZI::IBitmapData> const&)> const &func,
+    int nthreads=1, std::shared_ptr<ReadMonitor> const &monitor=nullptr);
+bool parse_subblock_indices(PyObject *indices_obj, std::vector<int> &indices);
+bool box_to_rect(npy_int64 const *box, libCZI::IntRect &rect);
+std::vector<SubBlockEntry> enumerate_subblock_entries(CziSource &czi, std::vector<int> const *indices);
+void compose_with_accessor(CziSource &czi, libCZI::IntRect const &rect, int channel, libCZI::PixelType pixel_type,
+    void *out, int pixel_size_bytes, RowSink *sink=nullptr);
+PyArrayObject* new_image_array(libCZI::PixelType pixel_type, int size_x, int size_y, int &pixel_size_bytes);
+PyArrayObject* new_array(int numpy_type, int channels, int size_x, int size_y);
+libCZI::IntRect rasterize_polygon(std::vector<std::pair<double,double>> const &points,
+    std::vector<std::vector<std::pair<int,int>>> &spans);
+int point_in_polygon(std::vector<std::pair<double,double>> const &points, double x, double y);
+bool get_pixel_type_info(libCZI::PixelType pixel_type, int &numpy_type, int &pixel_size_bytes, int &channels);
 PyArrayObject* copy_bitmap_to_numpy_array(std::shared_ptr<libCZI::IBitmapData> pBitmap);
+PyObject* wrap_bitmap(std::shared_ptr<libCZI::IBitmapData> pBitmap);
 
 /* #### Extended modules #################################### */
 
 static PyObject *cziread_meta(PyObject *self, PyObject *args) {
-    char *filename_buf;
+    PyObject *source;
     // parse arguments
-    if (!PyArg_ParseTuple(args, "s", &filename_buf))
+    if (!PyArg_ParseTuple(args, "O", &source))
         return NULL;
 
-    auto cziReader = open_czireader_from_cfilename(filename_buf);
+    ReaderHandle cziReader;
+    if( !cziReader.open(source) ) return NULL;
 
-    // get the the document's metadata
-    auto mds = cziReader->ReadMetadataSegment();
-    auto md = mds->CreateMetaFromMetadataSegment();
-    //auto docInfo = md->GetDocumentInfo();
-    //auto dsplSettings = docInfo->GetDisplaySettings();
-    std::string xml = md->GetXml();
+    std::string xml;
+    try {
+        // get the the document's metadata
+        auto mds = cziReader->ReadMetadataSegment();
+        auto md = mds->CreateMetaFromMetadataSegment();
+        //auto docInfo = md->GetDocumentInfo();
+        //auto dsplSettings = docInfo->GetDisplaySettings();
+        xml = md->GetXml();
+    } catch (std::exception &e) {
+        set_error_from_exception(e);
+        return NULL;
+    }
     // copy the metadata into python string
     PyObject* pystring = Py_BuildValue("s", xml.c_str());
 
-    cziReader->Close();
     return pystring;
 }
 
-static PyObject *cziread_allsubblocks(PyObject *self, PyObject *args) {
-    char *filename_buf;
+static PyObject *cziread_allsubblocks(PyObject *self, PyObject *args, PyObject *kwds) {
+    PyObject *source;
+    PyObject *indices_obj = Py_None, *progress_obj = Py_None;
+    int zero_copy = 0;
+    unsigned long long readahead = 0, max_gap = default_max_gap;
+    static char const *kwlist[] = {"source", "zero_copy", "readahead", "max_gap", "indices", "progress", NULL};
     // parse arguments
-    if (!PyArg_ParseTuple(args, "s", &filename_buf))
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|pKKOO", (char**) kwlist, &source, &zero_copy, &readahead,
+            &max_gap, &indices_obj, &progress_obj))
         return NULL;
+    std::shared_ptr<ReadMonitor> monitor;
+    if( !get_read_monitor(progress_obj, monitor) ) return NULL;
 
-    auto cziReader = open_czireader_from_cfilename(filename_buf);
+    // optionally only read the subblocks with the given subblock indices, in the given order.
+    std::vector<int> indices;
+    bool use_indices = (indices_obj != Py_None);
+    if( use_indices && !parse_subblock_indices(indices_obj, indices) ) return NULL;
 
-    // count all the subblocks
-    npy_intp subblock_count = 0;
-    cziReader->EnumerateSubBlocks(
-        [&subblock_count](int idx, const libCZI::SubBlockInfo& info)
-    {
-        subblock_count++;
-        return true;
-    });
+    ReaderHandle cziReader;
+    if( !cziReader.open(source) ) return NULL;
+
+    // enumerate all the subblocks (or the selected ones), this only uses the subblock directory.
+    std::vector<SubBlockEntry> entries;
+    try {
+        entries = enumerate_subblock_entries(*cziReader.czi, use_indices ? &indices : nullptr);
+    } catch (std::exception &e) {
+        set_error_from_exception(e);
+        return NULL;
+    }
+    npy_intp subblock_count = entries.size();
     //std::cout << "Enumerated " << subblock_count << std::endl;
 
     // meh - this seems to be not useful, what is an M-index? someone read the spec...
@@ -179,41 +958,69 @@ static PyObject *cziread_allsubblocks(PyObject *self, PyObject *args) {
     npy_intp eshp[2]; eshp[0] = subblock_count; eshp[1] = 2;
     PyArrayObject *coordinates = (PyArrayObject *) PyArray_Empty(2, eshp, PyArray_DescrFromType(NPY_INT32), 0);
     npy_int32 *coords = (npy_int32 *) PyArray_DATA(coordinates);
+    for( npy_intp cnt=0; cnt < subblock_count; cnt++ ) {
+        coords[2*cnt] = entries[cnt].rect.x; coords[2*cnt+1] = entries[cnt].rect.y;
+    }
 
-    npy_intp cnt = 0;
-    cziReader->EnumerateSubBlocks(
-        [&cziReader, &subblock_count, &cnt, images, coords](int idx, const libCZI::SubBlockInfo& info)
-    {
-        //std::cout << "Index " << idx << ": " << libCZI::Utils::DimCoordinateToString(&info.coordinate)
-        //  << " Rect=" << info.logicalRect << " M-index " << info.mIndex << std::endl;
-
-        // add the sub-block image
-        PyList_SetItem(images, cnt,
-            (PyObject*) copy_bitmap_to_numpy_array(cziReader->ReadSubBlock(idx)->CreateBitmap()));
-        // add the coordinates
-        coords[2*cnt] = info.logicalRect.x; coords[2*cnt+1] = info.logicalRect.y;
-
-        //info.coordinate.EnumValidDimensions([](libCZI::DimensionIndex dim, int value)
-        //{
-        //    //valid_dims[(int) dim] = true;
-        //    cout << "Dimension  " << dim << " value " << value << endl;
-        //    return true;
-        //});
-
-        cnt++;
-        return true;
-    });
+    try {
+        // the subblocks are read in file order, but returned in the order of the subblock directory (or indices).
+        GILRelease nogil;
+        decode_in_file_order(*cziReader.czi, entries, readahead, max_gap,
+            [images, zero_copy](size_t cnt, std::shared_ptr<libCZI::IBitmapData> const &bitmap)
+        {
+            // add the sub-block image, either as a copy or as a view on the decoded bitmap
+            GILAcquire gil;
+            PyObject *img = zero_copy ? wrap_bitmap(bitmap) : (PyObject*) copy_bitmap_to_numpy_array(bitmap);
+            if( img == NULL ) throw std::runtime_error("converting subblock failed");
+            PyList_SET_ITEM(images, cnt, img);
+        }, 1, monitor);
+    } catch (std::exception &e) {
+        set_error_from_exception(e);
+        Py_DECREF(images); Py_DECREF(coordinates);
+        return NULL;
+    }
 
-    return Py_BuildValue("OO", images, (PyObject *) coordinates);
+    return Py_BuildValue("NN", images, (PyObject *) coordinates);
 }
 
-static PyObject *cziread_scene(PyObject *self, PyObject *args) {
-    char *filename_buf;
+static PyObject *cziread_scene(PyObject *self, PyObject *args, PyObject *kwds) {
+    PyObject *source;
     PyArrayObject *scene_or_box;
+    PyObject *dtype_obj = Py_None, *window_obj = Py_None, *lut_obj = Py_None, *progress_obj = Py_None;
+    PyObject *max_bytes_obj = Py_None;
+    int ds = 1, rgb = 0, channel = 0;
+    char const *reduce_name = "mean", *order = "file";
+    unsigned long long readahead = 0, max_gap = default_max_gap, max_bytes = 0;
+    static char const *kwlist[] = {"source", "scene_or_box", "readahead", "max_gap", "ds", "reduce", "dtype",
+        "window", "lut", "rgb", "channel", "max_bytes", "progress", "order", NULL};
 
     // parse arguments
-    if (!PyArg_ParseTuple(args, "sO!", &filename_buf, &PyArray_Type, &scene_or_box))
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO!|KKisOOOpiOOs", (char**) kwlist, &source, &PyArray_Type,
+            &scene_or_box, &readahead, &max_gap, &ds, &reduce_name, &dtype_obj, &window_obj, &lut_obj, &rgb,
+            &channel, &max_bytes_obj, &progress_obj, &order))
+        return NULL;
+    // None for no limit, zero is a limit like any other.
+    bool limit_bytes = max_bytes_obj != Py_None;
+    if( limit_bytes ) {
+        PyObject *index = PyNumber_Index(max_bytes_obj);
+        if( index != NULL ) max_bytes = PyLong_AsUnsignedLongLong(index);
+        Py_XDECREF(index);
+        if( PyErr_Occurred() ) return NULL;
+    }
+    bool file_order = std::string(order) == "file";
+    if( !file_order && std::string(order) != "directory" ) {
+        PyErr_SetString(PylibcziError, "order must be file or directory");
+        return NULL;
+    }
+    std::shared_ptr<ReadMonitor> monitor;
+    if( !get_read_monitor(progress_obj, monitor) ) return NULL;
+    Downsampler::Reduce reduce;
+    if( ds < 1 || !Downsampler::parse_reduce(reduce_name, reduce) ) {
+        PyErr_SetString(PylibcziError, "ds must be positive and reduce one of mean, max or stride");
         return NULL;
+    }
+    PixelConversion conversion;
+    if( !conversion.parse(dtype_obj, window_obj, lut_obj, rgb) ) return NULL;
 
     // get either the scene or a bounding box on the scene to load
     npy_intp size_scene_or_box = PyArray_SIZE(scene_or_box);
@@ -234,146 +1041,2125 @@ static PyObject *cziread_scene(PyObject *self, PyObject *args) {
         return NULL;
     }
 
-    auto cziReader = open_czireader_from_cfilename(filename_buf);
+    ReaderHandle cziReader;
+    if( !cziReader.open(source) ) return NULL;
 
-    // if only the scene was given the enumerate subblocks to get limits, otherwise use the provided bounding box.
-    int min_x, min_y, max_x, max_y, size_x, size_y;
-    //std::vector<bool> valid_dims ((int) libCZI::DimensionIndex::MaxDim, false);
-    if( use_scene ) {
-        // enumerate subblocks, get the min and max coordinates of the specified scene
-        min_x = std::numeric_limits<int>::max(); min_y = std::numeric_limits<int>::max(); max_x = -1; max_y = -1;
-        cziReader->EnumerateSubBlocks(
-            //[scene, &min_x, &min_y, &max_x, &max_y, &valid_dims](int idx, const libCZI::SubBlockInfo& info)
-            [scene, &min_x, &min_y, &max_x, &max_y](int idx, const libCZI::SubBlockInfo& info)
-        {
-            int cscene = 0;
-            info.coordinate.TryGetPosition(libCZI::DimensionIndex::S, &cscene);
-            // negative value for scene indicates to load all scenes
-            if( cscene == scene || scene < 0 ) {
-                //cout << "Index " << idx << ": " << libCZI::Utils::DimCoordinateToString(&info.coordinate)
-                //  << " Rect=" << info.logicalRect << " scene " << scene << endl;
-                auto rect = info.logicalRect;
-                if( rect.x < min_x ) min_x = rect.x;
-                if( rect.y < min_y ) min_y = rect.y;
-                if( rect.x + rect.w > max_x ) max_x = rect.x + rect.w;
-                if( rect.y + rect.h > max_y ) max_y = rect.y + rect.h;
-            }
+    PyArrayObject *img = NULL;
+    try {
+        // if only the scene was given the enumerate subblocks to get limits, otherwise use the provided box.
+        int min_x, min_y, max_x, max_y, size_x, size_y;
+        //std::vector<bool> valid_dims ((int) libCZI::DimensionIndex::MaxDim, false);
+        if( use_scene ) {
+            // enumerate subblocks, get the min and max coordinates of the specified scene
+            min_x = std::numeric_limits<int>::max(); min_y = std::numeric_limits<int>::max();
+            max_x = -1; max_y = -1;
+            cziReader->EnumerateSubBlocks(
+                //[scene, &min_x, &min_y, &max_x, &max_y, &valid_dims](int idx, const libCZI::SubBlockInfo& info)
+                [scene, &min_x, &min_y, &max_x, &max_y](int idx, const libCZI::SubBlockInfo& info)
+            {
+                int cscene = 0;
+                info.coordinate.TryGetPosition(libCZI::DimensionIndex::S, &cscene);
+                // negative value for scene indicates to load all scenes
+                if( cscene == scene || scene < 0 ) {
+                    //cout << "Index " << idx << ": " << libCZI::Utils::DimCoordinateToString(&info.coordinate)
+                    //  << " Rect=" << info.logicalRect << " scene " << scene << endl;
+                    auto rect = info.logicalRect;
+                    if( rect.x < min_x ) min_x = rect.x;
+                    if( rect.y < min_y ) min_y = rect.y;
+                    if( rect.x + rect.w > max_x ) max_x = rect.x + rect.w;
+                    if( rect.y + rect.h > max_y ) max_y = rect.y + rect.h;
+                }
 
-            //info.coordinate.EnumValidDimensions(
-            //    [&valid_dims](libCZI::DimensionIndex dim, int value)
-            //{
-            //    valid_dims[(int) dim] = true;
-            //    //cout << "Dimension  " << dim << " value " << value << endl;
-            //    return true;
-            //});
+                //info.coordinate.EnumValidDimensions(
+                //    [&valid_dims](libCZI::DimensionIndex dim, int value)
+                //{
+                //    valid_dims[(int) dim] = true;
+                //    //cout << "Dimension  " << dim << " value " << value << endl;
+                //    return true;
+                //});
+
+                return true;
+            });
+            if( max_x < 0 ) throw std::invalid_argument("No subblocks found for the specified scene");
+            size_x = max_x-min_x; size_y = max_y-min_y;
+        } else {
+            min_x = rect[0]; size_x = rect[2]; min_y = rect[1]; size_y = rect[3];
+            max_x = min_x + size_x; max_y = min_y + size_y;
+        }
+        //std::cout << "min x y " << min_x << " " << min_y << " max x y " << max_x << " " << max_y << std::endl;
+        //for (auto it = valid_dims.begin(); it != valid_dims.end(); ++it) {
+        //    if( *it ) {
+        //        int index = std::distance(valid_dims.begin(), it);
+        //        std::cout << static_cast<libCZI::DimensionIndex>(index) << ' ';
+        //    }
+        //}
+        //cout << endl;
+
+        // get the layer 0 subblocks in the region, the same ones the libCZI single channel tile accessor draws.
+        // xxx - how to generalize correct image dimension here?
+        //   commented code above creates bool vector saying which dims are valid (in any subblock).
+        //   it is possible for a czi file to not have any valid dims, not sure what this means exactly.
+        //   the region composer always uses the plane C=channel.
+        libCZI::IntRect roi{ min_x, min_y, size_x, size_y };
+        RegionComposer composer(*cziReader.czi, std::vector<libCZI::IntRect>{roi}, nullptr, channel);
+
+        int pixel_size_bytes, numpy_type, channels;
+        if( !get_pixel_type_info(composer.pixel_type, numpy_type, pixel_size_bytes, channels) ) return NULL;
+        conversion.setup(numpy_type, channels);
+        int out_x = Downsampler::reduced_size(size_x, ds), out_y = Downsampler::reduced_size(size_y, ds);
+        // refuse reads that are too large before anything is allocated or read. besides the output this counts
+        //   the reduction buffers with ds > 1 and the full resolution bitmap of the libCZI accessor.
+        unsigned long long out_bytes = (unsigned long long) out_x*out_y*conversion.out_pixel_size_bytes;
+        if( ds > 1 )
+            out_bytes += Downsampler::state_bytes(numpy_type, channels, size_x, size_y, ds, reduce,
+                conversion.active());
+        if( !file_order ) out_bytes += (unsigned long long) size_x*size_y*pixel_size_bytes;
+        if( limit_bytes && out_bytes > max_bytes ) {
+            PyErr_Format(PyExc_MemoryError, "Reading %llu bytes (%d x %d) exceeds max_bytes %llu", out_bytes,
+                out_y, out_x, max_bytes);
+            return NULL;
+        }
+        img = new_array(conversion.out_type, channels, out_x, out_y);
+        if( img == NULL ) return NULL;
+        std::size_t out_pixels = (std::size_t) out_x*out_y;
+
+        // with ds > 1 the rows are reduced while they are composed, the full resolution region is never
+        //   allocated. the conversion is applied to the reduced rows, otherwise directly to the composed rows.
+        std::unique_ptr<Downsampler> downsampler;
+        std::unique_ptr<ConvertSink> converter;
+        if( ds > 1 ) {
+            downsampler.reset(new Downsampler(numpy_type, channels, size_x, size_y, ds, reduce, PyArray_DATA(img),
+                conversion.active() ? &conversion : nullptr));
+        } else if( conversion.active() ) {
+            converter.reset(new ConvertSink(conversion, size_x, PyArray_DATA(img)));
+            conversion.fill_background((char*) PyArray_DATA(img), out_pixels);
+        }
+        RowSink *sink = downsampler ? (RowSink*) downsampler.get() : (RowSink*) converter.get();
+        composer.set_output(0, PyArray_DATA(img), pixel_size_bytes, sink);
+
+        // read and decode in file order without holding the GIL, the composite is drawn directly into the array.
+        GILRelease nogil;
+        if( file_order ) composer.read(readahead, max_gap, 1, monitor);
+        else compose_with_accessor(*cziReader.czi, roi, channel, composer.pixel_type, PyArray_DATA(img),
+            pixel_size_bytes, sink);
+        if( downsampler ) downsampler->finish();
+    } catch (std::exception &e) {
+        Py_XDECREF(img);
+        set_error_from_exception(e);
+        return NULL;
+    }
 
-            return true;
-        });
-        size_x = max_x-min_x; size_y = max_y-min_y;
-    } else {
-        min_x = rect[0]; size_x = rect[2]; min_y = rect[1]; size_y = rect[3];
-        max_x = min_x + size_x; max_y = min_y + size_y;
-    }
-    //std::cout << "min x y " << min_x << " " << min_y << " max x y " << max_x << " " << max_y << std::endl;
-    //for (auto it = valid_dims.begin(); it != valid_dims.end(); ++it) {
-    //    if( *it ) {
-    //        int index = std::distance(valid_dims.begin(), it);
-    //        std::cout << static_cast<libCZI::DimensionIndex>(index) << ' ';
-    //    }
-    //}
-    //cout << endl;
-
-    // get the accessor to the image data
-    auto accessor = cziReader->CreateSingleChannelTileAccessor();
-    // xxx - how to generalize correct image dimension here?
-    //   commented code above creates bool vector saying which dims are valid (in any subblock).
-    //   it is possible for a czi file to not have any valid dims, not sure what this means exactly.
-    //libCZI::CDimCoordinate planeCoord{ { libCZI::DimensionIndex::Z,0 } };
-    libCZI::CDimCoordinate planeCoord{ { libCZI::DimensionIndex::C,0 } };
-    auto multiTileComposit = accessor->Get(
-        libCZI::IntRect{ min_x, min_y, size_x, size_y },
-        &planeCoord,
-        nullptr);   // use default options
-
-    PyArrayObject* img = copy_bitmap_to_numpy_array(multiTileComposit);
-
-    cziReader->Close();
     return (PyObject*) img;
 }
 
-PyArrayObject* copy_bitmap_to_numpy_array(std::shared_ptr<libCZI::IBitmapData> pBitmap) {
-    // define numpy types/shapes and bytes per pixel depending on the zeiss bitmap pixel type.
-    int numpy_type = NPY_UINT16; int pixel_size_bytes = 0; int channels = 1;
-    switch( pBitmap->GetPixelType() ) {
-        case libCZI::PixelType::Gray8:
-            numpy_type = NPY_UINT8; pixel_size_bytes = 1; channels = 1;
-            break;
-        case libCZI::PixelType::Gray16:
-            numpy_type = NPY_UINT16; pixel_size_bytes = 2; channels = 1;
-            break;
-        case libCZI::PixelType::Bgr48:
-            numpy_type = NPY_UINT16; pixel_size_bytes = 6; channels = 3;
-            break;
-        default:
-            std::cout << pBitmap->GetPixelType() << std::endl;
-            PyErr_SetString(PylibcziError, "Unknown image type in czi file, ask to add more types.");
+static PyObject *cziread_boxes(PyObject *self, PyObject *args, PyObject *kwds) {
+    PyObject *source, *boxes_obj;
+    PyObject *dtype_obj = Py_None, *window_obj = Py_None, *lut_obj = Py_None, *progress_obj = Py_None;
+    int nthreads = 0, rgb = 0, channel = 0;
+    unsigned long long readahead = 0, max_gap = default_max_gap;
+    static char const *kwlist[] = {"source", "boxes", "readahead", "max_gap", "threads", "dtype", "window", "lut",
+        "rgb", "channel", "progress", NULL};
+
+    // parse arguments
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|KKiOOOpiO", (char**) kwlist, &source, &boxes_obj, &readahead,
+            &max_gap, &nthreads, &dtype_obj, &window_obj, &lut_obj, &rgb, &channel, &progress_obj))
+        return NULL;
+    std::shared_ptr<ReadMonitor> monitor;
+    if( !get_read_monitor(progress_obj, monitor) ) return NULL;
+    PixelConversion conversion;
+    if( !conversion.parse(dtype_obj, window_obj, lut_obj, rgb) ) return NULL;
+
+    // get the boxes, same (x, y, w, h) as the box for cziread_scene
+    PyArrayObject *boxes_arr = (PyArrayObject *) PyArray_FROMANY(boxes_obj, NPY_INT64, 2, 2,
+        NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    if( boxes_arr == NULL ) return NULL;
+    if( PyArray_DIM(boxes_arr, 1) != 4 ) {
+        Py_DECREF(boxes_arr);
+        PyErr_SetString(PylibcziError, "Boxes must be N x 4 (x, y, w, h)");
+        return NULL;
+    }
+    npy_intp nboxes = PyArray_DIM(boxes_arr, 0);
+    npy_int64 *pboxes = (npy_int64 *) PyArray_DATA(boxes_arr);
+    std::vector<libCZI::IntRect> rects(nboxes);
+    bool same_size = true;
+    for( npy_intp i=0; i < nboxes; i++ ) {
+        if( !box_to_rect(pboxes + 4*i, rects[i]) ) {
+            Py_DECREF(boxes_arr);
             return NULL;
+        }
+        same_size = same_size && (rects[i].w == rects[0].w && rects[i].h == rects[0].h);
     }
+    Py_DECREF(boxes_arr);
+    if( nthreads <= 0 ) nthreads = std::max(1, (int) std::thread::hardware_concurrency());
 
-    // allocate the numpy matrix to copy image into
-    //cout << size_x << " " << size_y << endl;
-    auto size = pBitmap->GetSize();
-    int size_x = size.w, size_y = size.h;
-    PyArrayObject *img;
-    int swap_axes[2];
-    if( channels==1 ) {
-        npy_intp shp[2]; shp[0] = size_x; shp[1] = size_y;
-        // images in czi file are in F-order, set F-order flag (last argument to PyArray_Empty)
-        img = (PyArrayObject *) PyArray_Empty(2, shp, PyArray_DescrFromType(numpy_type), 1);
-        swap_axes[0] = 0; swap_axes[1] = 1;
-    } else {
-        npy_intp shp[3]; shp[1] = size_x; shp[2] = size_y; shp[0] = channels;
-        // images in czi file are in F-order, set F-order flag (last argument to PyArray_Empty)
-        img = (PyArrayObject *) PyArray_Empty(3, shp, PyArray_DescrFromType(numpy_type), 1);
-        swap_axes[0] = 0; swap_axes[1] = 2;
+    ReaderHandle cziReader;
+    if( !cziReader.open(source) ) return NULL;
+
+    PyObject *ret = NULL;
+    try {
+        // group the boxes by the subblocks they need, so that each subblock is read and decoded once.
+        RegionComposer composer(*cziReader.czi, rects, nullptr, channel);
+
+        // boxes of the same size go into one stacked array, otherwise return a list of arrays.
+        int numpy_type, pixel_size_bytes, channels;
+        if( !get_pixel_type_info(composer.pixel_type, numpy_type, pixel_size_bytes, channels) ) return NULL;
+        conversion.setup(numpy_type, channels);
+        std::vector<char*> outs(nboxes);
+        if( same_size && nboxes > 0 ) {
+            npy_intp shp[4]; shp[0] = nboxes; shp[1] = rects[0].h; shp[2] = rects[0].w; shp[3] = channels;
+            ret = PyArray_ZEROS(channels == 1 ? 3 : 4, shp, conversion.out_type, 0);
+            if( ret == NULL ) return NULL;
+            std::size_t box_bytes = (std::size_t) rects[0].w*rects[0].h*conversion.out_pixel_size_bytes;
+            char *data = (char *) PyArray_DATA((PyArrayObject *) ret);
+            for( npy_intp i=0; i < nboxes; i++ ) outs[i] = data + i*box_bytes;
+        } else {
+            ret = PyList_New(nboxes);
+            for( npy_intp i=0; i < nboxes; i++ ) {
+                PyArrayObject *img = new_array(conversion.out_type, channels, rects[i].w, rects[i].h);
+                if( img == NULL ) throw std::runtime_error("Could not allocate box image");
+                PyList_SET_ITEM(ret, i, (PyObject *) img);
+                outs[i] = (char *) PyArray_DATA(img);
+            }
+        }
+        // the conversion only reads its settings, so the boxes can still be composed from several threads.
+        std::vector<std::unique_ptr<ConvertSink>> converters(nboxes);
+        for( npy_intp i=0; i < nboxes; i++ ) {
+            if( conversion.active() ) {
+                converters[i].reset(new ConvertSink(conversion, rects[i].w, outs[i]));
+                conversion.fill_background(outs[i], (std::size_t) rects[i].w*rects[i].h);
+            }
+            composer.set_output(i, outs[i], pixel_size_bytes, converters[i].get());
+        }
+
+        GILRelease nogil;
+        composer.read(readahead, max_gap, nthreads, monitor);
+    } catch (std::exception &e) {
+        Py_XDECREF(ret);
+        set_error_from_exception(e);
+        return NULL;
     }
-    void *pointer = PyArray_DATA(img);
 
-    // copy from the czi lib image pointer to the numpy array pointer
-    auto bitmap = pBitmap->Lock();
-    //cout << "sixe_x " << size_x << " size y " << size_y << endl;
-    //cout << "stride " << bitmap.stride << " size " << bitmap.size << endl;
-    // can not do a single memcpy call because the stride does not necessarily match the row size.
-    npy_byte *cptr = (npy_byte*)pointer, *cimgptr = (npy_byte*)bitmap.ptrDataRoi;
-    // stride units is not documented but emperically means the row (x) stride in bytes, not in pixels.
-    int rowsize = pixel_size_bytes * size_x; //, imgrowsize = pixel_size_bytes * bitmap.stride;
-    for( int y=0; y < size_y; y++ ) {
-        std::memcpy(cptr, cimgptr, rowsize);
-        cptr += rowsize; cimgptr += bitmap.stride;
+    return ret;
+}
+
+static PyObject *cziread_polygons(PyObject *self, PyObject *args, PyObject *kwds) {
+    PyObject *source, *polygons_obj;
+    PyObject *progress_obj = Py_None;
+    int mask = 1, nthreads = 0, channel = 0;
+    unsigned long long readahead = 0, max_gap = default_max_gap;
+    static char const *kwlist[] = {"source", "polygons", "mask", "readahead", "max_gap", "progress", "threads",
+        "channel", NULL};
+
+    // parse arguments
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|pKKOii", (char**) kwlist, &source, &polygons_obj, &mask,
+            &readahead, &max_gap, &progress_obj, &nthreads, &channel))
+        return NULL;
+    std::shared_ptr<ReadMonitor> monitor;
+    if( !get_read_monitor(progress_obj, monitor) ) return NULL;
+
+    // get the polygon points, in the same (pixel) coordinates as the boxes for cziread_scene.
+    PyObject *seq = PySequence_Fast(polygons_obj, "Polygons must be a sequence of n x 2 point arrays");
+    if( seq == NULL ) return NULL;
+    Py_ssize_t npolygons = PySequence_Fast_GET_SIZE(seq);
+    std::vector<std::vector<std::pair<double,double>>> points(npolygons);
+    for( Py_ssize_t p=0; p < npolygons; p++ ) {
+        PyArrayObject *arr = (PyArrayObject *) PyArray_FROMANY(PySequence_Fast_GET_ITEM(seq, p), NPY_DOUBLE, 2, 2,
+            NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+        if( arr == NULL || PyArray_DIM(arr, 1) != 2 || PyArray_DIM(arr, 0) < 3 ) {
+            if( arr != NULL ) PyErr_SetString(PylibcziError, "Each polygon must be n x 2 points with n >= 3");
+            Py_XDECREF(arr); Py_DECREF(seq);
+            return NULL;
+        }
+        npy_double *ptr = (npy_double *) PyArray_DATA(arr);
+        for( npy_intp i=0; i < PyArray_DIM(arr, 0); i++ ) {
+            // the crops are in int pixel coordinates, as the subblocks.
+            double const max_coord = 1 << 30;
+            if( !(std::abs(ptr[2*i]) <= max_coord && std::abs(ptr[2*i+1]) <= max_coord) ) {
+                PyErr_SetString(PylibcziError, "Polygon points must be finite and within +-2^30");
+                Py_DECREF(arr); Py_DECREF(seq);
+                return NULL;
+            }
+            points[p].push_back(std::make_pair(ptr[2*i], ptr[2*i+1]));
+        }
+        Py_DECREF(arr);
     }
-    pBitmap->Unlock();
+    Py_DECREF(seq);
+    if( nthreads <= 0 ) nthreads = std::max(1, (int) std::thread::hardware_concurrency());
 
-    // transpose to convert from F-order to C-order array
-    return (PyArrayObject*) PyArray_SwapAxes(img,swap_axes[0],swap_axes[1]);
+    ReaderHandle cziReader;
+    if( !cziReader.open(source) ) return NULL;
+
+    // rasterize the polygons, spans are the x-intervals inside the polygon for each row of the crop.
+    std::vector<libCZI::IntRect> rects(npolygons);
+    std::vector<std::vector<std::vector<std::pair<int,int>>>> spans(npolygons);
+    for( Py_ssize_t p=0; p < npolygons; p++ ) rects[p] = rasterize_polygon(points[p], spans[p]);
+
+    PyObject *images = PyList_New(npolygons), *masks = PyList_New(npolygons);
+    npy_intp cshp[2]; cshp[0] = npolygons; cshp[1] = 2;
+    PyArrayObject *corners = (PyArrayObject *) PyArray_ZEROS(2, cshp, NPY_INT64, 0);
+    try {
+        // get the layer 0 subblocks for each polygon, the same ones cziread_scene would draw for the crop.
+        //   with mask, only the subblocks that contain pixels inside of the polygon are needed.
+        RegionComposer composer(*cziReader.czi, rects, [mask, &rects, &spans](size_t p, libCZI::IntRect const &r)
+        {
+            if( !mask ) return true;
+            auto const &rect = rects[p];
+            int y0 = std::max(r.y, rect.y), y1 = std::min(r.y + r.h, rect.y + rect.h);
+            for( int y=y0; y < y1; y++ ) {
+                for( auto const &span : spans[p][y - rect.y] ) {
+                    if( span.first < r.x + r.w && span.second > r.x ) return true;
+                }
+            }
+            return false;
+        }, channel);
+
+        // allocate the crops and the masks
+        int pixel_size_bytes = 0;
+        npy_int64 *pcorners = (npy_int64 *) PyArray_DATA(corners);
+        for( Py_ssize_t p=0; p < npolygons; p++ ) {
+            auto const &rect = rects[p];
+            pcorners[2*p] = rect.x; pcorners[2*p+1] = rect.y;
+            PyArrayObject *img = new_image_array(composer.pixel_type, rect.w, rect.h, pixel_size_bytes);
+            if( img == NULL ) throw std::runtime_error("Could not allocate polygon image");
+            PyList_SET_ITEM(images, p, (PyObject *) img);
+            composer.set_output(p, PyArray_DATA(img), pixel_size_bytes);
+            if( !mask ) {
+                Py_INCREF(Py_None); PyList_SET_ITEM(masks, p, Py_None);
+                continue;
+            }
+            npy_intp mshp[2]; mshp[0] = rect.h; mshp[1] = rect.w;
+            PyArrayObject *pmask = (PyArrayObject *) PyArray_ZEROS(2, mshp, NPY_BOOL, 0);
+            if( pmask == NULL ) throw std::runtime_error("Could not allocate polygon mask");
+            PyList_SET_ITEM(masks, p, (PyObject *) pmask);
+            npy_bool *m = (npy_bool *) PyArray_DATA(pmask);
+            for( int y=0; y < rect.h; y++ ) {
+                npy_bool *mrow = m + (std::size_t) y*rect.w;
+                for( auto const &span : spans[p][y] )
+                    std::fill(mrow + (span.first - rect.x), mrow + (span.second - rect.x), 1);
+            }
+        }
+
+        // each subblock is only read and decoded once, also if it is needed for several polygons.
+        GILRelease nogil;
+        composer.read(readahead, max_gap, nthreads, monitor);
+
+        // clear everything outside of the polygons
+        for( Py_ssize_t p=0; p < npolygons && mask; p++ ) {
+            auto const &rect = rects[p];
+            char *data = (char *) PyArray_DATA((PyArrayObject *) PyList_GET_ITEM(images, p));
+            std::size_t row_bytes = (std::size_t) rect.w*pixel_size_bytes;
+            for( int y=0; y < rect.h; y++ ) {
+                char *row = data + y*row_bytes;
+                int x = rect.x;
+                for( auto const &span : spans[p][y] ) {
+                    std::memset(row + (std::size_t)(x - rect.x)*pixel_size_bytes, 0,
+                        (std::size_t)(span.first - x)*pixel_size_bytes);
+                    x = span.second;
+                }
+                std::memset(row + (std::size_t)(x - rect.x)*pixel_size_bytes, 0,
+                    (std::size_t)(rect.x + rect.w - x)*pixel_size_bytes);
+            }
+        }
+    } catch (std::exception &e) {
+        set_error_from_exception(e);
+        Py_DECREF(images); Py_DECREF(masks); Py_DECREF(corners);
+        return NULL;
+    }
+
+    return Py_BuildValue("NNN", images, masks, (PyObject *) corners);
+}
+
+static PyObject *cziread_subblock_index(PyObject *self, PyObject *args) {
+    PyObject *source;
+    // parse arguments
+    if (!PyArg_ParseTuple(args, "O", &source))
+        return NULL;
+
+    ReaderHandle cziReader;
+    if( !cziReader.open(source) ) return NULL;
+
+    // the fields of the subblock directory that are useful for selecting subblocks before reading them.
+    //   dimensions that a subblock does not have are set to -1, file position and size to -1 if unknown.
+    static char const *fields[] = {"index", "x", "y", "w", "h", "stored_w", "stored_h", "m_index", "pyramid_type",
+        "pixel_type", "compression", "S", "C", "Z", "T", "file_position", "file_size", NULL};
+    static libCZI::DimensionIndex const dims[] = {libCZI::DimensionIndex::S, libCZI::DimensionIndex::C,
+        libCZI::DimensionIndex::Z, libCZI::DimensionIndex::T};
+    int const nfields = sizeof(fields)/sizeof(fields[0]) - 1;
+    std::vector<std::vector<npy_int64>> columns(nfields);
+    try {
+        std::vector<SubBlockEntry> entries;
+        cziReader->EnumerateSubBlocks(
+            [&columns, &entries](int idx, const libCZI::SubBlockInfo& info)
+        {
+            npy_int64 values[] = {idx, info.logicalRect.x, info.logicalRect.y, info.logicalRect.w,
+                info.logicalRect.h, info.physicalSize.w, info.physicalSize.h, info.mIndex,
+                (npy_int64) info.pyramidType, (npy_int64) info.pixelType, info.compressionModeRaw,
+                -1, -1, -1, -1};
+            for( int d=0; d < 4; d++ ) {
+                int value;
+                if( info.coordinate.TryGetPosition(dims[d], &value) ) values[11 + d] = value;
+            }
+            for( int f=0; f < 15; f++ ) columns[f].push_back(values[f]);
+            entries.push_back(SubBlockEntry{idx, info.logicalRect, info.mIndex, SubBlockExtent{0, 0}});
+            return true;
+        });
+        fill_subblock_extents(*cziReader.czi, entries);
+        for( auto const &entry : entries ) {
+            bool known = (entry.extent.size > 0);
+            columns[15].push_back(known ? (npy_int64) entry.extent.position : -1);
+            columns[16].push_back(known ? (npy_int64) entry.extent.size : -1);
+        }
+    } catch (std::exception &e) {
+        set_error_from_exception(e);
+        return NULL;
+    }
+
+    // copy the columns into numpy arrays
+    PyObject *index = PyDict_New();
+    for( int f=0; f < nfields; f++ ) {
+        npy_intp n = columns[f].size();
+        PyArrayObject *column = (PyArrayObject *) PyArray_SimpleNew(1, &n, NPY_INT64);
+        if( column == NULL ) {
+            Py_DECREF(index);
+            return NULL;
+        }
+        if( n > 0 ) std::memcpy(PyArray_DATA(column), columns[f].data(), n*sizeof(npy_int64));
+        PyDict_SetItemString(index, fields[f], (PyObject *) column);
+        Py_DECREF(column);
+    }
+
+    return index;
 }
 
-std::shared_ptr<libCZI::ICZIReader> open_czireader_from_cfilename(char const *fn) {
-    // open the czi file
-    // https://msdn.microsoft.com/en-us/library/ms235631.aspx
-    size_t newsize = strlen(fn) + 1;
-    // The following creates a buffer large enough to contain
-    // the exact number of characters in the original string
-    // in the new format. If you want to add more characters
-    // to the end of the string, increase the value of newsize
-    // to increase the size of the buffer.
-    wchar_t * wcstring = new wchar_t[newsize];
-    // Convert char* string to a wchar_t* string.
-    //size_t convertedChars = mbstowcs(wcstring, fn, newsize);
-    mbstowcs(wcstring, fn, newsize);
-    auto cziReader = libCZI::CreateCZIReader();
-    auto stream = libCZI::CreateStreamFromFile(wcstring);
-    delete[] wcstring;
-    cziReader->Open(stream);
-
-    return cziReader;
+static PyObject *cziread_attachments(PyObject *self, PyObject *args) {
+    PyObject *source;
+    // parse arguments
+    if (!PyArg_ParseTuple(args, "O", &source))
+        return NULL;
+
+    ReaderHandle cziReader;
+    if( !cziReader.open(source) ) return NULL;
+
+    // only the attachment directory is read here, none of the attachment or subblock data.
+    std::vector<std::pair<int, libCZI::AttachmentInfo>> infos;
+    try {
+        cziReader->EnumerateAttachments(
+            [&infos](int idx, const libCZI::AttachmentInfo& info)
+        {
+            infos.push_back(std::make_pair(idx, info));
+            return true;
+        });
+    } catch (std::exception &e) {
+        set_error_from_exception(e);
+        return NULL;
+    }
+    std::sort(infos.begin(), infos.end(),
+        [](std::pair<int, libCZI::AttachmentInfo> const &a, std::pair<int, libCZI::AttachmentInfo> const &b)
+    {
+        return a.first < b.first;
+    });
+
+    PyObject* attachments = PyList_New(infos.size());
+    for( size_t i=0; i < infos.size(); i++ ) {
+        auto const &info = infos[i].second;
+        auto const &g = info.contentGuid;
+        char guid[40];
+        std::snprintf(guid, sizeof(guid), "%08x-%04x-%04x-%02x%02x-%02x%02x%02x%02x%02x%02x", (unsigned) g.Data1,
+            (unsigned) g.Data2, (unsigned) g.Data3, g.Data4[0], g.Data4[1], g.Data4[2], g.Data4[3], g.Data4[4],
+            g.Data4[5], g.Data4[6], g.Data4[7]);
+        // name and type are not guaranteed to be valid utf-8, do not fail listing on a bad name.
+        std::size_t type_size = strnlen(info.contentFileType, sizeof(info.contentFileType));
+        PyObject *item = Py_BuildValue("NNs",
+            PyUnicode_DecodeUTF8(info.name.c_str(), info.name.size(), "replace"),
+            PyUnicode_DecodeUTF8(info.contentFileType, type_size, "replace"), guid);
+        if( item == NULL ) {
+            Py_DECREF(attachments);
+            return NULL;
+        }
+        PyList_SET_ITEM(attachments, i, item);
+    }
+
+    return attachments;
+}
+
+static PyObject *cziread_attachment(PyObject *self, PyObject *args) {
+    PyObject *source;
+    int index;
+    // parse arguments
+    if (!PyArg_ParseTuple(args, "Oi", &source, &index))
+        return NULL;
+
+    ReaderHandle cziReader;
+    if( !cziReader.open(source) ) return NULL;
+
+    std::shared_ptr<const void> data;
+    size_t size = 0;
+    try {
+        GILRelease nogil;
+        auto attachment = cziReader->ReadAttachment(index);
+        if( !attachment ) throw std::out_of_range("Attachment index not found");
+        data = attachment->GetRawData(&size);
+    } catch (std::exception &e) {
+        set_error_from_exception(e);
+        return NULL;
+    }
+
+    return PyBytes_FromStringAndSize((char const*) data.get(), size);
+}
+
+static PyObject *cziread_stats(PyObject *self, PyObject *args, PyObject *kwds) {
+    PyObject *source, *box_obj, *range_obj = Py_None, *progress_obj = Py_None;
+    int step = 1, nthreads = 0, nbins = 65536, channel = 0;
+    unsigned long long readahead = 0, max_gap = default_max_gap;
+    static char const *kwlist[] = {"source", "box", "step", "threads", "range", "nbins", "readahead", "max_gap",
+        "channel", "progress", NULL};
+
+    // parse arguments
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|iiOiKKiO", (char**) kwlist, &source, &box_obj, &step,
+            &nthreads, &range_obj, &nbins, &readahead, &max_gap, &channel, &progress_obj))
+        return NULL;
+    std::shared_ptr<ReadMonitor> monitor;
+    if( !get_read_monitor(progress_obj, monitor) ) return NULL;
+    PyArrayObject *box_arr = (PyArrayObject *) PyArray_FROMANY(box_obj, NPY_INT64, 1, 1,
+        NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    if( box_arr == NULL ) return NULL;
+    if( PyArray_SIZE(box_arr) != 4 ) {
+        Py_DECREF(box_arr);
+        PyErr_SetString(PylibcziError, "Box must be size 4 (x, y, w, h)");
+        return NULL;
+    }
+    libCZI::IntRect roi;
+    bool valid = box_to_rect((npy_int64 *) PyArray_DATA(box_arr), roi);
+    Py_DECREF(box_arr);
+    if( !valid ) return NULL;
+    bool has_range = range_obj != Py_None;
+    double lo = 0, hi = 0;
+    if( has_range && !PyArg_ParseTuple(range_obj, "dd", &lo, &hi) ) return NULL;
+    if( step < 1 || nbins < 1 ) {
+        PyErr_SetString(PylibcziError, "step and nbins must be positive");
+        return NULL;
+    }
+    if( nthreads <= 0 ) nthreads = std::max(1, (int) std::thread::hardware_concurrency());
+
+    ReaderHandle cziReader;
+    if( !cziReader.open(source) ) return NULL;
+
+    std::unique_ptr<StatsSink::Accumulator> result;
+    int numpy_type, pixel_size_bytes, channels;
+    try {
+        RegionComposer composer(*cziReader.czi, std::vector<libCZI::IntRect>{roi}, nullptr, channel);
+        if( !get_pixel_type_info(composer.pixel_type, numpy_type, pixel_size_bytes, channels) ) return NULL;
+
+        // the composer draws every covered pixel once, the rows are only accumulated, never stored.
+        GILRelease nogil;
+        if( numpy_type == NPY_FLOAT32 && !has_range ) {
+            // the histogram range of float images is not known, take it from a first pass over the min and max.
+            StatsSink minmax(numpy_type, channels, step);
+            composer.set_output(0, NULL, pixel_size_bytes, &minmax);
+            composer.read(readahead, max_gap, nthreads, monitor);
+            auto acc = minmax.result();
+            lo = *std::min_element(acc.min.begin(), acc.min.end());
+            hi = *std::max_element(acc.max.begin(), acc.max.end());
+            if( !std::isfinite(lo) || !std::isfinite(hi) ) { lo = 0; hi = 1; }
+            if( !(hi > lo) ) hi = lo + 1;
+        }
+        StatsSink stats(numpy_type, channels, step, nbins, lo, hi);
+        composer.set_output(0, NULL, pixel_size_bytes, &stats);
+        composer.read(readahead, max_gap, nthreads, monitor);
+        result.reset(new StatsSink::Accumulator(stats.result()));
+        if( numpy_type != NPY_FLOAT32 ) { lo = 0; hi = (double) stats.nbins; }
+        nbins = (int) stats.nbins;
+    } catch (std::exception &e) {
+        set_error_from_exception(e);
+        return NULL;
+    }
+
+    // return the statistics as a dict of arrays with one element (or row) per channel
+    npy_intp shp[2]; shp[0] = channels; shp[1] = nbins;
+    PyArrayObject *count = (PyArrayObject *) PyArray_SimpleNew(1, shp, NPY_INT64);
+    PyArrayObject *min = (PyArrayObject *) PyArray_SimpleNew(1, shp, NPY_FLOAT64);
+    PyArrayObject *max = (PyArrayObject *) PyArray_SimpleNew(1, shp, NPY_FLOAT64);
+    PyArrayObject *mean = (PyArrayObject *) PyArray_SimpleNew(1, shp, NPY_FLOAT64);
+    PyArrayObject *std = (PyArrayObject *) PyArray_SimpleNew(1, shp, NPY_FLOAT64);
+    PyArrayObject *hist = (PyArrayObject *) PyArray_SimpleNew(2, shp, NPY_INT64);
+    npy_intp nedges = nbins + 1;
+    PyArrayObject *edges = (PyArrayObject *) PyArray_SimpleNew(1, &nedges, NPY_FLOAT64);
+    PyObject *ret = PyDict_New();
+    if( count && min && max && mean && std && hist && edges && ret ) {
+        for( int c=0; c < channels; c++ ) {
+            double n = (double) result->count[c];
+            ((npy_int64*) PyArray_DATA(count))[c] = (npy_int64) result->count[c];
+            ((double*) PyArray_DATA(min))[c] = n > 0 ? result->min[c] : NAN;
+            ((double*) PyArray_DATA(max))[c] = n > 0 ? result->max[c] : NAN;
+            ((double*) PyArray_DATA(mean))[c] = n > 0 ? result->mean[c] : NAN;
+            ((double*) PyArray_DATA(std))[c] = n > 0 ? std::sqrt(result->m2[c]/n) : NAN;
+        }
+        std::copy(result->hist.begin(), result->hist.end(), (npy_int64*) PyArray_DATA(hist));
+        for( npy_intp i=0; i < nedges; i++ ) ((double*) PyArray_DATA(edges))[i] = lo + (hi - lo)*i/nbins;
+    }
+    char const *names[] = {"count", "min", "max", "mean", "std", "histogram", "bin_edges"};
+    PyArrayObject *values[] = {count, min, max, mean, std, hist, edges};
+    bool ok = ret != NULL;
+    for( int i=0; i < 7; i++ ) {
+        ok = ok && values[i] != NULL && PyDict_SetItemString(ret, names[i], (PyObject*) values[i]) == 0;
+        Py_XDECREF(values[i]);
+    }
+    // integer images have one bin per value
+    ok = ok && PyDict_SetItemString(ret, "integer", numpy_type == NPY_FLOAT32 ? Py_False : Py_True) == 0;
+    if( !ok ) { Py_XDECREF(ret); return NULL; }
+
+    return ret;
+}
+
+static PyObject *cziread_subblocks_raw(PyObject *self, PyObject *args, PyObject *kwds) {
+    PyObject *source, *indices_obj = Py_None, *progress_obj = Py_None;
+    unsigned long long readahead = 0, max_gap = default_max_gap;
+    static char const *kwlist[] = {"source", "indices", "readahead", "max_gap", "progress", NULL};
+    // parse arguments
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|OKKO", (char**) kwlist, &source, &indices_obj, &readahead,
+            &max_gap, &progress_obj))
+        return NULL;
+    std::shared_ptr<ReadMonitor> monitor;
+    if( !get_read_monitor(progress_obj, monitor) ) return NULL;
+    std::vector<int> indices;
+    bool use_indices = (indices_obj != Py_None);
+    if( use_indices && !parse_subblock_indices(indices_obj, indices) ) return NULL;
+
+    ReaderHandle cziReader;
+    if( !cziReader.open(source) ) return NULL;
+
+    PyObject *raws = NULL;
+    try {
+        auto entries = enumerate_subblock_entries(*cziReader.czi, use_indices ? &indices : nullptr);
+        raws = PyList_New(entries.size());
+        if( raws == NULL ) return NULL;
+
+        // only the subblock segments are read, the data is copied into bytes without decoding.
+        GILRelease nogil;
+        read_in_file_order(*cziReader.czi, entries, readahead, max_gap,
+            [raws](size_t i, std::shared_ptr<libCZI::ISubBlock> const &subblock)
+        {
+            const void *ptr; size_t size;
+            subblock->DangerousGetRawData(libCZI::ISubBlock::MemBlkType::Data, ptr, size);
+            GILAcquire gil;
+            PyObject *raw = PyBytes_FromStringAndSize((char const*) ptr, size);
+            if( raw == NULL ) throw std::runtime_error("copying subblock data failed");
+            PyList_SET_ITEM(raws, i, raw);
+            // progress counts the raw bytes
+            return (std::uint64_t) size;
+        }, 1, monitor);
+    } catch (std::exception &e) {
+        Py_XDECREF(raws);
+        set_error_from_exception(e);
+        return NULL;
+    }
+
+    return raws;
+}
+
+static PyObject *decode(PyObject *self, PyObject *args, PyObject *kwds) {
+    PyObject *raw_obj;
+    int pixel_type, size_x, size_y, compression = 0;
+    static char const *kwlist[] = {"raw", "pixel_type", "shape", "compression", NULL};
+    // parse arguments
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "Oi(ii)|i", (char**) kwlist, &raw_obj, &pixel_type, &size_y,
+            &size_x, &compression))
+        return NULL;
+    int numpy_type, pixel_size_bytes, channels;
+    if( !get_pixel_type_info((libCZI::PixelType) pixel_type, numpy_type, pixel_size_bytes, channels) )
+        return NULL;
+    if( size_x < 0 || size_y < 0 ) {
+        PyErr_SetString(PylibcziError, "Shape must not be negative");
+        return NULL;
+    }
+    Py_buffer view;
+    if( PyObject_GetBuffer(raw_obj, &view, PyBUF_SIMPLE) < 0 ) return NULL;
+
+    // only the fields used for decoding matter, the subblock is at the origin of its own plane. every field is
+    //   set, the coordinate has no valid dimensions but its values are initialized as well (it is copied).
+    libCZI::SubBlockInfo info{};
+    for( int d=(int) libCZI::DimensionIndex::MinDim; d <= (int) libCZI::DimensionIndex::MaxDim; d++ )
+        info.coordinate.Set((libCZI::DimensionIndex) d, 0);
+    info.coordinate.Clear();
+    info.compressionModeRaw = compression;
+    info.pixelType = (libCZI::PixelType) pixel_type;
+    info.logicalRect = libCZI::IntRect{0, 0, size_x, size_y};
+    info.physicalSize = libCZI::IntSize{(std::uint32_t) size_x, (std::uint32_t) size_y};
+    info.mIndex = std::numeric_limits<int>::max();
+    info.pyramidType = libCZI::SubBlockPyramidType::None;
+
+    PyArrayObject *img = NULL;
+    try {
+        RawSubBlock subblock(view.buf, view.len, info);
+        std::shared_ptr<libCZI::IBitmapData> bitmap;
+        {
+            GILRelease nogil;
+            if( info.GetCompressionMode() == libCZI::CompressionMode::Invalid )
+                throw std::invalid_argument("Unknown subblock compression");
+            bitmap = subblock.CreateBitmap(nullptr);
+        }
+        // the bitmap may be on the raw data (uncompressed), copy it before the buffer is released.
+        img = copy_bitmap_to_numpy_array(bitmap);
+    } catch (std::exception &e) {
+        set_error_from_exception(e);
+    }
+    PyBuffer_Release(&view);
+
+    return (PyObject*) img;
+}
+
+static PyObject *downsample(PyObject *self, PyObject *args, PyObject *kwds) {
+    PyObject *image_obj;
+    int ds;
+    char const *reduce_name = "mean";
+    static char const *kwlist[] = {"image", "ds", "reduce", NULL};
+    // parse arguments
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "Oi|s", (char**) kwlist, &image_obj, &ds, &reduce_name))
+        return NULL;
+    Downsampler::Reduce reduce;
+    if( ds < 1 || !Downsampler::parse_reduce(reduce_name, reduce) ) {
+        PyErr_SetString(PylibcziError, "ds must be positive and reduce one of mean, max or stride");
+        return NULL;
+    }
+
+    PyArrayObject *image = (PyArrayObject*) PyArray_FROMANY(image_obj, NPY_NOTYPE, 2, 3, NPY_ARRAY_C_CONTIGUOUS);
+    if( image == NULL ) return NULL;
+    int numpy_type = PyArray_TYPE(image);
+    npy_intp *shp = PyArray_DIMS(image);
+    int ndim = PyArray_NDIM(image), channels = ndim == 3 ? (int) shp[2] : 1;
+    npy_intp out_shp[3] = { Downsampler::reduced_size((int) shp[0], ds),
+        Downsampler::reduced_size((int) shp[1], ds), channels };
+    PyArrayObject *img = (PyArrayObject *) PyArray_ZEROS(ndim, out_shp, numpy_type, 0);
+    if( img == NULL ) { Py_DECREF(image); return NULL; }
+    try {
+        Downsampler downsampler(numpy_type, channels, (int) shp[1], (int) shp[0], ds, reduce, PyArray_DATA(img));
+
+        GILRelease nogil;
+        char const *src = (char const*) PyArray_DATA(image);
+        npy_intp stride = PyArray_STRIDES(image)[0];
+        for( int y=0; y < shp[0]; y++ ) downsampler.write(y, 0, (int) shp[1], src + y*stride);
+        downsampler.finish();
+    } catch (std::exception &e) {
+        Py_DECREF(image); Py_DECREF(img);
+        set_error_from_exception(e);
+        return NULL;
+    }
+    Py_DECREF(image);
+
+    return (PyObject*) img;
+}
+
+static PyObject *convert(PyObject *self, PyObject *args, PyObject *kwds) {
+    PyObject *image_obj, *dtype_obj = Py_None, *window_obj = Py_None, *lut_obj = Py_None;
+    int rgb = 0;
+    static char const *kwlist[] = {"image", "dtype", "window", "lut", "rgb", NULL};
+    // parse arguments
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|OOOp", (char**) kwlist, &image_obj, &dtype_obj, &window_obj,
+            &lut_obj, &rgb))
+        return NULL;
+    PixelConversion conversion;
+    if( !conversion.parse(dtype_obj, window_obj, lut_obj, rgb) ) return NULL;
+
+    PyArrayObject *image = (PyArrayObject*) PyArray_FROMANY(image_obj, NPY_NOTYPE, 2, 3, NPY_ARRAY_C_CONTIGUOUS);
+    if( image == NULL ) return NULL;
+    npy_intp *shp = PyArray_DIMS(image);
+    int channels = PyArray_NDIM(image) == 3 ? (int) shp[2] : 1;
+    int numpy_type = PyArray_TYPE(image);
+    PyArrayObject *img = NULL;
+    try {
+        if( numpy_type != NPY_UINT8 && numpy_type != NPY_UINT16 && numpy_type != NPY_FLOAT32 )
+            throw std::invalid_argument("Conversion only supports uint8, uint16 and float32 images");
+        conversion.setup(numpy_type, channels);
+        img = (PyArrayObject *) PyArray_EMPTY(PyArray_NDIM(image), shp, conversion.out_type, 0);
+        if( img == NULL ) { Py_DECREF(image); return NULL; }
+
+        GILRelease nogil;
+        conversion.convert((char const*) PyArray_DATA(image), (char*) PyArray_DATA(img),
+            (std::size_t) shp[0]*shp[1]);
+    } catch (std::exception &e) {
+        Py_DECREF(image); Py_XDECREF(img);
+        set_error_from_exception(e);
+        return NULL;
+    }
+    Py_DECREF(image);
+
+    return (PyObject*) img;
+}
+
+bool get_pixel_type_info(libCZI::PixelType pixel_type, int &numpy_type, int &pixel_size_bytes, int &channels) {
+    // define numpy types/shapes and bytes per pixel depending on the zeiss bitmap pixel type.
+    switch( pixel_type ) {
+        case libCZI::PixelType::Gray8:
+            numpy_type = NPY_UINT8; pixel_size_bytes = 1; channels = 1;
+            break;
+        case libCZI::PixelType::Gray16:
+            numpy_type = NPY_UINT16; pixel_size_bytes = 2; channels = 1;
+            break;
+        case libCZI::PixelType::Gray32Float:
+            numpy_type = NPY_FLOAT32; pixel_size_bytes = 4; channels = 1;
+            break;
+        case libCZI::PixelType::Bgr24:
+            numpy_type = NPY_UINT8; pixel_size_bytes = 3; channels = 3;
+            break;
+        case libCZI::PixelType::Bgr48:
+            numpy_type = NPY_UINT16; pixel_size_bytes = 6; channels = 3;
+            break;
+        default:
+            std::cout << pixel_type << std::endl;
+            PyErr_SetString(PylibcziError, "Unknown image type in czi file, ask to add more types.");
+            return false;
+    }
+    return true;
+}
+
+PyArrayObject* copy_bitmap_to_numpy_array(std::shared_ptr<libCZI::IBitmapData> pBitmap) {
+    int numpy_type, pixel_size_bytes, channels;
+    if( !get_pixel_type_info(pBitmap->GetPixelType(), numpy_type, pixel_size_bytes, channels) )
+        return NULL;
+
+    // allocate the numpy matrix to copy image into
+    //cout << size_x << " " << size_y << endl;
+    auto size = pBitmap->GetSize();
+    int size_x = size.w, size_y = size.h;
+    PyArrayObject *img;
+    int swap_axes[2];
+    if( channels==1 ) {
+        npy_intp shp[2]; shp[0] = size_x; shp[1] = size_y;
+        // images in czi file are in F-order, set F-order flag (last argument to PyArray_Empty)
+        img = (PyArrayObject *) PyArray_Empty(2, shp, PyArray_DescrFromType(numpy_type), 1);
+        swap_axes[0] = 0; swap_axes[1] = 1;
+    } else {
+        npy_intp shp[3]; shp[1] = size_x; shp[2] = size_y; shp[0] = channels;
+        // images in czi file are in F-order, set F-order flag (last argument to PyArray_Empty)
+        img = (PyArrayObject *) PyArray_Empty(3, shp, PyArray_DescrFromType(numpy_type), 1);
+        swap_axes[0] = 0; swap_axes[1] = 2;
+    }
+    void *pointer = PyArray_DATA(img);
+
+    // copy from the czi lib image pointer to the numpy array pointer
+    auto bitmap = pBitmap->Lock();
+    //cout << "sixe_x " << size_x << " size y " << size_y << endl;
+    //cout << "stride " << bitmap.stride << " size " << bitmap.size << endl;
+    // can not do a single memcpy call because the stride does not necessarily match the row size.
+    npy_byte *cptr = (npy_byte*)pointer, *cimgptr = (npy_byte*)bitmap.ptrDataRoi;
+    // stride units is not documented but emperically means the row (x) stride in bytes, not in pixels.
+    int rowsize = pixel_size_bytes * size_x; //, imgrowsize = pixel_size_bytes * bitmap.stride;
+    for( int y=0; y < size_y; y++ ) {
+        std::memcpy(cptr, cimgptr, rowsize);
+        cptr += rowsize; cimgptr += bitmap.stride;
+    }
+    pBitmap->Unlock();
+
+    // transpose to convert from F-order to C-order array
+    return (PyArrayObject*) PyArray_SwapAxes(img,swap_axes[0],swap_axes[1]);
+}
+
+PyObject* wrap_bitmap(std::shared_ptr<libCZI::IBitmapData> pBitmap) {
+    int numpy_type, pixel_size_bytes, channels;
+    if( !get_pixel_type_info(pBitmap->GetPixelType(), numpy_type, pixel_size_bytes, channels) )
+        return NULL;
+
+    PylibcziBitmap *obj = PyObject_New(PylibcziBitmap, &PylibcziBitmapType);
+    if( obj == NULL ) return NULL;
+    obj->bitmap = new std::shared_ptr<libCZI::IBitmapData>(pBitmap);
+    obj->nexports = 0;
+    obj->channels = channels;
+    obj->itemsize = pixel_size_bytes / channels;
+    switch( numpy_type ) {
+        case NPY_UINT8: obj->format = "B"; break;
+        case NPY_UINT16: obj->format = "H"; break;
+        default: obj->format = "f"; break;
+    }
+
+    // the stride is only known once the bitmap is locked, lock once here to fill in the buffer layout.
+    auto size = pBitmap->GetSize();
+    auto bitmap = pBitmap->Lock();
+    obj->shape[0] = size.h; obj->shape[1] = size.w; obj->shape[2] = channels;
+    obj->strides[0] = bitmap.stride; obj->strides[1] = pixel_size_bytes; obj->strides[2] = obj->itemsize;
+    pBitmap->Unlock();
+
+    return (PyObject*) obj;
+}
+
+static void PylibcziBitmap_dealloc(PylibcziBitmap *self) {
+    // libCZI considers destroying a locked bitmap a fatal error, but exported buffers hold a reference to us,
+    //   so the bitmap is always unlocked by the time we get here.
+    delete self->bitmap;
+    PyObject_Del(self);
+}
+
+static int PylibcziBitmap_getbuffer(PylibcziBitmap *self, Py_buffer *view, int flags) {
+    // the rows are padded to the stride, so only strided requests can be served.
+    if( (flags & PyBUF_STRIDES) != PyBUF_STRIDES ) {
+        PyErr_SetString(PyExc_BufferError, "Bitmap is strided, request a strided buffer (e.g. np.asarray)");
+        return -1;
+    }
+    if( self->nexports == 0 ) self->lock_info = (*self->bitmap)->Lock();
+    self->nexports++;
+
+    view->obj = (PyObject*) self; Py_INCREF(self);
+    view->buf = self->lock_info.ptrDataRoi;
+    view->ndim = (self->channels == 1) ? 2 : 3;
+    view->itemsize = self->itemsize;
+    view->len = self->shape[0] * self->shape[1] * self->shape[2] * self->itemsize;
+    view->readonly = 0;
+    view->format = (flags & PyBUF_FORMAT) ? (char*) self->format : NULL;
+    view->shape = self->shape;
+    view->strides = self->strides;
+    view->suboffsets = NULL;
+    view->internal = NULL;
+    return 0;
+}
+
+static void PylibcziBitmap_releasebuffer(PylibcziBitmap *self, Py_buffer *view) {
+    if( --self->nexports == 0 ) (*self->bitmap)->Unlock();
+}
+
+static PyObject *PylibcziBitmap_get_shape(PylibcziBitmap *self, void *closure) {
+    if( self->channels == 1 ) return Py_BuildValue("(nn)", self->shape[0], self->shape[1]);
+    return Py_BuildValue("(nnn)", self->shape[0], self->shape[1], self->shape[2]);
+}
+
+static PyObject *PylibcziBitmap_get_stride(PylibcziBitmap *self, void *closure) {
+    return PyLong_FromSsize_t(self->strides[0]);
+}
+
+static PyObject *PylibcziBitmap_get_pixel_type(PylibcziBitmap *self, void *closure) {
+    std::ostringstream out;
+    out << (*self->bitmap)->GetPixelType();
+    // strip the libCZI::PixelType:: prefix
+    std::string name = out.str();
+    return PyUnicode_FromString(name.substr(name.rfind(':') + 1).c_str());
+}
+
+std::shared_ptr<CziSource> open_czisource_from_pyobject(PyObject *source) {
+    // open the czi reader on a path, a python buffer or a python file-like object.
+    std::shared_ptr<libCZI::IStream> stream;
+    PyObject *path = NULL;
+    if( PyUnicode_Check(source) || PyObject_HasAttrString(source, "__fspath__") ) {
+        path = PyOS_FSPath(source);
+        if( path == NULL ) return nullptr;
+    }
+    try {
+        if( path != NULL ) {
+            if( !PyUnicode_Check(path) ) {
+                Py_DECREF(path);
+                PyErr_SetString(PyExc_TypeError, "czi filename must be str");
+                return nullptr;
+            }
+            wchar_t *wcstring = PyUnicode_AsWideCharString(path, NULL);
+            Py_DECREF(path);
+            if( wcstring == NULL ) return nullptr;
+            try {
+                stream = libCZI::CreateStreamFromFile(wcstring);
+            } catch (...) {
+                PyMem_Free(wcstring);
+                throw;
+            }
+            PyMem_Free(wcstring);
+        } else if( PyObject_CheckBuffer(source) ) {
+            stream = std::make_shared<PyBufferStream>(source);
+        } else if( PyObject_HasAttrString(source, "readinto") && PyObject_HasAttrString(source, "seek") ) {
+            stream = std::make_shared<PyFileStream>(source);
+        } else {
+            PyErr_SetString(PyExc_TypeError,
+                "czi source must be a filename, CziReader, buffer or file-like object with seek and readinto");
+            return nullptr;
+        }
+        auto czi = std::make_shared<CziSource>();
+        czi->stream = std::make_shared<ReadaheadStream>(stream);
+        czi->reader = libCZI::CreateCZIReader();
+        czi->reader->Open(czi->stream);
+        return czi;
+    } catch (std::exception &e) {
+        if( !PyErr_Occurred() ) set_error_from_exception(e);
+        return nullptr;
+    }
+}
+
+bool ReaderHandle::open(PyObject *source) {
+    if( PyObject_TypeCheck(source, &PylibcziReaderType) ) {
+        PylibcziReader *pyreader = (PylibcziReader*) source;
+        if( pyreader->closed ) {
+            PyErr_SetString(PylibcziError, "CziReader is closed");
+            return false;
+        }
+        if( pyreader->czi == NULL || pyreader->pid != (long) getpid() ) {
+            // lazy reader or reader inherited from the parent process over fork. a python file-like object shares
+            //   its file offset with the parent, so it can not be opened again (same as for pickling).
+            if( pyreader->pid != (long) getpid() && !reopenable(pyreader->source) ) {
+                PyErr_SetString(PyExc_TypeError,
+                    "CziReader on a file-like object can not be used in another process");
+                return false;
+            }
+            auto reopened = open_czisource_from_pyobject(pyreader->source);
+            if( !reopened ) return false;
+            release_inherited(pyreader);
+            pyreader->czi = new std::shared_ptr<CziSource>(reopened);
+            pyreader->pid = (long) getpid();
+        }
+        czi = *pyreader->czi; owned = false;
+    } else {
+        czi = open_czisource_from_pyobject(source); owned = true;
+    }
+    return (bool) czi;
+}
+
+static void append_nested_messages(std::exception const &e, std::string &msg) {
+    try {
+        std::rethrow_if_nested(e);
+    } catch (std::exception const &inner) {
+        msg += " -> "; msg += inner.what();
+        append_nested_messages(inner, msg);
+    } catch (...) {
+    }
+}
+
+void set_error_from_exception(std::exception const &e) {
+    // a stopped read raises the error that stopped it (e.g. KeyboardInterrupt) or pylibczi.cancelled.
+    auto cancelled = dynamic_cast<ReadCancelled const*>(&e);
+    if( cancelled != nullptr ) {
+        cancelled->monitor->set_error();
+        return;
+    }
+    // an error raised by a python callback takes precedence.
+    if( PyErr_Occurred() ) return;
+    // libCZI reports all errors by exceptions, which must not propagate into python.
+    //   io errors wrap the exception thrown by the stream, append the nested messages.
+    std::string msg(e.what());
+    append_nested_messages(e, msg);
+    PyErr_SetString(PylibcziError, msg.c_str());
+}
+
+static PyObject *PylibcziReader_new(PyTypeObject *type, PyObject *args, PyObject *kwds) {
+    PyObject *source;
+    int lazy = 0;
+    static char const *kwlist[] = {"source", "lazy", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|p", (char**) kwlist, &source, &lazy))
+        return NULL;
+    if( PyObject_TypeCheck(source, &PylibcziReaderType) ) {
+        PyErr_SetString(PyExc_TypeError, "source is already a CziReader");
+        return NULL;
+    }
+
+    std::shared_ptr<CziSource> czi;
+    if( !lazy ) {
+        czi = open_czisource_from_pyobject(source);
+        if( !czi ) return NULL;
+    }
+
+    PylibcziReader *self = (PylibcziReader*) type->tp_alloc(type, 0);
+    if( self == NULL ) return NULL;
+    self->czi = lazy ? NULL : new std::shared_ptr<CziSource>(czi);
+    Py_INCREF(source); self->source = source;
+    self->pid = (long) getpid();
+    self->closed = 0;
+    return (PyObject*) self;
+}
+
+static PyObject *PylibcziReader_close(PylibcziReader *self, PyObject *args) {
+    if( self->czi != NULL ) {
+        if( self->pid == (long) getpid() ) {
+            (*self->czi)->reader->Close();
+            delete self->czi;
+            self->czi = NULL;
+        } else {
+            release_inherited(self);
+        }
+    }
+    self->closed = 1;
+    Py_RETURN_NONE;
+}
+
+static void release_inherited(PylibcziReader *self) {
+    // release the holder of a reader inherited over fork without closing it (the parent still uses it). it is
+    //   only destroyed if no other reference was copied. a parent thread that was using the reader (and maybe
+    //   holding its locks) at the fork held a reference, which is never released in the child, so the reader is
+    //   only destroyed if none of its locks can be held. destroying it closes the file descriptor of the child.
+    if( self->czi == NULL || self->pid == (long) getpid() ) return;
+    delete self->czi;
+    self->czi = NULL;
+}
+
+static bool reopenable(PyObject *source) {
+    // a filename or buffer can be opened again in another process, a python file-like object can not.
+    return !PyObject_HasAttrString(source, "readinto");
+}
+
+static PyObject *PylibcziReader_reduce(PylibcziReader *self, PyObject *args) {
+    // only the source is pickled (a filename is cheap, a buffer is copied), the unpickled reader opens it lazily.
+    if( !reopenable(self->source) ) {
+        PyErr_SetString(PyExc_TypeError, "CziReader on a file-like object can not be pickled");
+        return NULL;
+    }
+    return Py_BuildValue("(O(OO))", (PyObject*) Py_TYPE(self), self->source, Py_True);
+}
+
+static void PylibcziReader_dealloc(PylibcziReader *self) {
+    Py_XDECREF(PylibcziReader_close(self, NULL));
+    Py_XDECREF(self->source);
+    Py_TYPE(self)->tp_free((PyObject*) self);
+}
+
+static PyObject *PylibcziReader_enter(PylibcziReader *self, PyObject *args) {
+    Py_INCREF(self);
+    return (PyObject*) self;
+}
+
+static PyObject *PylibcziReader_exit(PylibcziReader *self, PyObject *args) {
+    return PylibcziReader_close(self, NULL);
+}
+
+static std::int64_t steady_ns() {
+    return std::chrono::duration_cast<std::chrono::nanoseconds>(
+        std::chrono::steady_clock::now().time_since_epoch()).count();
+}
+
+ReadMonitor::ReadMonitor(PyObject *callback, double interval) : done(0), total(0), bytes(0), cancelled(false),
+        callback(callback), interval_ns((std::int64_t) (interval*1e9)), next_poll(steady_ns() + interval_ns),
+        failed(false), error_type(NULL), error_value(NULL), error_traceback(NULL) {
+    Py_XINCREF(callback);
+}
+
+ReadMonitor::~ReadMonitor() {
+    if( callback == NULL && error_type == NULL ) return;
+    GILAcquire gil;
+    Py_XDECREF(callback);
+    Py_XDECREF(error_type); Py_XDECREF(error_value); Py_XDECREF(error_traceback);
+}
+
+void ReadMonitor::check() {
+    if( !cancelled && !failed ) {
+        // only one thread polls per interval, the others continue decoding.
+        std::int64_t now = steady_ns(), next = next_poll;
+        if( now >= next && next_poll.compare_exchange_strong(next, now + interval_ns) ) poll();
+    }
+    if( cancelled || failed ) throw ReadCancelled(shared_from_this());
+}
+
+void ReadMonitor::finish() {
+    if( callback != NULL && !failed ) poll();
+    if( failed ) throw ReadCancelled(shared_from_this());
+}
+
+void ReadMonitor::poll() {
+    GILAcquire gil;
+    // signals are only handled in the main thread, elsewhere this does nothing.
+    bool error = PyErr_CheckSignals() < 0;
+    if( !error && callback != NULL ) {
+        PyObject *ret = PyObject_CallFunction(callback, "KKK", (unsigned long long) done,
+            (unsigned long long) total, (unsigned long long) bytes);
+        int stop = (ret == NULL) ? -1 : PyObject_IsTrue(ret);
+        Py_XDECREF(ret);
+        error = stop < 0;
+        if( stop > 0 ) cancelled = true;
+    }
+    if( error ) {
+        // keep the error to raise it in the thread that started the read, this may be a worker thread.
+        std::lock_guard<std::mutex> lock(mutex);
+        if( error_type == NULL ) PyErr_Fetch(&error_type, &error_value, &error_traceback); else PyErr_Clear();
+        failed = true;
+    }
+}
+
+void ReadMonitor::reset() {
+    std::lock_guard<std::mutex> lock(mutex);
+    Py_XDECREF(error_type); Py_XDECREF(error_value); Py_XDECREF(error_traceback);
+    error_type = error_value = error_traceback = NULL;
+    done = 0; total = 0; bytes = 0;
+    cancelled = false; failed = false;
+    next_poll = steady_ns() + interval_ns;
+}
+
+void ReadMonitor::set_error() {
+    std::lock_guard<std::mutex> lock(mutex);
+    if( error_type != NULL ) {
+        // the error is raised once, the progress can be used again for other reads.
+        PyErr_Restore(error_type, error_value, error_traceback);
+        error_type = error_value = error_traceback = NULL;
+        failed = false;
+    } else {
+        PyErr_SetString(PylibcziCancelled, "Read was cancelled");
+    }
+}
+
+// Get the monitor for the progress argument of a read, a new one for None. Sets a python error for other types.
+bool get_read_monitor(PyObject *progress, std::shared_ptr<ReadMonitor> &monitor) {
+    if( progress == Py_None ) {
+        monitor = std::make_shared<ReadMonitor>();
+    } else if( PyObject_TypeCheck(progress, &PylibcziProgressType) ) {
+        monitor = *((PylibcziProgress*) progress)->monitor;
+    } else {
+        PyErr_SetString(PyExc_TypeError, "progress must be a ReadProgress or None");
+        return false;
+    }
+    return true;
+}
+
+static PyObject *PylibcziProgress_new(PyTypeObject *type, PyObject *args, PyObject *kwds) {
+    PyObject *callback = Py_None;
+    double interval = 0.1;
+    static char const *kwlist[] = {"callback", "interval", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|Od", (char**) kwlist, &callback, &interval))
+        return NULL;
+    if( callback != Py_None && !PyCallable_Check(callback) ) {
+        PyErr_SetString(PyExc_TypeError, "callback must be callable");
+        return NULL;
+    }
+
+    PylibcziProgress *self = (PylibcziProgress*) type->tp_alloc(type, 0);
+    if( self == NULL ) return NULL;
+    self->monitor = new std::shared_ptr<ReadMonitor>(
+        std::make_shared<ReadMonitor>(callback == Py_None ? NULL : callback, std::max(interval, 0.)));
+    return (PyObject*) self;
+}
+
+static void PylibcziProgress_dealloc(PylibcziProgress *self) {
+    delete self->monitor;
+    Py_TYPE(self)->tp_free((PyObject*) self);
+}
+
+static PyObject *PylibcziProgress_cancel(PylibcziProgress *self, PyObject *args) {
+    (*self->monitor)->cancel();
+    Py_RETURN_NONE;
+}
+
+static PyObject *PylibcziProgress_reset(PylibcziProgress *self, PyObject *args) {
+    (*self->monitor)->reset();
+    Py_RETURN_NONE;
+}
+
+static PyObject *PylibcziProgress_get_counter(PylibcziProgress *self, void *closure) {
+    auto const &monitor = *self->monitor;
+    std::atomic<std::uint64_t> const *counters[] = {&monitor->done, &monitor->total, &monitor->bytes};
+    return PyLong_FromUnsignedLongLong(*counters[(size_t) closure]);
+}
+
+static PyObject *PylibcziProgress_get_cancelled(PylibcziProgress *self, void *closure) {
+    return PyBool_FromLong((*self->monitor)->cancelled);
+}
+
+static inline std::int32_t get_int32(unsigned char const *p) {
+    // czi files are little endian
+    return (std::int32_t) ((std::uint32_t) p[0] | ((std::uint32_t) p[1] << 8) | ((std::uint32_t) p[2] << 16) |
+        ((std::uint32_t) p[3] << 24));
+}
+
+static inline std::int64_t get_int64(unsigned char const *p) {
+    return (std::int64_t) ((std::uint64_t) (std::uint32_t) get_int32(p) |
+        ((std::uint64_t) (std::uint32_t) get_int32(p + 4) << 32));
+}
+
+static std::uint64_t read_at(libCZI::IStream *stream, std::uint64_t offset, std::vector<unsigned char> &buf,
+        std::uint64_t size) {
+    buf.resize(size);
+    std::uint64_t nread = 0;
+    stream->Read(offset, buf.data(), size, &nread);
+    buf.resize(nread);
+    return nread;
+}
+
+bool read_subblock_extents(libCZI::IStream *stream, std::vector<SubBlockExtent> &extents,
+        std::vector<libCZI::IntRect> &rects) {
+    // libCZI does not expose where the subblocks are stored, so parse the subblock directory ourselves.
+    //   only the positions (and the x/y start to check against libCZI) are needed. rects gets x and y only.
+    std::vector<unsigned char> buf;
+
+    // file header segment, 32 byte segment header followed by the file header data
+    if( read_at(stream, 0, buf, 32 + 80) < 32 + 80 || std::memcmp(buf.data(), "ZISRAWFILE", 10) != 0 )
+        return false;
+    std::int64_t directory_position = get_int64(&buf[32 + 52]);
+    std::int64_t metadata_position = get_int64(&buf[32 + 60]);
+    std::int64_t attachments_position = get_int64(&buf[32 + 72]);
+    if( directory_position <= 0 ) return false;
+
+    // every segment ends where the next segment in the file starts, collect the start of all segments.
+    std::vector<std::uint64_t> boundaries;
+    boundaries.push_back(directory_position);
+    if( metadata_position > 0 ) boundaries.push_back(metadata_position);
+    if( attachments_position > 0 ) boundaries.push_back(attachments_position);
+
+    // subblock directory segment, 128 bytes of fixed data followed by the (variable size) directory entries
+    if( read_at(stream, directory_position, buf, 32 + 128) < 32 + 128 ||
+        std::memcmp(buf.data(), "ZISRAWDIRECTORY", 15) != 0 ) return false;
+    std::int32_t count = get_int32(&buf[32]);
+    std::int64_t used_size = get_int64(&buf[24]);
+    if( used_size <= 128 ) used_size = get_int64(&buf[16]);
+    if( count < 0 || used_size <= 128 ) return false;
+    read_at(stream, directory_position + 32 + 128, buf, used_size - 128);
+
+    extents.resize(count); rects.resize(count);
+    size_t pos = 0;
+    for( std::int32_t i=0; i < count; i++ ) {
+        if( pos + 32 > buf.size() ) return false;
+        unsigned char const *entry = buf.data() + pos;
+        std::int64_t file_position; int x = 0, y = 0;
+        if( entry[0] == 'D' && entry[1] == 'V' ) {
+            std::int32_t ndims = get_int32(entry + 28);
+            if( ndims < 0 || pos + 32 + 20*(size_t)ndims > buf.size() ) return false;
+            file_position = get_int64(entry + 6);
+            for( int d=0; d < ndims; d++ ) {
+                unsigned char const *dim = entry + 32 + 20*d;
+                if( dim[1] != 0 ) continue;
+                if( dim[0] == 'X' ) x = get_int32(dim + 4);
+                if( dim[0] == 'Y' ) y = get_int32(dim + 4);
+            }
+            pos += 32 + 20*ndims;
+        } else if( entry[0] == 'D' && entry[1] == 'E' ) {
+            if( pos + 128 > buf.size() ) return false;
+            file_position = get_int64(entry + 80);
+            x = get_int32(entry + 16); y = get_int32(entry + 24);
+            pos += 128;
+        } else {
+            return false;
+        }
+        extents[i].position = file_position; extents[i].size = 0;
+        rects[i] = libCZI::IntRect{ x, y, 0, 0 };
+        boundaries.push_back(file_position);
+    }
+
+    // attachment directory segment, 256 bytes of fixed data followed by 128 byte entries
+    if( attachments_position > 0 && read_at(stream, attachments_position, buf, 32 + 256) == 32 + 256 &&
+        std::memcmp(buf.data(), "ZISRAWATTDIR", 12) == 0 ) {
+        std::int32_t nattachments = get_int32(&buf[32]);
+        std::uint64_t entries_bytes = 128*(std::uint64_t)nattachments;
+        if( nattachments > 0 &&
+                read_at(stream, attachments_position + 32 + 256, buf, entries_bytes) == entries_bytes ) {
+            for( std::int32_t i=0; i < nattachments; i++ ) boundaries.push_back(get_int64(&buf[128*i + 12]));
+        }
+    }
+
+    std::sort(boundaries.begin(), boundaries.end());
+    for( auto &extent : extents ) {
+        auto next = std::upper_bound(boundaries.begin(), boundaries.end(), extent.position);
+        if( next != boundaries.end() ) {
+            extent.size = *next - extent.position;
+        } else {
+            // last segment in the file, get the size from its segment header
+            if( read_at(stream, extent.position, buf, 32) < 32 ) return false;
+            extent.size = 32 + get_int64(&buf[16]);
+        }
+    }
+    return true;
+}
+
+std::vector<SubBlockExtent> const& CziSource::extents() {
+    std::lock_guard<std::mutex> lock(mutex);
+    if( !extents_parsed ) {
+        extents_parsed = true;
+        std::vector<libCZI::IntRect> rects;
+        bool valid = false;
+        try {
+            valid = read_subblock_extents(stream->base_stream(), subblock_extents, rects);
+            // the directory must list the subblocks in the same order libCZI enumerates them.
+            int count = 0;
+            if( valid ) {
+                reader->EnumerateSubBlocks([&valid, &count, &rects](int idx, const libCZI::SubBlockInfo& info)
+                {
+                    valid = (idx >= 0 && idx < (int) rects.size() && rects[idx].x == info.logicalRect.x &&
+                        rects[idx].y == info.logicalRect.y);
+                    count++;
+                    return valid;
+                });
+            }
+            valid = valid && (count == (int) rects.size());
+        } catch (std::exception &e) {
+            valid = false;
+        }
+        // without the subblock positions reads are done in directory order without readahead.
+        if( !valid ) subblock_extents.clear();
+    }
+    return subblock_extents;
+}
+
+bool parse_subblock_indices(PyObject *indices_obj, std::vector<int> &indices) {
+    PyArrayObject *arr = (PyArrayObject *) PyArray_FROMANY(indices_obj, NPY_INT64, 1, 1,
+        NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    if( arr == NULL ) return false;
+    npy_int64 *ptr = (npy_int64 *) PyArray_DATA(arr);
+    indices.assign(ptr, ptr + PyArray_SIZE(arr));
+    Py_DECREF(arr);
+    return true;
+}
+
+bool box_to_rect(npy_int64 const *box, libCZI::IntRect &rect) {
+    // the libCZI coordinates are int, refuse boxes that would be truncated instead of reading another region.
+    npy_int64 const lim = std::numeric_limits<int>::max();
+    if( box[2] < 0 || box[3] < 0 ) {
+        PyErr_SetString(PylibcziError, "Box sizes must not be negative");
+        return false;
+    }
+    if( box[0] < -lim || box[1] < -lim || box[2] > lim || box[3] > lim || box[0] > lim - box[2] ||
+            box[1] > lim - box[3] ) {
+        PyErr_SetString(PylibcziError, "Box must be within the int32 range");
+        return false;
+    }
+    rect = libCZI::IntRect{ (int) box[0], (int) box[1], (int) box[2], (int) box[3] };
+    return true;
+}
+
+std::vector<SubBlockEntry> enumerate_subblock_entries(CziSource &czi, std::vector<int> const *indices) {
+    // all the subblocks in directory order, or the subblocks with the given indices in the given order.
+    std::vector<SubBlockEntry> entries;
+    std::unordered_map<int, size_t> slots;
+    bool use_indices = (indices != nullptr);
+    if( use_indices ) {
+        entries.assign(indices->size(), SubBlockEntry{-1, libCZI::IntRect{0, 0, 0, 0}, 0, SubBlockExtent{0, 0}});
+        for( size_t i=0; i < indices->size(); i++ ) {
+            if( !slots.insert(std::make_pair((*indices)[i], i)).second )
+                throw std::invalid_argument("Subblock indices must be unique");
+        }
+    }
+    czi.reader->EnumerateSubBlocks(
+        [&entries, &slots, use_indices](int idx, const libCZI::SubBlockInfo& info)
+    {
+        //std::cout << "Index " << idx << ": " << libCZI::Utils::DimCoordinateToString(&info.coordinate)
+        //  << " Rect=" << info.logicalRect << " M-index " << info.mIndex << std::endl;
+        SubBlockEntry entry{idx, info.logicalRect, info.mIndex, SubBlockExtent{0, 0}};
+        if( !use_indices ) {
+            entries.push_back(entry);
+        } else {
+            auto slot = slots.find(idx);
+            if( slot != slots.end() ) entries[slot->second] = entry;
+        }
+        return true;
+    });
+    for( auto const &entry : entries ) {
+        if( entry.index < 0 ) throw std::out_of_range("Subblock index not found");
+    }
+    fill_subblock_extents(czi, entries);
+    return entries;
+}
+
+void fill_subblock_extents(CziSource &czi, std::vector<SubBlockEntry> &entries) {
+    auto const &extents = czi.extents();
+    for( auto &entry : entries ) {
+        if( entry.index >= 0 && entry.index < (int) extents.size() ) entry.extent = extents[entry.index];
+    }
+}
+
+std::vector<ReadRange> plan_sequential_reads(std::vector<SubBlockEntry> const &entries,
+        std::vector<size_t> const &order, std::uint64_t readahead, std::uint64_t max_gap) {
+    // merge subblocks that follow each other in the file (order is sorted by file position) into one read,
+    //   as long as the gap between them is at most max_gap and the read is not larger than readahead.
+    std::vector<ReadRange> ranges;
+    for( size_t k=0; k < order.size(); k++ ) {
+        auto const &extent = entries[order[k]].extent;
+        if( !ranges.empty() && extent.size > 0 ) {
+            auto &range = ranges.back();
+            std::uint64_t end = range.offset + range.size;
+            if( range.size > 0 && extent.position >= end && extent.position - end <= max_gap &&
+                    extent.position + extent.size - range.offset <= readahead ) {
+                range.size = extent.position + extent.size - range.offset;
+                range.end = k + 1;
+                continue;
+            }
+        }
+        ranges.push_back(ReadRange{ extent.position, extent.size, k, k + 1 });
+    }
+    return ranges;
+}
+
+// unregisters a readahead chunk also when leaving through an exception
+class ChunkGuard {
+public:
+    ChunkGuard(ReadaheadStream &stream, std::shared_ptr<ReadaheadChunk> chunk) : stream(stream), chunk(chunk) {}
+    ~ChunkGuard() { if( chunk ) stream.release(chunk); }
+private:
+    ReadaheadStream &stream;
+    std::shared_ptr<ReadaheadChunk> chunk;
+};
+
+void read_in_file_order(CziSource &czi, std::vector<SubBlockEntry> const &entries, std::uint64_t readahead,
+        std::uint64_t max_gap,
+        std::function<std::uint64_t(size_t, std::shared_ptr<libCZI::ISubBlock> const&)> const &func,
+        int nthreads, std::shared_ptr<ReadMonitor> const &monitor) {
+    // without a monitor from python signals are still checked, so that long reads can be interrupted.
+    auto progress = monitor ? monitor : std::make_shared<ReadMonitor>();
+    progress->begin(entries.size());
+
+    // EnumerateSubBlocks order is not necessarily the order the subblocks are stored in, read them sorted by file
+    //   position to avoid seeking back and forth. Subblocks with unknown position keep their order.
+    std::vector<size_t> order(entries.size());
+    for( size_t i=0; i < order.size(); i++ ) order[i] = i;
+    std::stable_sort(order.begin(), order.end(), [&entries](size_t a, size_t b)
+    {
+        return entries[a].extent.position < entries[b].extent.position;
+    });
+
+    auto ranges = plan_sequential_reads(entries, order, readahead, max_gap);
+    auto process = [&](ReadRange const &range)
+    {
+        // with readahead, fetch all subblocks of the range with one sequential read and process them from memory.
+        std::shared_ptr<ReadaheadChunk> chunk;
+        if( readahead > 0 && range.size > 0 && range.end - range.begin > 1 )
+            chunk = czi.stream->load(range.offset, range.size);
+        ChunkGuard guard(*czi.stream, chunk);
+        for( size_t k=range.begin; k < range.end; k++ ) {
+            progress->check();
+            progress->update(func(order[k], czi.reader->ReadSubBlock(entries[order[k]].index)));
+        }
+    };
+    if( nthreads <= 1 || ranges.size() <= 1 ) {
+        for( auto const &range : ranges ) process(range);
+        progress->finish();
+        return;
+    }
+
+    // process the ranges in parallel, still picking them up in file order. func must be thread-safe.
+    std::atomic<size_t> next(0);
+    std::atomic<bool> failed(false);
+    std::exception_ptr error;
+    std::mutex error_mutex;
+    auto worker = [&]()
+    {
+        while( !failed ) {
+            size_t r = next++;
+            if( r >= ranges.size() ) break;
+            try {
+                process(ranges[r]);
+            } catch (...) {
+                std::lock_guard<std::mutex> lock(error_mutex);
+                if( !error ) error = std::current_exception();
+                failed = true;
+            }
+        }
+    };
+    std::vector<std::thread> threads;
+    for( int t=1; t < std::min(nthreads, (int) ranges.size()); t++ ) threads.push_back(std::thread(worker));
+    worker();
+    for( auto &thread : threads ) thread.join();
+    if( error ) std::rethrow_exception(error);
+    progress->finish();
+}
+
+void decode_in_file_order(CziSource &czi, std::vector<SubBlockEntry> const &entries, std::uint64_t readahead,
+        std::uint64_t max_gap,
+        std::function<void(size_t, std::shared_ptr<libCZI::IBitmapData> const&)> const &func,
+        int nthreads, std::shared_ptr<ReadMonitor> const &monitor) {
+    read_in_file_order(czi, entries, readahead, max_gap,
+        [&func](size_t i, std::shared_ptr<libCZI::ISubBlock> const &subblock)
+    {
+        auto bitmap = subblock->CreateBitmap();
+        func(i, bitmap);
+        // progress counts the decoded bytes
+        auto size = bitmap->GetSize();
+        return (std::uint64_t) size.w*size.h*libCZI::Utils::GetBytesPerPixel(bitmap->GetPixelType());
+    }, nthreads, monitor);
+}
+
+RegionComposer::RegionComposer(CziSource &czi, std::vector<libCZI::IntRect> const &rects,
+        std::function<bool(size_t, libCZI::IntRect const&)> const &needed, int channel) :
+        pixel_type(libCZI::PixelType::Invalid), czi(czi), rects(rects), region_entries(rects.size()),
+        compositors(rects.size()) {
+    // xxx - how to generalize correct image dimension here? only the channel of the plane can be selected.
+    libCZI::CDimCoordinate planeCoord{ { libCZI::DimensionIndex::C,channel } };
+    std::unordered_map<int, size_t> slots;
+    for( size_t r=0; r < rects.size(); r++ ) {
+        if( rects[r].w <= 0 || rects[r].h <= 0 ) continue;
+        czi.reader->EnumSubset(&planeCoord, &rects[r], true,
+            [&](int idx, const libCZI::SubBlockInfo& info)
+        {
+            if( needed && !needed(r, info.logicalRect) ) return true;
+            auto slot = slots.find(idx);
+            if( slot == slots.end() ) {
+                slot = slots.insert(std::make_pair(idx, entries.size())).first;
+                entries.push_back(SubBlockEntry{idx, info.logicalRect, info.mIndex, SubBlockExtent{0, 0}});
+                users.push_back(std::vector<std::pair<size_t, size_t>>());
+            }
+            users[slot->second].push_back(std::make_pair(r, region_entries[r].size()));
+            region_entries[r].push_back(entries[slot->second]);
+            pixel_type = info.pixelType;
+            return true;
+        });
+    }
+    if( pixel_type == libCZI::PixelType::Invalid ) {
+        // nothing to read, still need the pixel type of the image
+        czi.reader->EnumerateSubBlocks([this](int idx, const libCZI::SubBlockInfo& info)
+        {
+            pixel_type = info.pixelType;
+            return false;
+        });
+    }
+    fill_subblock_extents(czi, entries);
+}
+
+void RegionComposer::set_output(size_t i, void *out, int pixel_size_bytes, RowSink *sink) {
+    compositors[i].reset(new Compositor(region_entries[i], rects[i], pixel_type, out, pixel_size_bytes, sink));
+}
+
+void RegionComposer::read(std::uint64_t readahead, std::uint64_t max_gap, int nthreads,
+        std::shared_ptr<ReadMonitor> const &monitor) {
+    // each output pixel is only drawn by one subblock, so the subblocks can be drawn from several threads.
+    decode_in_file_order(czi, entries, readahead, max_gap,
+        [this](size_t i, std::shared_ptr<libCZI::IBitmapData> const &bitmap)
+    {
+        for( auto const &user : users[i] ) {
+            if( compositors[user.first] ) compositors[user.first]->draw(user.second, bitmap.get());
+        }
+    }, nthreads, monitor);
+}
+
+void compose_with_accessor(CziSource &czi, libCZI::IntRect const &rect, int channel, libCZI::PixelType pixel_type,
+        void *out, int pixel_size_bytes, RowSink *sink) {
+    // the libCZI single channel tile accessor reads the subblocks in directory order sorted by M-index and
+    //   composes them into a full resolution bitmap, which is then copied row by row. used to compare with the
+    //   file order.
+    libCZI::CDimCoordinate planeCoord{ { libCZI::DimensionIndex::C,channel } };
+    libCZI::ISingleChannelTileAccessor::Options options; options.Clear();
+    options.backGroundColor.r = options.backGroundColor.g = options.backGroundColor.b = 0;
+    auto bitmap = czi.reader->CreateSingleChannelTileAccessor()->Get(pixel_type, rect, &planeCoord, &options);
+
+    BitmapLock lock(bitmap.get());
+    std::size_t row_bytes = (std::size_t) rect.w*pixel_size_bytes;
+    for( int y=0; y < rect.h; y++ ) {
+        char const *src = (char const*) lock.info.ptrDataRoi + (std::size_t) y*lock.info.stride;
+        if( sink ) sink->write(y, 0, rect.w, src);
+        else std::memcpy((char*) out + y*row_bytes, src, row_bytes);
+    }
+}
+
+Compositor::Compositor(std::vector<SubBlockEntry> const &entries, libCZI::IntRect const &rect,
+        libCZI::PixelType pixel_type, void *out, int pixel_size_bytes, RowSink *sink) :
+        entries(entries), rect(rect), pixel_type(pixel_type), out((char*) out),
+        pixel_size_bytes(pixel_size_bytes), sink(sink), occluders(entries.size()) {
+    // the libCZI accessor sorts by M-index (invalid M-index first) and draws in that order. the entry drawn later
+    //   wins where subblocks overlap, ties go to the later subblock in the directory.
+    auto priority = [&entries](size_t i)
+    {
+        int m = entries[i].m_index;
+        bool valid = (m != std::numeric_limits<int>::max() && m != std::numeric_limits<int>::min());
+        return std::make_pair(valid ? m : std::numeric_limits<int>::min(), i);
+    };
+
+    // find the overlapping subblocks with a sweep over the subblocks sorted by x.
+    std::vector<size_t> byx(entries.size());
+    for( size_t i=0; i < byx.size(); i++ ) byx[i] = i;
+    std::sort(byx.begin(), byx.end(),
+        [&entries](size_t a, size_t b) { return entries[a].rect.x < entries[b].rect.x; });
+    for( size_t k=0; k < byx.size(); k++ ) {
+        auto const &r = entries[byx[k]].rect;
+        for( size_t l=k+1; l < byx.size() && entries[byx[l]].rect.x < r.x + r.w; l++ ) {
+            auto const &o = entries[byx[l]].rect;
+            if( o.y >= r.y + r.h || r.y >= o.y + o.h || o.w <= 0 || o.h <= 0 ) continue;
+            size_t i = byx[k], j = byx[l];
+            if( priority(i) < priority(j) ) occluders[i].push_back(j); else occluders[j].push_back(i);
+        }
+    }
+}
+
+void Compositor::draw(size_t i, libCZI::IBitmapData *bitmap) {
+    if( bitmap->GetPixelType() != pixel_type )
+        throw std::runtime_error("Subblocks with different pixel types can not be composed");
+
+    // the visible part of the subblock in the output image
+    auto const &r = entries[i].rect;
+    auto size = bitmap->GetSize();
+    int x0 = std::max(r.x, rect.x), x1 = std::min(r.x + std::min((int) size.w, r.w), rect.x + rect.w);
+    int y0 = std::max(r.y, rect.y), y1 = std::min(r.y + std::min((int) size.h, r.h), rect.y + rect.h);
+    if( x0 >= x1 || y0 >= y1 ) return;
+
+    BitmapLock lock(bitmap);
+    char const *src = (char const*) lock.info.ptrDataRoi;
+    std::vector<std::pair<int,int>> covered;
+    for( int y=y0; y < y1; y++ ) {
+        // get the intervals of this row that are covered by subblocks drawn on top of this one
+        covered.clear();
+        for( size_t j : occluders[i] ) {
+            auto const &o = entries[j].rect;
+            if( y < o.y || y >= o.y + o.h ) continue;
+            int ox0 = std::max(o.x, x0), ox1 = std::min(o.x + o.w, x1);
+            if( ox0 < ox1 ) covered.push_back(std::make_pair(ox0, ox1));
+        }
+        std::sort(covered.begin(), covered.end());
+
+        // copy the uncovered parts of the row
+        char const *src_row = src + (std::size_t)(y - r.y)*lock.info.stride -
+            (std::ptrdiff_t) r.x*pixel_size_bytes;
+        auto copy = [&](int b, int e)
+        {
+            if( sink )
+                sink->write(y - rect.y, b - rect.x, e - b, src_row + (std::ptrdiff_t) b*pixel_size_bytes);
+            else
+                std::memcpy(out + ((std::ptrdiff_t)(y - rect.y)*rect.w + b - rect.x)*pixel_size_bytes,
+                    src_row + (std::ptrdiff_t) b*pixel_size_bytes, (std::size_t)(e - b)*pixel_size_bytes);
+        };
+        int x = x0;
+        for( auto const &c : covered ) {
+            if( c.first > x ) copy(x, c.first);
+            x = std::max(x, c.second);
+        }
+        if( x < x1 ) copy(x, x1);
+    }
+}
+
+Downsampler::Downsampler(int numpy_type, int channels, int size_x, int size_y, int ds, Reduce reduce, void *out,
+        PixelConversion const *conversion) :
+        numpy_type(numpy_type), channels(channels), size_x(size_x), size_y(size_y), ds(ds),
+        out_x(reduced_size(size_x, ds)), out_y(reduced_size(size_y, ds)), reduce(reduce), out((char*) out),
+        conversion(conversion), img((char*) out) {
+    if( ds < 1 ) throw std::invalid_argument("Downsampling factor must be positive");
+    if( numpy_type != NPY_UINT8 && numpy_type != NPY_UINT16 && numpy_type != NPY_FLOAT32 )
+        throw std::invalid_argument("Downsampling only supports uint8, uint16 and float32 images");
+    std::size_t n = (std::size_t) out_x*out_y;
+    int image_bytes = numpy_type == NPY_UINT8 ? 1 : (numpy_type == NPY_UINT16 ? 2 : 4);
+    if( reduce == Mean ) {
+        switch( sum_bytes(numpy_type, ds) ) {
+            case 2: sum16.assign(n*channels, 0); break;
+            case 4: sum32.assign(n*channels, 0); break;
+            default: sum.assign(n*channels, 0.);
+        }
+    } else if( reduce == Max ) {
+        // integer images are not negative, the zero initialized image already is the max with the zero padding.
+        if( conversion ) { state.assign(n*channels*image_bytes, 0); img = state.data(); }
+        if( numpy_type == NPY_FLOAT32 ) {
+            std::fill((float*) img, (float*) img + n*channels, -std::numeric_limits<float>::infinity());
+            count.assign(n, 0);
+        }
+    } else if( conversion ) {
+        // the strided pixels are converted when they are written, the others keep the converted zero.
+        conversion->fill_background(this->out, n);
+    }
+    if( conversion ) row.resize((std::size_t) out_x*channels*image_bytes);
+}
+
+int Downsampler::sum_bytes(int numpy_type, int ds) {
+    // float images are summed in double
+    if( numpy_type == NPY_FLOAT32 ) return 8;
+    double max = (double) ds*ds*(numpy_type == NPY_UINT8 ? 255 : 65535);
+    if( max <= std::numeric_limits<std::uint16_t>::max() ) return 2;
+    return max <= std::numeric_limits<std::uint32_t>::max() ? 4 : 8;
+}
+
+std::uint64_t Downsampler::state_bytes(int numpy_type, int channels, int size_x, int size_y, int ds,
+        Reduce reduce, bool convert) {
+    std::uint64_t pixels = (std::uint64_t) reduced_size(size_x, ds)*reduced_size(size_y, ds);
+    int image_bytes = numpy_type == NPY_UINT8 ? 1 : (numpy_type == NPY_UINT16 ? 2 : 4);
+    std::uint64_t bytes = 0;
+    if( reduce == Mean ) {
+        bytes += pixels*channels*sum_bytes(numpy_type, ds);
+    } else if( reduce == Max ) {
+        if( convert ) bytes += pixels*channels*image_bytes;
+        if( numpy_type == NPY_FLOAT32 ) bytes += pixels*sizeof(std::uint32_t);
+    }
+    return bytes;
+}
+
+bool Downsampler::parse_reduce(char const *name, Reduce &reduce) {
+    std::string s(name);
+    if( s == "mean" ) reduce = Mean;
+    else if( s == "max" ) reduce = Max;
+    else if( s == "stride" ) reduce = Stride;
+    else return false;
+    return true;
+}
+
+void Downsampler::write(int y, int x, int n, char const *src) {
+    if( y < 0 || y >= size_y || x < 0 || x + n > size_x )
+        throw std::out_of_range("Downsampler row outside of the image");
+    switch( numpy_type ) {
+        case NPY_UINT8: write_type<std::uint8_t>(y, x, n, (std::uint8_t const*) src); break;
+        case NPY_UINT16: write_type<std::uint16_t>(y, x, n, (std::uint16_t const*) src); break;
+        case NPY_FLOAT32: write_type<float>(y, x, n, (float const*) src); break;
+    }
+}
+
+template<typename T> void Downsampler::write_type(int y, int x, int n, T const *src) {
+    std::size_t row0 = (std::size_t)(y/ds)*out_x;
+    if( reduce == Stride ) {
+        int k0 = (ds - x % ds) % ds;
+        if( y % ds || k0 >= n ) return;
+        int o0 = (x + k0)/ds, m = (n - k0 + ds - 1)/ds;
+        T *dst = conversion ? (T*) row.data() : (T*) out + (row0 + o0)*channels;
+        for( int i=0; i < m; i++ )
+            for( int c=0; c < channels; c++ )
+                dst[(std::size_t) i*channels + c] = src[(std::size_t)(k0 + i*ds)*channels + c];
+        if( conversion ) conversion->convert(row.data(), out + (row0 + o0)*conversion->out_pixel_size_bytes, m);
+    } else if( reduce == Mean ) {
+        if( !sum16.empty() ) accumulate(sum16.data() + row0*channels, x, n, src);
+        else if( !sum32.empty() ) accumulate(sum32.data() + row0*channels, x, n, src);
+        else accumulate(sum.data() + row0*channels, x, n, src);
+    } else {
+        T *dst = (T*) img + row0*channels;
+        std::uint32_t *cnt = count.empty() ? nullptr : count.data() + row0;
+        for( int k=0; k < n; k++ ) {
+            int o = (x + k)/ds;
+            if( cnt ) cnt[o]++;
+            for( int c=0; c < channels; c++ ) {
+                T &d = dst[(std::size_t) o*channels + c];
+                d = std::max(d, src[(std::size_t) k*channels + c]);
+            }
+        }
+    }
+}
+
+template<typename T, typename A> void Downsampler::accumulate(A *dst, int x, int n, T const *src) {
+    for( int k=0; k < n; k++ )
+        for( int c=0; c < channels; c++ )
+            dst[(std::size_t)((x + k)/ds)*channels + c] += (A) src[(std::size_t) k*channels + c];
+}
+
+void Downsampler::finish() {
+    switch( numpy_type ) {
+        case NPY_UINT8: finish_type<std::uint8_t>(); break;
+        case NPY_UINT16: finish_type<std::uint16_t>(); break;
+        case NPY_FLOAT32: finish_type<float>(); break;
+    }
+}
+
+template<typename T> void Downsampler::finish_type() {
+    // strided pixels are already written (and converted)
+    if( reduce == Stride ) return;
+    std::size_t n = (std::size_t) out_x*channels;
+    std::uint32_t area = (std::uint32_t) std::min((std::uint64_t) ds*ds, (std::uint64_t) 0xffffffff);
+    for( int y=0; y < out_y; y++ ) {
+        std::size_t i = (std::size_t) y*n;
+        T *dst;
+        if( reduce == Mean ) {
+            dst = conversion ? (T*) row.data() : (T*) out + i;
+            if( !sum16.empty() ) mean_row(sum16.data() + i, dst);
+            else if( !sum32.empty() ) mean_row(sum32.data() + i, dst);
+            else mean_row(sum.data() + i, dst);
+        } else {
+            dst = (T*) img + i;
+            // float blocks that are not completely written (or padded) contain zeros
+            std::uint32_t const *cnt = count.empty() ? nullptr : count.data() + (std::size_t) y*out_x;
+            for( std::size_t k=0; k < n && cnt; k++ ) {
+                if( cnt[k/channels] < area ) dst[k] = std::max(dst[k], (T) 0);
+            }
+        }
+        // convert one reduced row at a time, the reduced image is never stored besides the output.
+        if( conversion )
+            conversion->convert((char const*) dst, out + (std::size_t) y*out_x*conversion->out_pixel_size_bytes,
+                out_x);
+    }
+}
+
+template<typename T, typename A> void Downsampler::mean_row(A const *sums, T *dst) {
+    // same as the float mean over the zero padded block truncated by astype, integer sums divide exactly.
+    A area = (A)((double) ds*ds);
+    for( std::size_t k=0; k < (std::size_t) out_x*channels; k++ ) dst[k] = (T)(sums[k]/area);
+}
+
+bool PixelConversion::parse(PyObject *dtype_obj, PyObject *window_obj, PyObject *lut_obj, int rgb) {
+    this->rgb = rgb != 0;
+    if( dtype_obj != Py_None ) {
+        PyArray_Descr *descr = NULL;
+        if( !PyArray_DescrConverter2(dtype_obj, &descr) ) return false;
+        requested_type = descr->type_num;
+        Py_DECREF(descr);
+        if( requested_type != NPY_UINT8 && requested_type != NPY_UINT16 && requested_type != NPY_FLOAT32 ) {
+            PyErr_SetString(PylibcziError, "Output dtype must be uint8, uint16 or float32");
+            return false;
+        }
+    }
+    if( window_obj != Py_None ) {
+        if( !PyArg_ParseTuple(window_obj, "dd", &lo, &hi) ) return false;
+        window = true;
+    }
+    if( lut_obj != Py_None ) {
+        if( window ) {
+            PyErr_SetString(PylibcziError, "Use either a window or a lookup table");
+            return false;
+        }
+        PyArrayObject *lut_arr = (PyArrayObject*) PyArray_FROMANY(lut_obj, NPY_NOTYPE, 1, 1, NPY_ARRAY_IN_ARRAY);
+        if( lut_arr == NULL ) return false;
+        lut_type = PyArray_TYPE(lut_arr);
+        PyArrayObject *lut_dbl = (PyArrayObject*) PyArray_FROMANY((PyObject*) lut_arr, NPY_FLOAT64, 1, 1,
+            NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+        Py_DECREF(lut_arr);
+        if( lut_dbl == NULL ) return false;
+        double const *p = (double const*) PyArray_DATA(lut_dbl);
+        lut.assign(p, p + PyArray_SIZE(lut_dbl));
+        Py_DECREF(lut_dbl);
+        if( lut.empty() ) {
+            PyErr_SetString(PylibcziError, "Lookup table must not be empty");
+            return false;
+        }
+    }
+    return true;
+}
+
+void PixelConversion::setup(int numpy_type, int channels) {
+    this->numpy_type = numpy_type; this->channels = channels;
+    out_type = requested_type != NPY_NOTYPE ? requested_type : (!lut.empty() ? lut_type : numpy_type);
+    switch( out_type ) {
+        case NPY_UINT8: out_pixel_size_bytes = 1*channels; break;
+        case NPY_UINT16: out_pixel_size_bytes = 2*channels; break;
+        case NPY_FLOAT32: out_pixel_size_bytes = 4*channels; break;
+        default: throw std::invalid_argument("Output dtype must be uint8, uint16 or float32");
+    }
+    if( numpy_type == NPY_FLOAT32 ) {
+        if( !lut.empty() ) throw std::invalid_argument("Lookup tables are only supported for integer images");
+        return;
+    }
+    switch( out_type ) {
+        case NPY_UINT8: fill_table<std::uint8_t>(); break;
+        case NPY_UINT16: fill_table<std::uint16_t>(); break;
+        case NPY_FLOAT32: fill_table<float>(); break;
+    }
+}
+
+double PixelConversion::map(double v, bool use_window) const {
+    // the window maps lo..hi to the full range of integer output types, or to 0..1 for float output.
+    if( !use_window ) return v;
+    double f = hi > lo ? (v - lo)/(hi - lo) : (v >= hi ? 1. : 0.);
+    f = std::min(std::max(f, 0.), 1.);
+    switch( out_type ) {
+        case NPY_UINT8: return f*std::numeric_limits<std::uint8_t>::max();
+        case NPY_UINT16: return f*std::numeric_limits<std::uint16_t>::max();
+        default: return f;
+    }
+}
+
+template<typename U> U PixelConversion::saturate(double v) {
+    // integer outputs are rounded and clipped to the range of the type
+    if( !std::numeric_limits<U>::is_integer ) return (U) v;
+    return (U) std::floor(std::min(std::max(v, 0.), (double) std::numeric_limits<U>::max()) + 0.5);
+}
+
+template<typename U> void PixelConversion::fill_table() {
+    std::size_t size = numpy_type == NPY_UINT8 ? 256 : 65536;
+    table.resize(size*sizeof(U));
+    U *t = (U*) table.data();
+    for( std::size_t v=0; v < size; v++ )
+        t[v] = saturate<U>(!lut.empty() ? lut[std::min(v, lut.size() - 1)] : map((double) v, window));
+}
+
+template<typename T, typename U> void PixelConversion::convert_row(T const *src, U *dst, std::size_t n) const {
+    U const *t = (U const*) table.data();
+    if( rgb && channels > 1 ) {
+        for( std::size_t k=0; k < n; k++, src += channels, dst += channels )
+            for( int c=0; c < channels; c++ ) dst[channels - 1 - c] = t[src[c]];
+    } else {
+        for( std::size_t k=0; k < n*channels; k++ ) dst[k] = t[src[k]];
+    }
+}
+
+template<typename U> void PixelConversion::convert_row(float const *src, U *dst, std::size_t n) const {
+    for( std::size_t k=0; k < n; k++, src += channels, dst += channels )
+        for( int c=0; c < channels; c++ ) dst[rgb ? channels - 1 - c : c] = saturate<U>(map(src[c], window));
+}
+
+void PixelConversion::convert(char const *src, char *dst, std::size_t n) const {
+    switch( numpy_type ) {
+        case NPY_UINT8: convert_from((std::uint8_t const*) src, dst, n); break;
+        case NPY_UINT16: convert_from((std::uint16_t const*) src, dst, n); break;
+        case NPY_FLOAT32: convert_from((float const*) src, dst, n); break;
+    }
+}
+
+template<typename T> void PixelConversion::convert_from(T const *src, char *dst, std::size_t n) const {
+    switch( out_type ) {
+        case NPY_UINT8: convert_row(src, (std::uint8_t*) dst, n); break;
+        case NPY_UINT16: convert_row(src, (std::uint16_t*) dst, n); break;
+        case NPY_FLOAT32: convert_row(src, (float*) dst, n); break;
+    }
+}
+
+void PixelConversion::fill_background(char *dst, std::size_t n) const {
+    if( n == 0 ) return;
+    std::vector<char> zero(channels*sizeof(float), 0);
+    convert(zero.data(), dst, 1);
+    for( std::size_t i=1; i < n; i++ )
+        std::memcpy(dst + i*out_pixel_size_bytes, dst, out_pixel_size_bytes);
+}
+
+StatsSink::Accumulator::Accumulator(int channels, std::size_t nbins) : count(channels, 0),
+        hist(channels*nbins, 0), mean(channels, 0.), m2(channels, 0.),
+        min(channels, std::numeric_limits<double>::infinity()),
+        max(channels, -std::numeric_limits<double>::infinity()) {}
+
+void StatsSink::Accumulator::add(Accumulator const &other) {
+    for( size_t c=0; c < count.size(); c++ ) {
+        merge((int) c, other.count[c], other.mean[c], other.m2[c]);
+        min[c] = std::min(min[c], other.min[c]); max[c] = std::max(max[c], other.max[c]);
+    }
+    for( size_t i=0; i < hist.size(); i++ ) hist[i] += other.hist[i];
+}
+
+void StatsSink::Accumulator::merge(int c, std::uint64_t n, double mean, double m2) {
+    if( n == 0 ) return;
+    double na = (double) count[c], nb = (double) n, delta = mean - this->mean[c];
+    count[c] += n;
+    this->mean[c] += delta*nb/(na + nb);
+    this->m2[c] += m2 + delta*delta*na*nb/(na + nb);
+}
+
+StatsSink::StatsSink(int numpy_type, int channels, int step, std::size_t nbins, double lo, double hi) :
+        numpy_type(numpy_type), channels(channels), step(std::max(step, 1)), nbins(nbins), lo(lo), hi(hi) {
+    if( numpy_type == NPY_UINT8 ) this->nbins = 256;
+    else if( numpy_type == NPY_UINT16 ) this->nbins = 65536;
+    else if( numpy_type != NPY_FLOAT32 )
+        throw std::invalid_argument("Statistics only support uint8, uint16 and float32 images");
+}
+
+StatsSink::Accumulator &StatsSink::accumulator() {
+    // one accumulator per thread, so the histograms are updated without locking.
+    std::lock_guard<std::mutex> lock(mutex);
+    auto &acc = accumulators[std::this_thread::get_id()];
+    if( !acc ) acc.reset(new Accumulator(channels, nbins));
+    return *acc;
+}
+
+void StatsSink::write(int y, int x, int n, char const *src) {
+    if( y % step ) return;
+    Accumulator &acc = accumulator();
+    switch( numpy_type ) {
+        case NPY_UINT8: write_type(acc, x, n, (std::uint8_t const*) src); break;
+        case NPY_UINT16: write_type(acc, x, n, (std::uint16_t const*) src); break;
+        case NPY_FLOAT32: write_type(acc, x, n, (float const*) src); break;
+    }
+}
+
+template<typename T> void StatsSink::write_type(Accumulator &acc, int x, int n, T const *src) {
+    bool integer = std::numeric_limits<T>::is_integer;
+    double scale = hi > lo ? nbins/(hi - lo) : 0.;
+    for( int c=0; c < channels; c++ ) {
+        // the mean of the row first, then the squared deviations from it in a second pass over the row.
+        double sum = 0., m2 = 0., min = acc.min[c], max = acc.max[c];
+        std::uint64_t count = 0;
+        std::uint64_t *hist = acc.hist.data() + c*nbins;
+        for( int k = (step - x % step) % step; k < n; k += step ) {
+            T v = src[(std::size_t) k*channels + c];
+            if( v != v ) continue; // NaN
+            double d = (double) v;
+            sum += d; count++;
+            min = std::min(min, d); max = std::max(max, d);
+            if( integer ) {
+                hist[(std::size_t) v]++;
+            } else if( nbins > 0 ) {
+                double b = std::floor((d - lo)*scale);
+                hist[(std::size_t) std::min(std::max(b, 0.), (double) (nbins - 1))]++;
+            }
+        }
+        if( count == 0 ) continue;
+        double mean = sum/count;
+        for( int k = (step - x % step) % step; k < n; k += step ) {
+            T v = src[(std::size_t) k*channels + c];
+            if( v == v ) m2 += ((double) v - mean)*((double) v - mean);
+        }
+        acc.merge(c, count, mean, m2);
+        acc.min[c] = min; acc.max[c] = max;
+    }
+}
+
+StatsSink::Accumulator StatsSink::result() const {
+    Accumulator total(channels, nbins);
+    for( auto const &acc : accumulators ) total.add(*acc.second);
+    return total;
+}
+
+PyArrayObject* new_image_array(libCZI::PixelType pixel_type, int size_x, int size_y, int &pixel_size_bytes) {
+    // allocate zeroed C-order image, (size_y, size_x) for gray or (size_y, size_x, channels) for color images.
+    int numpy_type, channels;
+    if( !get_pixel_type_info(pixel_type, numpy_type, pixel_size_bytes, channels) ) return NULL;
+    return new_array(numpy_type, channels, size_x, size_y);
+}
+
+PyArrayObject* new_array(int numpy_type, int channels, int size_x, int size_y) {
+    npy_intp shp[3]; shp[0] = size_y; shp[1] = size_x; shp[2] = channels;
+    return (PyArrayObject *) PyArray_ZEROS(channels == 1 ? 2 : 3, shp, numpy_type, 0);
+}
+
+int point_in_polygon(std::vector<std::pair<double,double>> const &points, double x, double y) {
+    // position of the point relative to the polygon, computed exactly as skimage point_in_polygon does (O'Rourke,
+    //   crossings of the rays to the right and to the left): 0 outside, 1 inside, 2 vertex, 3 edge.
+    double const eps = 1e-12;
+    unsigned int l_cross = 0, r_cross = 0;
+    double x1 = points.back().first - x, y1 = points.back().second - y;
+    for( auto const &pt : points ) {
+        double x0 = pt.first - x, y0 = pt.second - y;
+        if( -eps < x0 && x0 < eps && -eps < y0 && y0 < eps ) return 2;
+        if( (y0 > 0) != (y1 > 0) && (x0*y1 - x1*y0)/(y1 - y0) > 0 ) r_cross++;
+        if( (y0 < 0) != (y1 < 0) && (x0*y1 - x1*y0)/(y1 - y0) < 0 ) l_cross++;
+        x1 = x0; y1 = y0;
+    }
+    if( (r_cross & 1) != (l_cross & 1) ) return 3;
+    return r_cross & 1;
+}
+
+libCZI::IntRect rasterize_polygon(std::vector<std::pair<double,double>> const &points,
+        std::vector<std::vector<std::pair<int,int>>> &spans) {
+    // pixels are inside of the polygon if their center (at integer coordinates) is inside (even-odd rule) or on
+    //   its boundary, same as skimage.draw.polygon (without its clipping to non-negative coordinates). the
+    //   interior of each row comes from the crossings of the edges, the pixels next to the crossings, vertices
+    //   and horizontal edges are decided with the skimage test. returns the tight bounding box of the polygon
+    //   pixels, spans contains the sorted, non-overlapping [begin, end) x-intervals for each row of the box.
+    double const tol = 1e-6;
+    double min_x = std::numeric_limits<double>::max(), min_y = min_x;
+    double max_x = -std::numeric_limits<double>::max(), max_y = max_x;
+    for( auto const &pt : points ) {
+        min_x = std::min(min_x, pt.first); max_x = std::max(max_x, pt.first);
+        min_y = std::min(min_y, pt.second); max_y = std::max(max_y, pt.second);
+    }
+    int y0 = (int) std::ceil(min_y - tol), y1 = (int) std::floor(max_y + tol) + 1;
+
+    std::vector<std::vector<std::pair<int,int>>> rows(std::max(0, y1 - y0));
+    std::vector<double> xs;
+    std::vector<int> candidates;
+    std::vector<std::pair<int,int>> inside;
+    size_t n = points.size();
+    for( int y=y0; y < y1; y++ ) {
+        xs.clear(); candidates.clear(); inside.clear();
+        for( size_t i=0; i < n; i++ ) {
+            auto const &a = points[i], &b = points[(i + 1) % n];
+            if( (a.second <= y && y < b.second) || (b.second <= y && y < a.second) )
+                xs.push_back(a.first + (y - a.second)*(b.first - a.first)/(b.second - a.second));
+            // pixels close to the edge, where rounding decides
+            if( y < std::min(a.second, b.second) - tol || y > std::max(a.second, b.second) + tol ) continue;
+            double lo = std::min(a.first, b.first), hi = std::max(a.first, b.first);
+            if( std::abs(b.second - a.second) > tol ) {
+                double x = a.first + (y - a.second)*(b.first - a.first)/(b.second - a.second);
+                lo = hi = std::min(std::max(x, lo), hi);
+            }
+            for( int x=(int) std::floor(lo) - 1; x <= (int) std::ceil(hi) + 1; x++ ) candidates.push_back(x);
+        }
+        std::sort(xs.begin(), xs.end());
+        for( size_t k=0; k+1 < xs.size(); k+=2 ) {
+            int x0 = (int) std::ceil(xs[k]), x1 = (int) std::ceil(xs[k+1]);
+            if( x0 < x1 ) inside.push_back(std::make_pair(x0, x1));
+        }
+        std::sort(candidates.begin(), candidates.end());
+        candidates.erase(std::unique(candidates.begin(), candidates.end()), candidates.end());
+        // the candidates replace the interior pixels at their positions, then overlapping spans are merged
+        std::vector<std::pair<int,int>> pieces;
+        auto c = candidates.begin();
+        for( auto const &span : inside ) {
+            int x = span.first;
+            c = std::lower_bound(c, candidates.end(), x);
+            for( ; c != candidates.end() && *c < span.second; c++ ) {
+                if( x < *c ) pieces.push_back(std::make_pair(x, *c));
+                x = *c + 1;
+            }
+            if( x < span.second ) pieces.push_back(std::make_pair(x, span.second));
+        }
+        for( int x : candidates ) {
+            if( point_in_polygon(points, x, y) ) pieces.push_back(std::make_pair(x, x + 1));
+        }
+        std::sort(pieces.begin(), pieces.end());
+        auto &row_spans = rows[y - y0];
+        for( auto const &piece : pieces ) {
+            if( !row_spans.empty() && piece.first <= row_spans.back().second )
+                row_spans.back().second = std::max(row_spans.back().second, piece.second);
+            else
+                row_spans.push_back(piece);
+        }
+    }
+
+    // tight bounding box of the pixels
+    int first = 0, last = (int) rows.size() - 1;
+    while( first <= last && rows[first].empty() ) first++;
+    while( last >= first && rows[last].empty() ) last--;
+    if( first > last ) {
+        spans.clear();
+        return libCZI::IntRect{ (int) std::ceil(min_x), (int) std::ceil(min_y), 0, 0 };
+    }
+    int x0 = std::numeric_limits<int>::max(), x1 = std::numeric_limits<int>::min();
+    for( int row=first; row <= last; row++ ) {
+        if( rows[row].empty() ) continue;
+        x0 = std::min(x0, rows[row].front().first); x1 = std::max(x1, rows[row].back().second);
+    }
+    spans.assign(rows.begin() + first, rows.begin() + last + 1);
+    return libCZI::IntRect{ x0, y0 + first, x1 - x0, last - first + 1 };
 }
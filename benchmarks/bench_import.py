@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# This file is part of pylibczi.
+# Copyright (c) 2018 Center of Advanced European Studies and Research (caesar)
+#
+# pylibczi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pylibczi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
+
+# Benchmark the start-up cost of importing pylibczi, as paid by every worker process and command line call.
+#   Each statement runs in a fresh interpreter. With --check the script exits with an error if the fast-start
+#   statements import any of the heavy packages or take more than --max-overhead longer than importing numpy,
+#   so it can be used as a regression check (e.g. on travis).
+
+import numpy as np
+import argparse
+import json
+import subprocess
+import sys
+
+# packages that must not be needed for reading pixels
+heavy = ['scipy', 'lxml', 'matplotlib', 'skimage', 'tifffile', 'czifile', 'sqlite3']
+
+def run_statement(statement, nrepeats):
+    # wall time of the statement in a new interpreter (without the interpreter start) and the heavy packages imported
+    code = '\n'.join(['import sys, time, json', 't = time.time()', statement, 't = time.time() - t',
+        'print(json.dumps([t, [x for x in %r if x in sys.modules]]))' % (heavy,)])
+    times = np.zeros((nrepeats,), dtype=np.double)
+    for i in range(nrepeats):
+        out = subprocess.check_output([sys.executable, '-c', code]).decode('utf-8').strip().split('\n')[-1]
+        times[i], loaded = json.loads(out)
+    return times, loaded
+
+parser = argparse.ArgumentParser(description='Time importing pylibczi in fresh interpreters')
+parser.add_argument('--czi-file', type=str, default='', help='also time reading all subblocks of this czi file')
+parser.add_argument('--nrepeats', type=int, default=5, help='number of interpreters to start for each statement')
+parser.add_argument('--check', action='store_true', help='exit with an error if the fast-start path regressed')
+parser.add_argument('--max-overhead', type=float, default=0.1,
+    help='largest time in seconds the fast-start statements may take in addition to importing numpy')
+args = parser.parse_args()
+
+# (statement, whether it is on the fast-start path)
+statements = [('import numpy', False), ('import _pylibczi', True), ('import pylibczi', True),
+              ('from pylibczi import CziFile', True), ('from pylibczi import CziScene', True),
+              ('from pylibczi import CziCatalog', False)]
+if args.czi_file:
+    statements.append(('from pylibczi import CziFile; CziFile(%r).read_image()' % (args.czi_file,), True))
+
+baseline = None; failed = []
+for statement, fast in statements:
+    times, loaded = run_statement(statement, args.nrepeats)
+    # compare the fastest runs, the medians are noisy on busy machines
+    if baseline is None: baseline = times.min()
+    print('%-48s min %.4f s, median %.4f s%s' % (statement[:48], times.min(), np.median(times),
+        (', imports ' + ' '.join(loaded)) if loaded else ''))
+    if fast and loaded:
+        failed.append('%s imports %s' % (statement, ' '.join(loaded)))
+    if fast and times.min() - baseline > args.max_overhead:
+        failed.append('%s takes %.4f s longer than importing numpy' % (statement, times.min() - baseline))
+
+if args.check:
+    for x in failed: print('FAILED: ' + x)
+    sys.exit(1 if failed else 0)
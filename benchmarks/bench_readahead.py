@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# This file is part of pylibczi.
+# Copyright (c) 2018 Center of Advanced European Studies and Research (caesar)
+#
+# pylibczi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pylibczi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
+
+# Benchmark reading czi files in file order with and without sequential readahead, against the libCZI tile accessor
+#   that reads the subblocks in directory order (sorted by M-index).
+#   The effect is largest on spinning disks with a cold page cache, use --drop-caches (needs root, linux only)
+#   to flush the page cache before each run, otherwise the second and later runs read from memory.
+
+import numpy as np
+import argparse
+import subprocess
+import time
+
+from lxml import etree as etree
+
+import _pylibczi
+
+def drop_caches():
+    subprocess.check_call(['sync'])
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3\n')
+
+def get_nscenes(czi_filename):
+    root = etree.fromstring(_pylibczi.cziread_meta(czi_filename))
+    sizes = root.xpath('/ImageDocument/Metadata/Information/Image/SizeS')
+    return int(sizes[0].text) if len(sizes) > 0 else 1
+
+def run(label, func, args):
+    times = np.zeros((args.nrepeats,), dtype=np.double)
+    for i in range(args.nrepeats):
+        if args.drop_caches: drop_caches()
+        t = time.time(); func(); times[i] = time.time() - t
+    print('\t%-44s min %.4f s, median %.4f s' % (label, times.min(), np.median(times)))
+
+parser = argparse.ArgumentParser(description='Time czi reads in file order with and without readahead')
+parser.add_argument('czi_files', nargs='+', type=str, help='czi files to read')
+parser.add_argument('--readahead', nargs='+', type=int, default=[0, 1<<24, 1<<26],
+    help='readahead sizes in bytes to compare, 0 reads each subblock separately')
+parser.add_argument('--max-gap', type=int, default=1<<20,
+    help='largest gap in bytes between subblocks that is still read over')
+parser.add_argument('--nrepeats', type=int, default=3, help='number of times to repeat each read')
+parser.add_argument('--drop-caches', action='store_true', help='flush the page cache before each read')
+parser.add_argument('--no-scenes', action='store_true', help='only time reading all subblocks')
+parser.add_argument('--order', nargs='+', type=str, default=['file', 'directory'], choices=['file', 'directory'],
+    help='subblock orders to compare for the scenes, directory is the libCZI tile accessor (without readahead)')
+args = parser.parse_args()
+
+def read_scenes(fn, nscenes, readahead, order):
+    # all scenes one after another, the way a multi-scene file is usually processed
+    with _pylibczi.CziReader(fn) as reader:
+        for scene in range(nscenes):
+            _pylibczi.cziread_scene(reader, np.array([scene], dtype=np.int64), readahead=readahead,
+                max_gap=args.max_gap, order=order)
+
+for fn in args.czi_files:
+    nscenes = get_nscenes(fn)
+    print('%s, %d scenes' % (fn, nscenes))
+    if not args.no_scenes and 'directory' in args.order:
+        run('each scene, directory order', lambda: read_scenes(fn, nscenes, 0, 'directory'), args)
+    for readahead in args.readahead:
+        run('all subblocks, readahead %d' % (readahead,),
+            lambda: _pylibczi.cziread_allsubblocks(fn, zero_copy=True, readahead=readahead, max_gap=args.max_gap), args)
+        if args.no_scenes or 'file' not in args.order: continue
+        run('each scene, file order, readahead %d' % (readahead,), lambda: read_scenes(fn, nscenes, readahead, 'file'),
+            args)
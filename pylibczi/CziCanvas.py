@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+
+# This file is part of pylibczi.
+# Copyright (c) 2018 Center of Advanced European Studies and Research (caesar)
+#
+# pylibczi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pylibczi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
+
+# Virtual canvas of the scenes of many czi files placed by their stage positions, regions are read on demand.
+
+import numpy as np
+import concurrent.futures
+import os
+import time
+
+# xxx - some better way to handle import if running from command line?
+try:
+    from .CziFile import CziFile
+    from .CziScene import CziScene
+except ImportError as exc:
+    from CziFile import CziFile
+    from CziScene import CziScene
+
+class CziCanvas(object):
+    """Virtual canvas of czi scenes placed by their stage positions, for reading regions across file boundaries.
+
+    Each scene (bounding box as read by CziScene.read_scene_image) is placed at its stage position divided by the
+    pixel size, so canvas coordinates are stage coordinates in pixels and all scenes must have the same pixel size.
+    The full resolution subblocks of all scenes are kept in one spatial index in canvas coordinates. A region read
+    only reads the files (in parallel, decoding does not hold the GIL) and subblocks that intersect the region, the
+    scenes are never composed in memory. Where scenes overlap, the later scene in sources is on top.
+
+    Args:
+      |  sources (list): Czi filenames (or any source accepted by CziFile) to place all scenes of, or (source, scene)
+      |      tuples with scene starting at 1 as for CziScene.
+
+    Kwargs:
+      |  channel (int): Plane (C index) to read.
+      |  threads (int): Number of files read in parallel, 0 to use all cpus.
+      |  readahead (int): Maximum size in bytes of a single sequential read, see CziFile.
+      |  progress (_pylibczi.ReadProgress): Passed to all reads, to follow or cancel them, see CziFile.
+      |  catalog (CziCatalog): Take the scene placements from the catalog instead of parsing the meta data of every
+      |      file, the files must be in the catalog.
+      |  verbose (bool): Print information and times.
+
+    .. note::
+
+       Only the meta data and subblock directories are read when the canvas is created.
+
+    """
+
+    # relative difference of the pixel sizes of the scenes that is still considered the same
+    scale_tolerance = 1e-3
+
+    # maximum size in full resolution pixels of the tiles in which downsampled pixels at scene seams are composed
+    seam_tile_size = 1024
+
+    def __init__(self, sources, channel=0, threads=0, readahead=0, progress=None, catalog=None, verbose=False):
+        import _pylibczi
+        self.czilib = _pylibczi
+        self.channel = channel
+        self.readahead = readahead
+        self.progress = progress
+        self.canvas_verbose = verbose
+
+        if verbose:
+            print('Placing %d czi sources on canvas' % (len(sources),)); t = time.time()
+
+        # one reader per file, also if several of its scenes are placed. the readers stay open for all reads.
+        self.files = []; keys = {}; wanted = []
+        for x in sources:
+            source, scene = x if isinstance(x, tuple) else (x, None)
+            key = source.source if isinstance(source, self.czilib.CziReader) else source
+            key = os.path.abspath(key) if isinstance(key, str) else id(key)
+            if key not in keys:
+                keys[key] = len(self.files)
+                reader = source if isinstance(source, self.czilib.CziReader) else self.czilib.CziReader(source, lazy=True)
+                self.files.append({'source':source, 'reader':reader})
+                wanted.append([])
+            wanted[keys[key]].append(scene)
+
+        if threads <= 0: threads = os.cpu_count() or 1
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        placed = list(self.executor.map(lambda i: self._place_file(i, wanted[i], catalog), range(len(self.files))))
+
+        # placements in the order of the sources, all scenes of a file in scene order.
+        self.placements = []; subblocks = []; pixel_types = set()
+        for x in sources:
+            source, scene = x if isinstance(x, tuple) else (x, None)
+            file = self._file_of(source, keys)
+            for p in placed[file]:
+                if scene is not None and p['scene'] != scene: continue
+                if any(q['file'] == file and q['scene'] == p['scene'] for q in self.placements): continue
+                index = p.pop('index')
+                index = index[(index.x < p['box'][0] + p['box'][2]) & (index.x + index.w > p['box'][0]) &
+                              (index.y < p['box'][1] + p['box'][3]) & (index.y + index.h > p['box'][1])]
+                subblocks.append((len(self.placements), index))
+                pixel_types.update(int(x) for x in np.unique(index.pixel_type))
+                self.placements.append(p)
+        assert( len(self.placements) > 0 ) # no scenes placed
+
+        # all scenes must have the same pixel size, otherwise they would need resampling.
+        scales = np.array([p['scale'] for p in self.placements])
+        self.scale = scales[0]
+        assert( (np.abs(scales - self.scale) <= self.scale_tolerance*self.scale).all() ) # different pixel sizes
+        assert( len(pixel_types) <= 1 ) # different pixel types
+        pixel_type = pixel_types.pop() if pixel_types else 0
+        assert( pixel_type in CziFile.pixel_types ) # unknown image type in czi file
+        self.dtype, self.nchan = CziFile.pixel_types[pixel_type]
+
+        # canvas bounding box of all the scenes
+        corners = np.array([p['box'][:2] + p['offset'] for p in self.placements])
+        ends = np.array([p['box'][:2] + p['box'][2:] + p['offset'] for p in self.placements])
+        self.box = np.concatenate((corners.min(0), ends.max(0) - corners.min(0))).astype(np.int64)
+
+        self._build_index(subblocks)
+
+        if verbose:
+            print('\t%d scenes from %d files, %d subblocks' % (len(self.placements), len(self.files),
+                self.subblocks.size))
+            print('\tcanvas box %d %d %d %d' % tuple(self.box))
+            print('\tdone in %.4f s' % (time.time() - t, ))
+
+    def _file_of(self, source, keys):
+        key = source.source if isinstance(source, self.czilib.CziReader) else source
+        return keys[os.path.abspath(key) if isinstance(key, str) else id(key)]
+
+    def _place_file(self, file, scenes, catalog):
+        # placements of the wanted scenes of one file (all scenes if any scene is None) with their subblock index.
+        info = self.files[file]
+        reader = info['reader']
+        index = CziFile(reader).read_subblock_index()
+        # the full resolution subblocks of the plane, the same that cziread_scene composes.
+        index = index[(index.w == index.stored_w) & (index.h == index.stored_h) &
+                      (np.maximum(index.C, 0) == self.channel)]
+        all_scenes = any(x is None for x in scenes)
+
+        rows = []
+        if catalog is not None:
+            assert( isinstance(info['source'], str) ) # catalog only for files
+            rows = catalog.query('SELECT s.scene, s.x, s.y, s.w, s.h, s.stage_x, s.stage_y, f.scale_x, f.scale_y, ' +
+                'f.nscenes FROM scenes s JOIN files f ON f.file_id = s.file_id WHERE f.filename = ? ORDER BY s.scene',
+                (os.path.abspath(info['source']),))
+            assert( len(rows) > 0 ) # file not in catalog
+        else:
+            scene = CziScene(reader, scene=1 if all_scenes else min(scenes), ribbon=0)
+            scene.read_scene_meta()
+            for s in range(scene.nscenes):
+                if not all_scenes and s+1 not in scenes: continue
+                if s != scene.scene:
+                    scene = CziScene(reader, scene=s+1, ribbon=0)
+                    scene.read_scene_meta()
+                box = scene._scene_box()
+                rows.append((s+1,) + tuple(box) + tuple(scene.scene_stage_corner) + tuple(scene.scale) +
+                    (scene.nscenes,))
+
+        placements = []
+        for row in rows:
+            s, box, stage_corner, scale, nscenes = row[0], np.array(row[1:5], dtype=np.int64), \
+                np.array(row[5:7], dtype=np.double), np.array(row[7:9], dtype=np.double), row[9]
+            if not all_scenes and s not in scenes: continue
+            # single scene files do not need an S index on the subblocks.
+            sindex = index if nscenes == 1 else index[np.maximum(index.S, 0) == s-1]
+            offset = np.round(stage_corner / scale).astype(np.int64) - box[:2]
+            placements.append({'file':file, 'scene':s, 'box':box, 'offset':offset, 'scale':scale, 'index':sindex})
+        return placements
+
+    def _build_index(self, subblocks):
+        # subblocks of all the scenes in canvas coordinates, sorted by x to find the ones in a region with bisection.
+        n = sum(x[1].size for x in subblocks)
+        names = ['x', 'y', 'w', 'h', 'placement', 'index']
+        arrays = [np.zeros((n,), dtype=np.int64) for x in names]
+        i = 0
+        for p, index in subblocks:
+            offset = self.placements[p]['offset']; j = i + index.size
+            arrays[0][i:j] = index.x + offset[0]; arrays[1][i:j] = index.y + offset[1]
+            arrays[2][i:j] = index.w; arrays[3][i:j] = index.h
+            arrays[4][i:j] = p; arrays[5][i:j] = index.index
+            i = j
+        order = np.argsort(arrays[0], kind='stable')
+        self.subblocks = np.rec.fromarrays([x[order] for x in arrays], names=names)
+        self.max_subblock_w = int(self.subblocks.w.max()) if n > 0 else 0
+
+    def query(self, box):
+        """Find the subblocks that intersect a region of the canvas, without reading anything.
+
+        Args:
+          |  box (4 array): Region (x, y, w, h) in canvas pixels.
+
+        Returns:
+          |  (recarray):  The subblocks in the region with x, y, w, h (canvas pixels), placement (index into
+          |      placements) and index (libCZI subblock index in the file of the placement).
+
+        """
+        box = np.asarray(box, dtype=np.int64).reshape(4)
+        beg = np.searchsorted(self.subblocks.x, box[0] - self.max_subblock_w, side='right')
+        end = np.searchsorted(self.subblocks.x, box[0] + box[2], side='left')
+        x = self.subblocks[beg:end]
+        return x[(x.x + x.w > box[0]) & (x.y < box[1] + box[3]) & (x.y + x.h > box[1])]
+
+    def stage_box(self, stage_box):
+        """Convert a region in stage coordinates (as in the meta data and CziCatalog) to canvas pixels.
+
+        Args:
+          |  stage_box (4 array): Region (x, y, w, h) in stage coordinates.
+
+        Returns:
+          |  (4 ndarray):  The region (x, y, w, h) in canvas pixels that covers the stage region.
+
+        """
+        stage_box = np.asarray(stage_box, dtype=np.double).reshape(4)
+        beg = np.floor(stage_box[:2] / self.scale); end = np.ceil((stage_box[:2] + stage_box[2:]) / self.scale)
+        return np.concatenate((beg, end - beg)).astype(np.int64)
+
+    def read(self, box=None, ds=1, reduce=np.mean, dtype=None, window=None, lut=None, rgb=False, max_bytes=None):
+        """Read a region of the canvas, composed from the scenes that intersect it.
+
+        Kwargs:
+          |  box (4 array): Region (x, y, w, h) in canvas pixels, defaults to the whole canvas.
+          |  ds (int): Downsampling reduce factor, the scenes are downsampled while they are read. Downsampled pixels
+          |      that mix several scenes are composed at full resolution, the result is the same as downsample_image
+          |      of the full resolution read.
+          |  reduce (func or str): np.mean, np.max or 'stride', see CziScene.read_scene_image_ds.
+          |  dtype (numpy dtype): Output data type (uint8, uint16 or float32), defaults to the image data type.
+          |  window (tuple): Intensity window (lo, hi) that is mapped to the output range, see CziFile.convert_image.
+          |  lut (1d ndarray): Lookup table from image values to output values.
+          |  rgb (bool): Reverse the channels of color images (BGR to RGB).
+          |  max_bytes (int): Raise MemoryError before reading if the image, the images of the scenes and the buffers
+          |      of their downsampled reads would be larger than this.
+
+        Returns:
+          |  (m/ds,n/ds,nchan ndarray):  The region, zero where no scene has subblocks.
+
+        """
+        box = self.box if box is None else np.asarray(box, dtype=np.int64).reshape(4)
+        assert( ds >= 1 and (box[2:] >= 0).all() ) # bad downsampling or box
+        assert( CziFile.native_reduce.get(reduce) is not None ) # reduce not supported natively
+        shape = (-(-int(box[3]) // ds), -(-int(box[2]) // ds)) + ((self.nchan,) if self.nchan > 1 else ())
+        out_dtype = np.dtype(self.dtype if dtype is None else dtype)
+
+        if self.canvas_verbose:
+            print('Loading canvas box %d %d %d %d downsampled by %d' % (tuple(box) + (ds,))); t = time.time()
+
+        subblocks = self.query(box)
+        # the region of each scene covered by its subblocks, aligned to the pixels of the downsampled output.
+        reads = []
+        for p in np.unique(subblocks.placement):
+            x = subblocks[subblocks.placement == p]
+            beg = np.maximum(box[:2], [x.x.min(), x.y.min()])
+            end = np.minimum(box[:2] + box[2:], [(x.x + x.w).max(), (x.y + x.h).max()])
+            beg = box[:2] + (beg - box[:2]) // ds * ds
+            end = np.minimum(box[:2] + box[2:], box[:2] + -(-(end - box[:2]) // ds) * ds)
+            reads.append((int(p), x, beg, end))
+        # all scenes may be read at the same time and are kept until they are pasted.
+        nbytes = int(np.prod(shape))*out_dtype.itemsize
+        convert = any(x is not None for x in [dtype, window, lut]) or rgb
+        for _, _, beg, end in reads:
+            scene_shape = tuple(-(-(end - beg)[::-1] // ds)) + shape[2:]
+            nbytes += int(np.prod(scene_shape))*out_dtype.itemsize + \
+                CziFile._reduce_bytes(scene_shape, self.dtype, ds, reduce, convert)
+        # downsampled pixels at the seams of overlapping scenes are composed at full resolution (see _compose_seams),
+        #   this needs the scene that covers each pixel and one seam tile.
+        seams = ds > 1 and len(reads) > 1
+        if seams:
+            n = max(1, self.seam_tile_size // ds)
+            nbytes += int(np.prod(shape[:2]))*5 + (n*ds)**2*int(np.prod(shape[2:]))*np.dtype(self.dtype).itemsize
+        CziFile._check_bytes(nbytes, max_bytes)
+
+        convert = dict(dtype=dtype, window=window, lut=lut, rgb=rgb)
+        def read_scene(read):
+            p, _, beg, end = read
+            placement = self.placements[p]
+            file_box = np.concatenate((beg - placement['offset'], end - beg)).astype(np.int64)
+            return self.czilib.cziread_scene(self.files[placement['file']]['reader'], file_box,
+                readahead=self.readahead, ds=ds, reduce=CziFile.native_reduce[reduce], channel=self.channel,
+                progress=self.progress, **convert)
+        imgs = self.executor.map(read_scene, reads)
+
+        # paste only the pixels covered by the subblocks of each scene, in the order of the placements.
+        img = np.zeros(shape, dtype=out_dtype)
+        if seams:
+            # the last scene touching each downsampled pixel and whether the pixel also mixes in another scene.
+            owner = np.full(shape[:2], -1, dtype=np.int32); mixed = np.zeros(shape[:2], dtype=bool)
+        for (p, x, beg, end), scene_img in zip(reads, imgs):
+            sbeg = np.maximum(np.vstack((x.x, x.y)).T, beg); send = np.minimum(np.vstack((x.x + x.w, x.y + x.h)).T, end)
+            obeg = (sbeg - box[:2]) // ds; oend = -(-(send - box[:2]) // ds)
+            ibeg = (sbeg - beg) // ds; iend = -(-(send - beg) // ds)
+            for i in range(x.size):
+                img[obeg[i,1]:oend[i,1], obeg[i,0]:oend[i,0]] = scene_img[ibeg[i,1]:iend[i,1], ibeg[i,0]:iend[i,0]]
+            if not seams: continue
+            for i in range(x.size):
+                sl = np.s_[obeg[i,1]:oend[i,1], obeg[i,0]:oend[i,0]]
+                mixed[sl] |= (owner[sl] >= 0) & (owner[sl] != p); owner[sl] = p
+            # pixels completely covered by a subblock of this scene only show this scene.
+            fbeg = -(-(sbeg - box[:2]) // ds)
+            fend = np.where(send >= box[:2] + box[2:], np.array(shape[1::-1]), (send - box[:2]) // ds)
+            for i in range(x.size):
+                mixed[fbeg[i,1]:fend[i,1], fbeg[i,0]:fend[i,0]] = False
+        if seams and mixed.any():
+            self._compose_seams(img, mixed, box, ds, reduce, convert)
+
+        if self.canvas_verbose:
+            print('\t%d subblocks from %d scenes' % (subblocks.size, len(reads)))
+            print('\tdone in %.4f s' % (time.time() - t, ))
+
+        return img
+
+    def _compose_seams(self, img, mixed, box, ds, reduce, convert):
+        # the scenes are downsampled separately, so a downsampled pixel at the border of a scene has the pixels of
+        #   the scene mixed with zeros. where another scene covers the rest of the pixel, it is read again at full
+        #   resolution and reduced after composing, same as downsample_image of the full resolution read.
+        n = max(1, self.seam_tile_size // ds)
+        for ty in range(0, mixed.shape[0], n):
+            for tx in range(0, mixed.shape[1], n):
+                tile = mixed[ty:ty+n, tx:tx+n]
+                if not tile.any(): continue
+                rows, cols = np.nonzero(tile.any(1))[0], np.nonzero(tile.any(0))[0]
+                obeg = np.array([tx + cols[0], ty + rows[0]]); oend = np.array([tx + cols[-1] + 1, ty + rows[-1] + 1])
+                beg = box[:2] + obeg*ds; end = np.minimum(box[:2] + box[2:], box[:2] + oend*ds)
+                part = CziFile.downsample_image(self.read(np.concatenate((beg, end - beg))), ds, reduce=reduce)
+                if any(convert[k] is not None for k in ['dtype', 'window', 'lut']) or convert['rgb']:
+                    part = CziFile.convert_image(part, **convert)
+                sel = mixed[obeg[1]:oend[1], obeg[0]:oend[0]]
+                img[obeg[1]:oend[1], obeg[0]:oend[0]][sel] = part[sel]
+
+    def close(self):
+        """Stop the read threads and close the readers that were opened by the canvas."""
+        self.executor.shutdown()
+        for info in self.files:
+            if info['reader'] is not info['source']: info['reader'].close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+
+# This file is part of pylibczi.
+# Copyright (c) 2018 Center of Advanced European Studies and Research (caesar)
+#
+# pylibczi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pylibczi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
+
+# Catalog of the scenes, ribbons, polygons and subblocks of many czi files in a local sqlite database.
+
+import numpy as np
+import argparse
+import io
+import json
+import os
+import sqlite3
+import time
+import concurrent.futures
+
+# xxx - some better way to handle import if running from command line?
+try:
+    from .CziFile import CziFile
+    from .CziScene import CziScene
+except ImportError as exc:
+    from CziFile import CziFile
+    from CziScene import CziScene
+
+class CziCatalog(object):
+    """Catalog of czi file scene geometry, ribbons, polygons and subblock summaries in a sqlite database.
+
+    The meta data of each czi file is parsed once (in parallel) with CziScene and stored, files are only parsed again
+    if their modification time or size changed. Query functions return tuples that can be passed directly to
+    CziScene or _pylibczi.cziread_scene. Scene intensity statistics can be kept in the catalog as well.
+
+    Args:
+      |  db_filename (str): Filename of the sqlite database, created if it does not exist.
+
+    Kwargs:
+      |  verbose (bool): Print information and times during catalog updates.
+
+    .. note::
+
+       Boxes are (x, y, w, h) int64 arrays in subblock (pixel) coordinates, for scenes the region read by
+       CziScene.read_scene_image and for ribbons the selection box. Stage coordinates are as in the czi meta data.
+
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS files (
+            file_id INTEGER PRIMARY KEY, filename TEXT UNIQUE NOT NULL, mtime REAL, size INTEGER,
+            nscenes INTEGER, nsubblocks INTEGER, scale_x REAL, scale_y REAL, error TEXT);
+        CREATE TABLE IF NOT EXISTS scenes (
+            file_id INTEGER REFERENCES files(file_id) ON DELETE CASCADE, scene INTEGER,
+            x INTEGER, y INTEGER, w INTEGER, h INTEGER,
+            stage_x REAL, stage_y REAL, stage_w REAL, stage_h REAL,
+            nribbons INTEGER, nsections INTEGER, nrois INTEGER, PRIMARY KEY (file_id, scene));
+        CREATE TABLE IF NOT EXISTS ribbons (
+            file_id INTEGER REFERENCES files(file_id) ON DELETE CASCADE, scene INTEGER, ribbon INTEGER,
+            x INTEGER, y INTEGER, w INTEGER, h INTEGER, nsections INTEGER, nrois INTEGER,
+            PRIMARY KEY (file_id, scene, ribbon));
+        CREATE TABLE IF NOT EXISTS polygons (
+            file_id INTEGER REFERENCES files(file_id) ON DELETE CASCADE, scene INTEGER, ribbon INTEGER,
+            kind TEXT, polygon INTEGER, rotation REAL, min_x REAL, min_y REAL, max_x REAL, max_y REAL, points TEXT);
+        CREATE TABLE IF NOT EXISTS subblocks (
+            file_id INTEGER REFERENCES files(file_id) ON DELETE CASCADE, scene INTEGER, count INTEGER,
+            pixel_type INTEGER, compression INTEGER, stored_w INTEGER, stored_h INTEGER, npyramid INTEGER,
+            min_x INTEGER, min_y INTEGER, max_x INTEGER, max_y INTEGER, nbytes INTEGER);
+        CREATE TABLE IF NOT EXISTS stats (
+            file_id INTEGER REFERENCES files(file_id) ON DELETE CASCADE, scene INTEGER, ribbon INTEGER,
+            step INTEGER, data BLOB, PRIMARY KEY (file_id, scene, ribbon, step));
+        CREATE INDEX IF NOT EXISTS scenes_stage ON scenes (stage_x, stage_y);
+        CREATE INDEX IF NOT EXISTS polygons_scene ON polygons (file_id, scene, ribbon);
+        CREATE INDEX IF NOT EXISTS subblocks_file ON subblocks (file_id);
+        """
+
+    def __init__(self, db_filename, verbose=False):
+        self.db_filename = db_filename
+        self.catalog_verbose = verbose
+        self.db = sqlite3.connect(db_filename)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(self.schema)
+
+    def close(self):
+        """Close the database connection."""
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def update(self, paths, nworkers=None, prune=False):
+        """Add czi files to the catalog or refresh the ones that changed.
+
+        Args:
+          |  paths (list of str): czi files and/or directories that are searched recursively for czi files.
+
+        Kwargs:
+          |  nworkers (int): Number of processes parsing files in parallel, defaults to the number of cpus.
+          |  prune (bool): Remove files from the catalog that are not in paths (or do not exist anymore).
+
+        Returns:
+          |  (int):  Number of files that were (re)parsed.
+          |  (int):  Number of files that were unchanged.
+          |  (int):  Number of files that failed to parse (error is stored in the files table).
+
+        """
+        if isinstance(paths, str): paths = [paths]
+        filenames = []
+        for path in paths:
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    filenames += [os.path.join(root, x) for x in sorted(files) if x.lower().endswith('.czi')]
+            else:
+                filenames.append(path)
+        filenames = [os.path.abspath(x) for x in filenames]
+
+        if self.catalog_verbose:
+            print('Updating catalog with %d czi files' % (len(filenames),)); t = time.time()
+
+        # only parse files that are new or changed since the last update
+        known = dict((x[0], (x[1], x[2])) for x in self.db.execute('SELECT filename, mtime, size FROM files'))
+        changed = []
+        for fn in filenames:
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            if known.get(fn) != (st.st_mtime, st.st_size): changed.append(fn)
+        nunchanged = len(filenames) - len(changed)
+
+        nfailed = 0
+        if len(changed) > 0:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=nworkers) as executor:
+                for record in executor.map(_catalog_file, changed, chunksize=max(1, len(changed)//64)):
+                    self._store(record)
+                    if record['error'] is not None: nfailed += 1
+            self.db.commit()
+
+        if prune:
+            keep = set(filenames)
+            for fn, in self.db.execute('SELECT filename FROM files').fetchall():
+                if fn not in keep or not os.path.isfile(fn):
+                    self.db.execute('DELETE FROM files WHERE filename = ?', (fn,))
+            self.db.commit()
+
+        if self.catalog_verbose:
+            print('\t%d parsed (%d failed), %d unchanged' % (len(changed), nfailed, nunchanged))
+            print('\tdone in %.4f s' % (time.time() - t, ))
+
+        return len(changed), nunchanged, nfailed
+
+    def _store(self, record):
+        # replace everything stored for the file with the new record.
+        db = self.db
+        db.execute('DELETE FROM files WHERE filename = ?', (record['filename'],))
+        file_id = db.execute('INSERT INTO files (filename, mtime, size, nscenes, nsubblocks, scale_x, scale_y, error)' +
+            ' VALUES (?,?,?,?,?,?,?,?)', tuple(record[x] for x in ['filename', 'mtime', 'size', 'nscenes',
+            'nsubblocks', 'scale_x', 'scale_y', 'error'])).lastrowid
+        for table in ['scenes', 'ribbons', 'polygons', 'subblocks']:
+            for row in record[table]:
+                db.execute('INSERT INTO %s VALUES (%s)' % (table, ','.join(['?']*(len(row)+1))), (file_id,) + row)
+
+    def query(self, sql, params=()):
+        """Run any sql query on the catalog database and return all rows."""
+        return self.db.execute(sql, params).fetchall()
+
+    def query_scenes(self, stage_region=None, min_sections=0, filename_like=None):
+        """Get scenes, optionally the ones overlapping a stage region.
+
+        Kwargs:
+          |  stage_region (4 array): (x, y, w, h) region in stage coordinates the scenes must overlap.
+          |  min_sections (int): Minimum number of section polygons in the scene.
+          |  filename_like (str): sql LIKE pattern on the (absolute) filename.
+
+        Returns:
+          |  (list of tuple):  (filename, scene, box) for each scene. Scene starts at 1 as for CziScene.
+
+        """
+        where, params = self._where(stage_region, filename_like)
+        rows = self.db.execute('SELECT f.filename, s.scene, s.x, s.y, s.w, s.h FROM scenes s ' +
+            'JOIN files f ON f.file_id = s.file_id WHERE s.nsections >= ?' + where + ' ORDER BY f.filename, s.scene',
+            (min_sections,) + params)
+        return [(x[0], x[1], np.array(x[2:], dtype=np.int64)) for x in rows]
+
+    def query_ribbons(self, min_sections=0, stage_region=None, filename_like=None):
+        """Get ribbons, for example the ribbons with at least some number of sections.
+
+        Kwargs:
+          |  min_sections (int): Minimum number of section polygons assigned to the ribbon.
+          |  stage_region (4 array): (x, y, w, h) region in stage coordinates the scene of the ribbon must overlap.
+          |  filename_like (str): sql LIKE pattern on the (absolute) filename.
+
+        Returns:
+          |  (list of tuple):  (filename, scene, ribbon, box) for each ribbon. Scene and ribbon start at 1 as for
+          |      CziScene, i.e. CziScene(filename, scene=scene, ribbon=ribbon) loads the ribbon.
+
+        """
+        where, params = self._where(stage_region, filename_like)
+        rows = self.db.execute('SELECT f.filename, r.scene, r.ribbon, r.x, r.y, r.w, r.h FROM ribbons r ' +
+            'JOIN files f ON f.file_id = r.file_id JOIN scenes s ON s.file_id = r.file_id AND s.scene = r.scene ' +
+            'WHERE r.nsections >= ?' + where + ' ORDER BY f.filename, r.scene, r.ribbon', (min_sections,) + params)
+        return [(x[0], x[1], x[2], np.array(x[3:], dtype=np.int64)) for x in rows]
+
+    def query_polygons(self, filename, scene, ribbon=None, kind='section'):
+        """Get the section or ROI polygons of a scene or ribbon.
+
+        Args:
+          |  filename (str): czi filename as returned by the other queries.
+          |  scene (int): The scene (starting at 1).
+
+        Kwargs:
+          |  ribbon (int): Only polygons assigned to this ribbon (starting at 1), all polygons in the scene if None.
+          |  kind (str): 'section' or 'roi'.
+
+        Returns:
+          |  (list of n,2 ndarray):  Polygon points in pixels relative to the scene, as CziScene polygons_points.
+
+        """
+        sql = 'SELECT p.points FROM polygons p JOIN files f ON f.file_id = p.file_id ' + \
+            'WHERE f.filename = ? AND p.scene = ? AND p.kind = ?'
+        params = (os.path.abspath(filename), scene, kind)
+        if ribbon is not None:
+            sql += ' AND p.ribbon = ?'; params += (ribbon,)
+        rows = self.db.execute(sql + ' ORDER BY p.polygon', params)
+        return [np.array(json.loads(x[0]), dtype=np.double).reshape(-1,2) for x in rows]
+
+    def store_stats(self, filename, scene, ribbon, step, stats):
+        """Keep the intensity statistics of a scene (as returned by _pylibczi.cziread_stats), see CziScene.stats.
+
+        The file is added to the catalog (or refreshed) if needed, the statistics are removed when the file changes.
+
+        Args:
+          |  filename (str): czi filename.
+          |  scene (int): The scene (starting at 1).
+          |  ribbon (int): The ribbon (starting at 1) or 0 for the whole scene.
+          |  step (int): Only every step-th row and column was used.
+          |  stats (dict): The statistics, dict of ndarrays.
+
+        """
+        filename = os.path.abspath(filename)
+        # parse the file in this process if it is not in the catalog or changed, no worker process for one file.
+        st = os.stat(filename)
+        row = self.db.execute('SELECT mtime, size FROM files WHERE filename = ?', (filename,)).fetchone()
+        if row is None or tuple(row) != (st.st_mtime, st.st_size): self._store(_catalog_file(filename))
+        # only keep the used part of the histograms
+        stats = dict(stats); hist = stats['histogram']; used = np.nonzero(hist.any(0))[0]
+        b, e = (used[0], used[-1] + 1) if used.size > 0 else (0, 0)
+        stats['histogram'] = hist[:,b:e]; stats['histogram_size'] = np.array([b, hist.shape[1]])
+        data = io.BytesIO(); np.savez_compressed(data, **stats)
+        self.db.execute('INSERT OR REPLACE INTO stats SELECT file_id, ?, ?, ?, ? FROM files WHERE filename = ?',
+            (scene, ribbon, step, sqlite3.Binary(data.getvalue()), filename))
+        self.db.commit()
+
+    def query_stats(self, filename, scene, ribbon, step):
+        """Get the intensity statistics kept with store_stats.
+
+        Returns:
+          |  (dict):  The statistics, or None if they are not in the catalog or the file changed since.
+
+        """
+        filename = os.path.abspath(filename)
+        row = self.db.execute('SELECT f.mtime, f.size, s.data FROM stats s JOIN files f ON f.file_id = s.file_id ' +
+            'WHERE f.filename = ? AND s.scene = ? AND s.ribbon = ? AND s.step = ?',
+            (filename, scene, ribbon, step)).fetchone()
+        if row is None: return None
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        if (st.st_mtime, st.st_size) != (row[0], row[1]): return None
+        with np.load(io.BytesIO(row[2])) as data:
+            stats = dict((k, data[k]) for k in data.files)
+        # kept before the statistics had the integer flag
+        if 'integer' not in stats: return None
+        b, n = stats.pop('histogram_size'); hist = stats['histogram']
+        stats['histogram'] = np.zeros((hist.shape[0], n), dtype=hist.dtype); stats['histogram'][:,b:b+hist.shape[1]] = hist
+        return stats
+
+    @staticmethod
+    def _where(stage_region, filename_like):
+        # additional conditions on the scenes (alias s) and files (alias f) tables
+        where, params = '', ()
+        if stage_region is not None:
+            x, y, w, h = [float(v) for v in stage_region]
+            where += ' AND s.stage_x < ? AND s.stage_x + s.stage_w > ? AND s.stage_y < ? AND s.stage_y + s.stage_h > ?'
+            params += (x + w, x, y + h, y)
+        if filename_like is not None:
+            where += ' AND f.filename LIKE ?'; params += (filename_like,)
+        return where, params
+
+    @staticmethod
+    def _addArgs(p):
+        # adds arguments required for this object to specified ArgumentParser object
+        p.add_argument('--db-filename', nargs=1, type=str, default=['czi_catalog.sqlite'], help='Catalog database')
+        p.add_argument('--paths', nargs='+', type=str, default=[], help='czi files or directories to catalog')
+        p.add_argument('--nworkers', nargs=1, type=int, default=[None], help='Number of parallel processes')
+        p.add_argument('--prune', action='store_true', help='Remove files not in paths from the catalog')
+        p.add_argument('--catalog-verbose', action='store_true', help='Verbose output')
+
+def _catalog_file(filename):
+    # parse the meta data and subblock directory of one czi file into rows for the catalog tables.
+    #   runs in the worker processes, so only returns plain python values.
+    st = os.stat(filename)
+    record = {'filename':filename, 'mtime':st.st_mtime, 'size':st.st_size, 'nscenes':None, 'nsubblocks':None,
+              'scale_x':None, 'scale_y':None, 'error':None, 'scenes':[], 'ribbons':[], 'polygons':[], 'subblocks':[]}
+    try:
+        import _pylibczi
+        # keep the file open for all the scenes
+        with _pylibczi.CziReader(filename) as reader:
+            index = CziFile(reader).read_subblock_index()
+            record['nsubblocks'] = int(index.size)
+            for s in np.unique(index.S):
+                sel = (index.S == s); x = index[sel]
+                shapes = np.vstack((x.stored_h, x.stored_w)).T; h, w = CziFile._mode_rows(shapes)
+                pixel_types, counts = np.unique(x.pixel_type, return_counts=True)
+                record['subblocks'].append((int(s)+1 if s >= 0 else None, int(sel.sum()),
+                    int(pixel_types[counts.argmax()]), int(x.compression[0]), int(w), int(h),
+                    int((x.pyramid_type != 0).sum()), int(x.x.min()), int(x.y.min()), int((x.x + x.w).max()),
+                    int((x.y + x.h).max()), int(x.file_size[x.file_size > 0].sum())))
+
+            scene = CziScene(reader, scene=1, ribbon=0)
+            scene.read_scene_meta()
+            record['nscenes'] = int(scene.nscenes)
+            record['scale_x'], record['scale_y'] = [float(v) for v in scene.scale]
+            for s in range(scene.nscenes):
+                if s > 0:
+                    scene = CziScene(reader, scene=s+1, ribbon=0)
+                    scene.read_scene_meta()
+                _catalog_scene(scene, record)
+    except Exception as e:
+        record['error'] = '{}: {}'.format(type(e).__name__, e)
+    return record
+
+def _catalog_scene(scene, record):
+    # add the rows for one scene (without ribbon cropping) to the catalog record.
+    s = scene.scene + 1
+    # the region read by read_scene_image, single scene files are cropped from the libCZI scene image.
+    corner = scene._scene_origin_pix() + scene.scene_corner_pix
+
+    # the polygons are assigned to the closest ribbon by read_scene_meta, the same as for cropping a ribbon.
+    box_corners = np.asarray(scene.box_corners_pix, dtype=np.double).reshape(-1,2)
+    box_sizes = np.asarray(scene.box_sizes_pix, dtype=np.double).reshape(-1,2)
+    kinds = [('section', scene.polygons_points, scene.polygons_rotation, scene.polygons_ribbons),
+             ('roi', scene.rois_points, scene.rois_rotation, scene.rois_ribbons)]
+    counts = {}
+    for kind, points, rotations, ribbons in kinds:
+        for i in range(len(points)):
+            p = np.asarray(points[i], dtype=np.double); pmin = p.min(0); pmax = p.max(0)
+            record['polygons'].append((s, int(ribbons[i]) if ribbons[i] > 0 else None, kind, i,
+                float(rotations[i]), float(pmin[0]), float(pmin[1]), float(pmax[0]), float(pmax[1]),
+                json.dumps(p.tolist())))
+        counts[kind] = ribbons
+
+    record['scenes'].append((s, int(corner[0]), int(corner[1]), int(scene.scene_size_pix[0]),
+        int(scene.scene_size_pix[1]), float(scene.scene_stage_corner[0]), float(scene.scene_stage_corner[1]),
+        float(scene.scene_stage_size[0]), float(scene.scene_stage_size[1]), int(scene.nboxes),
+        len(scene.polygons_points), len(scene.rois_points)))
+    for i in range(box_corners.shape[0]):
+        r = int(scene.box_ribbons[i]); c = np.round(corner + box_corners[i,:]).astype(np.int64)
+        record['ribbons'].append((s, r, int(c[0]), int(c[1]), int(round(box_sizes[i,0])), int(round(box_sizes[i,1])),
+            int((counts['section'] == r).sum()), int((counts['roi'] == r).sum())))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Catalog of scenes, ribbons and polygons for many Zeiss czi files',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    CziCatalog._addArgs(parser)
+    args = parser.parse_args()
+
+    with CziCatalog(args.db_filename[0], verbose=args.catalog_verbose) as catalog:
+        catalog.update(args.paths, nworkers=args.nworkers[0], prune=args.prune)
@@ -18,19 +18,28 @@
 
 import numpy as np
 import time
+import io
+import concurrent.futures
+import multiprocessing
 #import os
 
-from lxml import etree as etree
+# lxml, uuid and the optional plotting / image io packages are imported where they are used, so that reading
+#   images only needs numpy and _pylibczi (fast start of worker processes).
 
 class CziFile(object):
     """Zeiss CZI file object.
 
       Args:
-        |  czi_filename (str): Filename of czifile to access.
+        |  czi_filename (str): Filename of czifile to access. With pylibczi this can also be an in-memory buffer
+        |      (bytes, memoryview, mmap), a file-like object with seek and readinto or an open _pylibczi.CziReader.
 
       Kwargs:
         |  metafile_out (str): Filename of xml file to optionally export czi meta data to.
         |  use_pylibczi (bool): Set to false to use Christoph Gohlke's czifile reader instead of libCZI.
+        |  readahead (int): Maximum size in bytes of a single sequential read. Subblocks are always read in the order
+        |      they are stored in the file, with readahead > 0 neighboring subblocks are fetched with one read.
+        |  progress (_pylibczi.ReadProgress): Passed to all reads, to follow their progress or cancel them from
+        |      another thread (reset it to read again). Only supported with pylibczi, not pickled.
         |  verbose (bool): Print information and times during czi file access.
 
     .. note::
@@ -42,13 +51,21 @@ class CziFile(object):
     # how many calibration markers to read in, this should essentially be a constant
     nmarkers = 3
 
+    # reduce functions for downsampling that are implemented natively in pylibczi
+    native_reduce = {np.mean: 'mean', np.max: 'max', np.amax: 'max', 'mean': 'mean', 'max': 'max', 'stride': 'stride'}
+
+    # numpy dtype and channels of the libCZI pixel types (pixel_type in the subblock index) that can be read
+    pixel_types = {0: (np.uint8, 1), 1: (np.uint16, 1), 2: (np.float32, 1), 3: (np.uint8, 3), 4: (np.uint16, 3)}
+
     # xxx - likely this is a Zeiss bug,
     #   units for the scale in the xml file are not correct (says microns, given in meters)
     scale_units = 1e6
 
-    def __init__(self, czi_filename, metafile_out='', use_pylibczi=True, verbose=False):
+    def __init__(self, czi_filename, metafile_out='', use_pylibczi=True, readahead=0, progress=None, verbose=False):
         self.czi_filename = czi_filename
         self.metafile_out = metafile_out
+        self.readahead = readahead
+        self.progress = progress
         self.czifile_verbose = verbose
 
         # whether to use czifile or pylibczi for reading the czi file.
@@ -61,6 +78,20 @@ class CziFile(object):
             import czifile
             self.czilib = czifile
 
+    def _init_args(self):
+        # the constructor arguments, enough to open the czi file again in another process.
+        #   the progress only follows reads in this process and is not passed on.
+        return dict(czi_filename=self.czi_filename, metafile_out=self.metafile_out, use_pylibczi=self.use_pylibczi,
+            readahead=self.readahead, verbose=self.czifile_verbose)
+
+    def __getstate__(self):
+        # pickle only the constructor arguments (e.g. for multiprocessing workers), the czi library, metadata and any
+        #   loaded images are read again on demand where it is unpickled. a CziReader pickles as its source.
+        return self._init_args()
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
     def read_meta(self):
         """Extract all metadata from czifile.
 
@@ -68,21 +99,82 @@ class CziFile(object):
             meta_root (etree): xml class containing root of the extracted meta data.
 
         """
+        from lxml import etree as etree
+
         if self.use_pylibczi:
             self.meta_root = etree.fromstring(self.czilib.cziread_meta(self.czi_filename))
         else:
             # get the root of the metadata xml
             #root = ET.fromstring(metastr) # to convert to python etree
-            self.meta_root = self.czi.metadata.getroottree()
+            metadata = self._czifile().metadata
+            # newer czifile versions return the xml string from a method
+            self.meta_root = etree.fromstring(metadata(raw=True)) if callable(metadata) else metadata.getroottree()
 
         if self.metafile_out:
             metastr = etree.tostring(self.meta_root, pretty_print=True).decode('utf-8')
             with open(self.metafile_out, 'w') as file:
                 file.write(metastr)
 
-    def read_image(self):
+    def read_subblock_index(self):
+        """Read the subblock directory of the czifile without reading or decoding any subblocks.
+
+        Returns:
+          |  (recarray):  One record per subblock with int64 fields index (libCZI subblock index), x, y, w, h (logical
+          |      rectangle), stored_w, stored_h (size of the stored bitmap), m_index, pyramid_type, pixel_type,
+          |      compression, S, C, Z, T (-1 if the subblock does not have the dimension) and file_position, file_size
+          |      (-1 if not known).
+
+        """
+        index = self.czilib.cziread_subblock_index(self.czi_filename)
+        return np.rec.fromarrays(list(index.values()), names=list(index.keys()))
+
+    def read_subblocks_raw(self, subblock_filter=None):
+        """Read the raw (compressed) data of subblocks without decoding them, e.g. for hashing or transcoding.
+
+        Kwargs:
+          |  subblock_filter (func): Predicate on the subblock index that returns a bool mask of the subblocks to
+          |      read, see read_image.
+
+        Returns:
+          |  (recarray):  The subblock index records of the subblocks that were read, see read_subblock_index.
+          |  (list of bytes):  The raw data of each subblock, decode it with decode_subblock.
+
+        """
+        assert( self.use_pylibczi ) # raw subblocks not supported with czifile
+
+        index = self.read_subblock_index()
+        if subblock_filter is not None:
+            index = index[np.asarray(subblock_filter(index), dtype=bool)]
+        raws = self.czilib.cziread_subblocks_raw(self.czi_filename, indices=index.index, readahead=self.readahead,
+            progress=self.progress)
+        return index, raws
+
+    @staticmethod
+    def decode_subblock(raw, record):
+        """Decode the raw data of a subblock (see read_subblocks_raw), releases the GIL while decoding.
+
+        Args:
+          |  raw (bytes): Raw subblock data, or any other buffer holding it.
+          |  record (record): The subblock index record of the subblock, for its pixel type, size and compression.
+
+        Returns:
+          |  (m,n,nchan ndarray):  The subblock image, same as read by read_image.
+
+        """
+        import _pylibczi
+        return _pylibczi.decode(raw, int(record.pixel_type), (int(record.stored_h), int(record.stored_w)),
+            compression=int(record.compression))
+
+    def read_image(self, subblock_filter=None, max_bytes=None):
         """Read image data from all subblocks and create single montaged image.
 
+        Kwargs:
+          |  subblock_filter (func): Predicate on the subblock index (see read_subblock_index) that returns a bool
+          |      mask of the subblocks to use, for example lambda x: x.S == 0. Evaluated before any subblock is read,
+          |      only the selected subblocks of the majority size are read. Only supported with pylibczi.
+          |  max_bytes (int): Raise MemoryError before reading if the image and the decoded subblocks would need more
+          |      memory than this. Only supported with pylibczi.
+
         Returns:
           |  (m,n,nchan ndarray):  Montaged image from all subblocks.
 
@@ -95,18 +187,44 @@ class CziFile(object):
             # xxx - this does not work for czifiles for which the subblocks have no dimension label.
             #   additionally it seems not possible to create an accessor without specifying a dimension label / index.
             #img = self.czilib.cziread_scene(self.czi_filename, -np.ones((1,), dtype=np.int64))
-            imgs, coords = self.czilib.cziread_allsubblocks(self.czi_filename)
-            if len(imgs) > 1:
+            index = self.read_subblock_index()
+            if subblock_filter is not None:
+                index = index[np.asarray(subblock_filter(index), dtype=bool)]
+                assert( index.size > 0 ) # no subblocks left after filter
+            sel = np.ones((index.size,), dtype=bool)
+            if index.size > 1:
                 # xxx - was not clear what to do in the cases of many subblocks of different sizes.
                 #   could not find any other subblock attribute to indicate what the difference is between them.
                 #   only plotting the images that are the majority size gave the result closest to loading in Zen.
-                img, _ = CziFile._montage(imgs, coords, mode_size_only=True)
+                # the sizes are known from the subblock directory, so only read the subblocks of the majority size.
+                shapes = np.vstack((index.stored_h, index.stored_w)).T
+                sel = (shapes == CziFile._mode_rows(shapes)).all(1)
+            if max_bytes is not None:
+                # the decoded subblocks are kept until they are pasted into the montage (same extent as _montage).
+                dtype, nchan = CziFile.pixel_types[index.pixel_type[sel][0]]
+                pixel_bytes = np.dtype(dtype).itemsize*nchan
+                nbytes = int((index.stored_w[sel]*index.stored_h[sel]).sum())*pixel_bytes
+                if index.size > 1:
+                    extent = [max(index.x.max(), (index.x + index.stored_w)[sel].max()) - index.x.min(),
+                              max(index.y.max(), (index.y + index.stored_h)[sel].max()) - index.y.min()]
+                    nbytes += int(extent[0])*int(extent[1])*pixel_bytes
+                CziFile._check_bytes(nbytes, max_bytes)
+            # the subblocks are only pasted into the montage, so get views on the decoded bitmaps instead of copies.
+            read_imgs, _ = self.czilib.cziread_allsubblocks(self.czi_filename, zero_copy=True,
+                readahead=self.readahead, indices=index.index[sel], progress=self.progress)
+            if index.size > 1:
+                # subblocks of other sizes are not read, but still count towards the montage extent.
+                imgs = [None]*index.size
+                for i,x in zip(np.nonzero(sel)[0], read_imgs): imgs[i] = np.asarray(x)
+                coords = np.vstack((index.x, index.y)).T
+                img, _ = CziFile._montage(imgs, coords)
             else:
-                img = imgs[0]
+                # the bitmap rows may be padded, return a contiguous image as for several subblocks.
+                img = np.ascontiguousarray(read_imgs[0])
         else:
-            # (?, scenes, ?, xdim, ydim, colors?)
-            img = np.squeeze(self.czilib.CziFile(self.czi_filename).asarray())
-            assert( img.ndim <= 3 ) # xxx - other dims?
+            assert( subblock_filter is None ) # subblock filter not supported with czifile
+            # only the first plane is read (same as cziread_scene), not every plane of the file.
+            img, _ = self._czifile_read()
 
         if self.czifile_verbose:
             print('\tdone in %.4f s' % (time.time() - t, ))
@@ -114,6 +232,277 @@ class CziFile(object):
 
         return img
 
+    def plan_read(self, scene_or_box=None, zoom=1., channels=None, dtype=None, reduce=np.mean, convert=None):
+        """Estimate the cost of reading a scene or box (as with cziread_scene) from the subblock index, without reading
+        any pixels. Only supported with pylibczi.
+
+        Kwargs:
+          |  scene_or_box (int or 1d ndarray): Scene (S index, the bounding box of its subblocks) or box (x, y, w, h)
+          |      in pixels, None for the bounding box of all subblocks.
+          |  zoom (float): Read downsampled by round(1/zoom), see CziScene.read_scene_image_ds.
+          |  channels (list of int): Planes (C indices) to read, each is a separate image. Defaults to [0].
+          |  dtype (numpy dtype): Output data type of a conversion, defaults to the image data type.
+          |  reduce (func or str): Reduction of a downsampled read, see CziScene.read_scene_image_ds.
+          |  convert (bool): Whether the read converts (dtype, window, lut or rgb), defaults to whether dtype differs
+          |      from the image data type.
+
+        Returns:
+          |  (dict):  box (x, y, w, h), ds (downsampling), shape and dtype of the output image (per channel),
+          |      image_dtype (data type of the subblocks), bytes
+          |      (output size of all channels plus the buffers of a downsampled read, what max_bytes is checked
+          |      against), subblocks (number of subblocks to read and decode), compressed_bytes (size of the
+          |      subblocks in the file) and decoded_bytes (size of the decoded subblocks).
+
+        """
+        assert( self.use_pylibczi ) # read planning not supported with czifile
+
+        index = self.read_subblock_index()
+        # the full resolution subblocks, the same that cziread_scene composes.
+        index = index[(index.w == index.stored_w) & (index.h == index.stored_h)]
+        assert( index.size > 0 ) # no subblocks in czi file
+        if scene_or_box is None:
+            sel = np.ones((index.size,), dtype=bool)
+        elif np.size(scene_or_box) == 1:
+            sel = (np.maximum(index.S, 0) == int(np.ravel(scene_or_box)[0]))
+            assert( sel.any() ) # no subblocks for the scene
+        if scene_or_box is None or np.size(scene_or_box) == 1:
+            box = np.array([index.x[sel].min(), index.y[sel].min(), (index.x + index.w)[sel].max() - index.x[sel].min(),
+                            (index.y + index.h)[sel].max() - index.y[sel].min()], dtype=np.int64)
+        else:
+            box = np.asarray(scene_or_box, dtype=np.int64).reshape(4)
+
+        ds = max(1, int(round(1./zoom)))
+        if channels is None: channels = [0]
+        # subblocks of the planes that overlap the box
+        sel = np.isin(np.maximum(index.C, 0), channels) & (index.x < box[0] + box[2]) & \
+            (index.x + index.w > box[0]) & (index.y < box[1] + box[3]) & (index.y + index.h > box[1])
+        pixel_type = index.pixel_type[sel][0] if sel.any() else index.pixel_type[0]
+        assert( pixel_type in CziFile.pixel_types ) # unknown image type in czi file
+        img_dtype, nchan = CziFile.pixel_types[pixel_type]
+        dtype = np.dtype(img_dtype if dtype is None else dtype)
+        shape = (-(-int(box[3]) // ds), -(-int(box[2]) // ds)) + ((nchan,) if nchan > 1 else ())
+        file_size = np.maximum(index.file_size[sel], 0)
+        if convert is None: convert = dtype != np.dtype(img_dtype)
+        # the channels are read one after the other, so the buffers of only one read are allocated at a time.
+        nbytes = int(np.prod(shape))*dtype.itemsize*len(channels) + \
+            CziFile._reduce_bytes(shape, img_dtype, ds, reduce, convert)
+
+        return {'box':box, 'ds':ds, 'shape':shape, 'dtype':dtype, 'image_dtype':np.dtype(img_dtype), 'bytes':nbytes,
+                'subblocks':int(sel.sum()),
+                'compressed_bytes':int(file_size.sum()),
+                'decoded_bytes':int((index.stored_w[sel]*index.stored_h[sel]).sum())*np.dtype(img_dtype).itemsize*nchan}
+
+    @staticmethod
+    def _reduce_bytes(shape, img_dtype, ds, reduce, convert):
+        # bytes that a native read downsampled to shape allocates besides the output image (block sums for mean,
+        #   the reduced image before the conversion for max), the same as the max_bytes check of cziread_scene.
+        reduce = CziFile.native_reduce.get(reduce)
+        if ds <= 1 or reduce is None: return 0
+        img_dtype = np.dtype(img_dtype)
+        pixels = int(shape[0])*int(shape[1]); nchan = int(shape[2]) if len(shape) > 2 else 1
+        if reduce == 'mean':
+            if img_dtype == np.float32:
+                sum_bytes = 8
+            else:
+                # the smallest type that can hold the block sums
+                block_max = ds*ds*int(np.iinfo(img_dtype).max)
+                sum_bytes = 2 if block_max < 2**16 else (4 if block_max < 2**32 else 8)
+            return pixels*nchan*sum_bytes
+        elif reduce == 'max':
+            return (pixels*nchan*img_dtype.itemsize if convert else 0) + (pixels*4 if img_dtype == np.float32 else 0)
+        return 0
+
+    @staticmethod
+    def _check_bytes(nbytes, max_bytes):
+        if max_bytes is not None and nbytes > max_bytes:
+            raise MemoryError('Reading %d bytes exceeds max_bytes %d' % (nbytes, max_bytes))
+
+    def read_boxes(self, boxes, threads=0, dtype=None, window=None, lut=None, rgb=False, max_bytes=None):
+        """Read many boxes at once, for example patches for training data. Only supported with pylibczi.
+
+        Each subblock is read and decoded once, also if several boxes need it, and the subblocks are decoded in
+        parallel. The conversion options are applied while the subblocks are copied into the boxes, see convert_image.
+
+        Args:
+          |  boxes (n,4 ndarray): Boxes (x, y, w, h) in pixels, same coordinates as the box for cziread_scene.
+
+        Kwargs:
+          |  threads (int): Number of decoding threads, 0 to use all cpus.
+          |  dtype (numpy dtype): Output data type (uint8, uint16 or float32), defaults to the image data type.
+          |  window (tuple): Intensity window (lo, hi) that is mapped to the output range.
+          |  lut (1d ndarray): Lookup table from image values to output values.
+          |  rgb (bool): Reverse the channels of color images (BGR to RGB).
+          |  max_bytes (int): Raise MemoryError before reading if the boxes would be larger than this (the decoded
+          |      subblocks that are kept while the boxes are read are not counted).
+
+        Returns:
+          |  (n,h,w,nchan ndarray or list):  The boxes, stacked if all boxes have the same size, otherwise a list.
+
+        """
+        assert( self.use_pylibczi ) # reading boxes not supported with czifile
+        if max_bytes is not None and len(boxes) > 0:
+            boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+            plan = self.plan_read(boxes[0], dtype=dtype)
+            pixel_bytes = plan['dtype'].itemsize*(plan['shape'][2] if len(plan['shape']) > 2 else 1)
+            CziFile._check_bytes(int((np.maximum(boxes[:,2], 0)*np.maximum(boxes[:,3], 0)).sum())*pixel_bytes,
+                max_bytes)
+
+        if self.czifile_verbose:
+            print('Loading %d boxes' % (len(boxes),)); t = time.time()
+
+        imgs = self.czilib.cziread_boxes(self.czi_filename, boxes, readahead=self.readahead, threads=threads,
+            dtype=dtype, window=window, lut=lut, rgb=rgb, progress=self.progress)
+
+        if self.czifile_verbose:
+            print('\tdone in %.4f s' % (time.time() - t, ))
+
+        return imgs
+
+    def _czifile(self):
+        # czifile object for the czifile backend, opened once.
+        if getattr(self, 'czi', None) is None:
+            self.czi = self.czilib.CziFile(self.czi_filename)
+        return self.czi
+
+    def _czifile_read(self, box=None, scene=None, channel=0, threads=0):
+        # read a box (x, y, w, h) or the bounding box of the selected subblocks with czifile, instead of reading the
+        #   whole file with asarray. only the full resolution subblocks of the plane (channel and the first index of
+        #   the other dimensions, of scene if given) that overlap the box are read. they are decoded in parallel and
+        #   drawn in mosaic index order, like the libCZI composition.
+        czi = self._czifile()
+        start = dict(zip(czi.axes, czi.start))
+        entries = []
+        for entry in czi.subblock_directory:
+            dims = dict((x.dimension, x) for x in entry.dimension_entries)
+            if 'X' not in dims or 'Y' not in dims: continue
+            if any(dims[x].size != dims[x].stored_size for x in 'XY'): continue
+            if scene is not None and (dims['S'].start if 'S' in dims else 0) != scene: continue
+            if (dims['C'].start if 'C' in dims else 0) != channel: continue
+            if any(x.start != start.get(x.dimension, x.start) for x in entry.dimension_entries
+                   if x.dimension not in 'XYSCM'): continue
+            rect = np.array([dims['X'].start, dims['Y'].start, dims['X'].size, dims['Y'].size], dtype=np.int64)
+            if box is not None and (rect[0] >= box[0] + box[2] or rect[0] + rect[2] <= box[0] or
+                                    rect[1] >= box[1] + box[3] or rect[1] + rect[3] <= box[1]): continue
+            entries.append((-1 if entry.mosaic_index is None else entry.mosaic_index, len(entries), entry, rect))
+        if box is None:
+            assert( len(entries) > 0 ) # no subblocks for the scene and plane
+            rects = np.array([x[3] for x in entries])
+            box = np.concatenate((rects[:,:2].min(0), (rects[:,:2] + rects[:,2:]).max(0) - rects[:,:2].min(0)))
+        box = np.asarray(box, dtype=np.int64)
+        if len(entries) == 0:
+            # nothing drawn, same as cziread_scene. the samples of color images are the '0' axis of czifile.
+            nchan = czi.shape[czi.axes.index('0')] if '0' in czi.axes else 1
+            return np.zeros((box[3], box[2]) + ((nchan,) if nchan > 1 else ()), dtype=czi.dtype), box
+        entries.sort(key=lambda x: x[:2])
+        rects = [x[3] for x in entries]
+
+        def decode(item):
+            entry = item[2]
+            tile = entry.data_segment().data(resize=False)
+            # all dimensions except Y, X and the samples have size one.
+            axes = [entry.axes.index(x) for x in 'YX0']
+            tile = np.transpose(tile, axes + [i for i in range(tile.ndim) if i not in axes])
+            tile = tile.reshape(tile.shape[:3])
+            if entry.compression != 4 and tile.shape[2] in (3, 4):
+                # czifile converts to RGB(A), keep the BGR order of libCZI.
+                tile = tile[:,:,[2, 1, 0] + list(range(3, tile.shape[2]))]
+            return tile
+
+        if threads <= 0: threads = multiprocessing.cpu_count()
+        if threads > 1 and len(entries) > 1:
+            # same as czifile asarray, reading from several threads needs the file handle lock.
+            czi._fh.lock = True
+            try:
+                with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+                    tiles = list(executor.map(decode, entries))
+            finally:
+                czi._fh.lock = None
+        else:
+            tiles = [decode(x) for x in entries]
+
+        img = np.zeros((box[3], box[2], tiles[0].shape[2]), dtype=tiles[0].dtype)
+        for tile, rect in zip(tiles, rects):
+            beg = np.maximum(rect[:2], box[:2]); end = np.minimum(rect[:2] + rect[2:], box[:2] + box[2:])
+            img[beg[1]-box[1]:end[1]-box[1], beg[0]-box[0]:end[0]-box[0]] = \
+                tile[beg[1]-rect[1]:end[1]-rect[1], beg[0]-rect[0]:end[0]-rect[0]]
+        return (img[:,:,0] if img.shape[2] == 1 else img), box
+
+    def list_attachments(self):
+        """List the attachments stored in the czifile (e.g. Thumbnail, Label, SlidePreview).
+
+        Only the attachment directory is read, no image data.
+
+        Returns:
+          |  (list of tuple):  (name, content_file_type, content_guid) for each attachment, ordered by attachment index.
+
+        """
+        if self.use_pylibczi:
+            return self.czilib.cziread_attachments(self.czi_filename)
+        else:
+            import uuid
+            czi = self.czilib.CziFile(self.czi_filename)
+            # czifile does not read the guid as little endian, convert to the same representation as libCZI.
+            return [(x.name, x.content_file_type, str(uuid.UUID(bytes_le=x.content_guid.bytes)))
+                    for x in czi.attachment_directory]
+
+    def read_attachment(self, name, raw=False):
+        """Read an attachment from the czifile without decoding any of the image subblocks.
+
+        Args:
+          |  name (str or int): Name of the attachment (first attachment with this name) or attachment index.
+
+        Kwargs:
+          |  raw (bool): Return the attachment data as stored instead of decoding it.
+
+        Returns:
+          |  (m,n,nchan ndarray or bytes):  Decoded image for CZI, JPG, PNG or BMP attachments (CZI attachments are
+          |      montaged like read_image, colors are BGR) and raw bytes for any other attachments.
+
+        """
+        attachments = self.list_attachments()
+        if isinstance(name, str):
+            index = [i for i,x in enumerate(attachments) if x[0] == name]
+            if len(index) == 0:
+                raise KeyError('Attachment {} not found, available: {}'.format(name, [x[0] for x in attachments]))
+            index = index[0]
+        else:
+            index = name
+        content_file_type = attachments[index][1]
+
+        if self.czifile_verbose:
+            print('Loading czi attachment %s (%s)' % (attachments[index][0], content_file_type)); t = time.time()
+
+        if self.use_pylibczi:
+            data = self.czilib.cziread_attachment(self.czi_filename, index)
+        else:
+            czi = self.czilib.CziFile(self.czi_filename)
+            data = czi.attachment_directory[index].data_segment().data(raw=True)
+
+        if not raw:
+            if content_file_type == 'CZI':
+                # embedded czi file, read it directly from memory
+                data = CziFile(data if self.use_pylibczi else io.BytesIO(data),
+                               use_pylibczi=self.use_pylibczi).read_image()
+            elif content_file_type in ['JPG', 'PNG', 'BMP']:
+                data = CziFile._decode_image_attachment(data)
+
+        if self.czifile_verbose:
+            print('\tdone in %.4f s' % (time.time() - t, ))
+
+        return data
+
+    @staticmethod
+    def _decode_image_attachment(data):
+        # decode a compressed image attachment with whichever image io is available, otherwise leave it raw.
+        try:
+            import imageio
+        except ImportError:
+            try:
+                import skimage.io as imageio
+            except ImportError:
+                return data
+        return np.asarray(imageio.imread(io.BytesIO(data)))
+
     @staticmethod
     def plot_image(image, figno=1, doplots_ds=1, reduce=np.mean, interp_string='nearest', show=True):
         """Generic image plot using matplotlib.
@@ -127,17 +516,11 @@ class CziFile(object):
 
         """
         from matplotlib import pylab as pl
-        import skimage.measure as measure
 
-        if image.ndim == 3 and issubclass(image.dtype.type, np.integer):
-            #image = image / np.iinfo(image.dtype).max
-            image = image / image.max()
-            # all the zeiss color formats are bgr, not rgb
-            image = image[:,:,[2,1,0]]
-            assert(doplots_ds==1) # block reduce on color images not implemented here
-
-        img_ds = measure.block_reduce(image, block_size=tuple([doplots_ds for x in range(image.ndim)]),
-                                      func=reduce).astype(image.dtype) if doplots_ds > 1 else image
+        img_ds = CziFile.downsample_image(image, doplots_ds, reduce=reduce)
+        if img_ds.ndim == 3 and issubclass(img_ds.dtype.type, np.integer):
+            # scale to the image max, all the zeiss color formats are bgr, not rgb
+            img_ds = CziFile.convert_image(img_ds, dtype=np.uint8, window=(0, img_ds.max()), rgb=True)
 
         pl.figure(figno)
         ax = pl.subplot(1,1,1)
@@ -146,6 +529,79 @@ class CziFile(object):
 
         if show: pl.show()
 
+    @staticmethod
+    def downsample_image(image, ds, reduce=np.mean):
+        """Downsample an image by an integer factor, same result as skimage block_reduce followed by astype.
+
+        Args:
+          |  image (m,n,nchan ndarray): Image to downsample, color channels are reduced independently.
+          |  ds (int): Downsampling reduce factor.
+
+        Kwargs:
+          |  reduce (func or str): Function to use for block-reduce downsampling. np.mean, np.max and 'stride'
+          |      (every ds-th pixel) are done natively in a single pass with pylibczi if it is available. The native
+          |      float32 mean is summed in double, so it differs from block_reduce (summed in float32) by the float32
+          |      rounding errors, integer images and the max are identical.
+
+        Returns:
+          |  (m/ds,n/ds,nchan ndarray):  The downsampled image with the same data type as image.
+
+        """
+        if ds == 1: return image
+        if reduce == 'stride': return image[::ds,::ds]
+        try:
+            import _pylibczi
+        except ImportError:
+            _pylibczi = None
+        if _pylibczi is not None and CziFile.native_reduce.get(reduce) is not None and \
+                image.dtype in [np.uint8, np.uint16, np.float32]:
+            return _pylibczi.downsample(image, ds, reduce=CziFile.native_reduce[reduce])
+
+        import skimage.measure as measure
+        return measure.block_reduce(image, block_size=(ds, ds) + (1,)*(image.ndim-2),
+                                    func=reduce).astype(image.dtype)
+
+    @staticmethod
+    def convert_image(image, dtype=None, window=None, lut=None, rgb=False):
+        """Convert an image for display in a single pass, natively with pylibczi if it is available.
+
+        Args:
+          |  image (m,n,nchan ndarray): Image to convert.
+
+        Kwargs:
+          |  dtype (numpy dtype): Output data type (uint8, uint16 or float32), defaults to the lut or image data type.
+          |      Values are rounded and clipped to the range of integer output types.
+          |  window (tuple): Intensity window (lo, hi) that is mapped to the full range of integer output types, or
+          |      to 0..1 for float output.
+          |  lut (1d ndarray): Lookup table from image values to output values (integer images only), values larger
+          |      than the table use the last entry.
+          |  rgb (bool): Reverse the channels of color images (BGR to RGB).
+
+        Returns:
+          |  (m,n,nchan ndarray):  The converted image.
+
+        """
+        try:
+            import _pylibczi
+        except ImportError:
+            _pylibczi = None
+        if _pylibczi is not None and image.dtype in [np.uint8, np.uint16, np.float32]:
+            return _pylibczi.convert(image, dtype=dtype, window=window, lut=lut, rgb=rgb)
+
+        out = np.dtype(dtype) if dtype is not None else (np.asarray(lut).dtype if lut is not None else image.dtype)
+        if lut is not None:
+            img = np.asarray(lut, dtype=np.float64)[np.minimum(image, len(lut)-1)]
+        else:
+            img = image.astype(np.float64)
+        if window is not None:
+            lo, hi = window
+            img = np.clip((img - lo)/(hi - lo), 0, 1) if hi > lo else (img >= hi).astype(np.float64)
+            if issubclass(out.type, np.integer): img *= np.iinfo(out).max
+        if issubclass(out.type, np.integer):
+            img = np.floor(np.clip(img, 0, np.iinfo(out).max) + 0.5)
+        img = img.astype(out)
+        return img[:,:,::-1] if rgb and img.ndim == 3 else img
+
     # https://stackoverflow.com/questions/43554819/find-most-frequent-row-or-mode-of-a-matrix-of-vectors-python-numpy
     @staticmethod
     def _mode_rows(a):
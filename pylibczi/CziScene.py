@@ -22,8 +22,6 @@ import numpy as np
 import argparse
 import time
 
-import scipy.spatial.distance as scidist
-
 # xxx - some better way to handle import if running from command line?
 try:
     from .CziFile import CziFile
@@ -36,13 +34,16 @@ class CziScene(CziFile):
     Access functions allow for reading of czi metadata to extract information for a particular scene.
 
     Args:
-      |  czi_filename (str): Filename of czifile to access scene information in.
+      |  czi_filename (str): Filename of czifile to access scene information in (or any source accepted by CziFile).
 
     Kwargs:
       |  scene (int): The scene to load in czifile (starting at 1).
       |  ribbon (int): The ribbon to crop to (starting at 1). Negative value disables the ribbon cropping.
       |  metafile_out (str): Filename of xml file to export czi meta data to.
       |  tifffile_out (str): Filename of tiff file to export czi scene image to.
+      |  use_pylibczi (bool): Set to false to use Christoph Gohlke's czifile reader instead of libCZI.
+      |  readahead (int): Maximum size in bytes of a single sequential read, see CziFile.
+      |  progress (_pylibczi.ReadProgress): Passed to all reads, to follow or cancel them, see CziFile.
       |  verbose (bool): Print information and times during czi file access.
 
     .. note::
@@ -67,17 +68,20 @@ class CziScene(CziFile):
             "/ImageDocument/Metadata/MetadataNodes/MetadataNode/Layers/Layer[@Name = \"CAT_ROI\"]/Elements/Polygon",
         }
 
-    def __init__(self, czi_filename, scene=1, ribbon=0, metafile_out='', tifffile_out='', verbose=False):
-        CziFile.__init__(self, czi_filename, metafile_out=metafile_out)
+    def __init__(self, czi_filename, scene=1, ribbon=0, metafile_out='', tifffile_out='', use_pylibczi=True,
+            readahead=0, progress=None, verbose=False):
+        CziFile.__init__(self, czi_filename, metafile_out=metafile_out, use_pylibczi=use_pylibczi, readahead=readahead,
+            progress=progress)
         self.scene, self.ribbon = scene-1, ribbon-1
         self.tifffile_out = tifffile_out
         self.cziscene_verbose = verbose
         self.meta_loaded = False
         self.scene_loaded = False
 
-        if not self.use_pylibczi:
-            # czi file object with image data and meta
-            self.czi = self.czilib.CziFile(self.czi_filename)
+    def _init_args(self):
+        return dict(czi_filename=self.czi_filename, scene=self.scene+1, ribbon=self.ribbon+1,
+            metafile_out=self.metafile_out, tifffile_out=self.tifffile_out, use_pylibczi=self.use_pylibczi,
+            readahead=self.readahead, verbose=self.cziscene_verbose)
 
     def read_scene_meta(self):
         """Extract metadata from czifile relevant for scene.
@@ -119,6 +123,8 @@ class CziScene(CziFile):
         assert(found) # bad scene number
         center_position = center_positions[load_scene,:]
         contour_size = contour_sizes[load_scene,:]
+        # the scene bounding box in global (stage) coordinates as stored in the meta data.
+        self.scene_stage_corner = center_position - contour_size/2; self.scene_stage_size = contour_size
         all_scenes_position = (center_positions - contour_sizes/2).min(axis=0)
         all_scenes_size = (center_positions + contour_sizes/2).max(axis=0)
 
@@ -167,6 +173,8 @@ class CziScene(CziFile):
 
         # calculate the rotation angle of the rectangle defined by the markers relative to the global coordinate frame
         # get the two markers that are furthest away from each other
+        import scipy.spatial.distance as scidist
+
         assert(self.nmarkers==3) # wrote this code assuming the markers are three corners of a rectangle
         D = scidist.squareform(scidist.pdist(marker_points)); #diag_dist = D.max()
         other_inds = np.array(np.unravel_index(np.argmax(D), (self.nmarkers,self.nmarkers)))
@@ -210,15 +218,20 @@ class CziScene(CziFile):
         sel = np.logical_and(box_corners_pix >= 0, box_corners_pix + box_sizes_pix <= self.scene_size_pix).all(axis=1)
         self.box_corners_pix = box_corners_pix[sel,:]; self.box_sizes_pix = box_sizes_pix[sel,:]
         self.nboxes = sel.sum()
+        # the ribbon numbers (starting at 1) of the selection boxes within the scene
+        self.box_ribbons = np.nonzero(sel)[0] + 1
+
+        # assign each polygon to a ribbon based on proximity (index of the closest selection box).
+        bctrs = box_corners_pix + box_sizes_pix/2
+        polygons_ribbons = self._polys_to_ribbons(polygons_points, bctrs)
+        rois_ribbons = self._polys_to_ribbons(rois_points, bctrs)
 
         # optionally crop out one of the selection boxes (ribbons)
         if self.ribbon >= 0:
             # this requires a special feature because in rare cases the ribbon was not placed properly.
-            # assign each polygon to a ribbon based on proximity and
-            #   then get bouding boxes of polygons assigned to the specified ribbon.
-            bctrs = box_corners_pix + box_sizes_pix/2
-            pmin, pmax = self._polys_to_ribbon_box(polygons_points, bctrs)
-            rmin, rmax = self._polys_to_ribbon_box(rois_points, bctrs)
+            #   get bouding boxes of polygons assigned to the specified ribbon.
+            pmin, pmax = self._polys_to_ribbon_box(polygons_points, polygons_ribbons)
+            rmin, rmax = self._polys_to_ribbon_box(rois_points, rois_ribbons)
 
             # take the bounding box that encompasses the ribbon and the calculated polygon bounding boxes
             amin = np.vstack((pmin[None,:]-1, rmin[None,:]-1, box_corners_pix[self.ribbon,:][None,:])).min(0)
@@ -229,12 +242,16 @@ class CziScene(CziFile):
             self.scene_size_pix = np.round(amax-amin).astype(np.int64)
             # now there is only one box for the scene
             self.nboxes = 1; self.box_corners_pix = np.zeros((1,2)); self.box_sizes_pix = self.scene_size_pix[None,:]
+            self.box_ribbons = np.array([self.ribbon+1])
 
         # get the polygon and roi points relative to the specified scene or ribbon
-        self.polygons_points, self.polygons_rotation = self._transform_polygons(polygons_points, polygons_rotation)
+        self.polygons_points, self.polygons_rotation, sel = self._transform_polygons(polygons_points,
+            polygons_rotation)
         self.npolygons = len(self.polygons_points)
-        self.rois_points, self.rois_rotation = self._transform_polygons(rois_points, rois_rotation)
+        self.rois_points, self.rois_rotation, rsel = self._transform_polygons(rois_points, rois_rotation)
         self.nROIs = len(self.rois_points)
+        # the ribbon numbers (starting at 1, 0 without selection boxes) the polygons within the scene are assigned to
+        self.polygons_ribbons = polygons_ribbons[sel] + 1; self.rois_ribbons = rois_ribbons[rsel] + 1
 
         self.meta_loaded = True
         if self.cziscene_verbose:
@@ -246,16 +263,22 @@ class CziScene(CziFile):
                                                                                     self.nboxes, load_scene+1))
 
     # helper function for read_scene_meta
-    def _polys_to_ribbon_box(self, polygons_points, box_centers):
+    def _polys_to_ribbons(self, polygons_points, box_centers):
+        import scipy.spatial.distance as scidist
+
         npolygons = len(polygons_points)
+        if npolygons == 0 or len(box_centers) == 0: return -np.ones((npolygons,), dtype=np.int64)
         # calculate the distance from all polygon centers to all ribbon centers.
         pctrs = np.zeros((npolygons,2), dtype=np.double)
         for i in range(npolygons):
             p = polygons_points[i] - self.scene_corner_pix; m = p.min(0); pctrs[i,:] = m + (p.max(0) - m)/2
         # categorize each polygon as belonging to the closest ribbon center.
-        d = scidist.cdist(box_centers,pctrs); pbox = np.argmin(d, axis=0)
+        d = scidist.cdist(box_centers,pctrs); return np.argmin(d, axis=0)
+
+    # helper function for read_scene_meta
+    def _polys_to_ribbon_box(self, polygons_points, polygons_ribbons):
         # select all the polygons for the specified ribbon and get bounding box
-        inds = np.nonzero(pbox == self.ribbon)[0]
+        inds = np.nonzero(polygons_ribbons == self.ribbon)[0]
         pmin = np.empty((2,), dtype=np.double); pmin.fill(np.inf)
         pmax = np.empty((2,), dtype=np.double); pmax.fill(-np.inf)
         for i in inds:
@@ -290,14 +313,16 @@ class CziScene(CziFile):
 
         # remove polyons outside of scene
         rpolygons_points = [rpolygons_points[x] for x in np.nonzero(polygons_inscene)[0]]
-        return rpolygons_points, polygons_rotation[polygons_inscene]
+        return rpolygons_points, polygons_rotation[polygons_inscene], polygons_inscene
 
-    def read_scene_image(self):
+    def read_scene_image(self, max_bytes=None):
         """Load scene image from czifile. Loads metadata if not currently loaded.
 
         Args:
 
         Kwargs:
+          |  max_bytes (int): Raise MemoryError before reading if the image would be larger than this (see plan_read).
+          |      Only supported with pylibczi.
 
         Attributes Modified:
           |  img (m,n,nchan ndarray): The loaded image data with data type matching that of the image.
@@ -314,17 +339,20 @@ class CziScene(CziFile):
         if self.use_pylibczi:
             if self.nscenes==1:
                 # meh, thanks Zeiss, determined empirically, need flag?
-                img = self.czilib.cziread_scene(self.czi_filename, np.zeros((1,), dtype=np.int64))
+                img = self.czilib.cziread_scene(self.czi_filename, np.zeros((1,), dtype=np.int64),
+                    readahead=self.readahead, max_bytes=max_bytes, progress=self.progress)
             else:
                 docrop = False
                 self.img = self.czilib.cziread_scene(self.czi_filename,
-                    np.concatenate((self.scene_corner_pix, self.scene_size_pix)))
+                    np.concatenate((self.scene_corner_pix, self.scene_size_pix)), readahead=self.readahead,
+                    max_bytes=max_bytes, progress=self.progress)
         else:
-            # xxx - is there a way to just read one "scene" without importing all the data?
-            #   this question only pertains to CziFile, cziread_scene above does this.
-            # (?, scenes, ?, xdim, ydim, colors?)
-            img = np.squeeze(self.czi.asarray()[:,load_scene,:,:,:])
-            assert( img.ndim == 2 ) # multiple colors or other dims?
+            # only the subblocks of the scene (or in the scene box) are read, same as with cziread_scene above.
+            if self.nscenes==1:
+                img, _ = self._czifile_read(scene=0)
+            else:
+                docrop = False
+                self.img, _ = self._czifile_read(np.concatenate((self.scene_corner_pix, self.scene_size_pix)))
         if docrop:
             # crop out the scene
             self.img = img[self.scene_corner_pix[1]:self.scene_corner_pix[1]+self.scene_size_pix[1],
@@ -336,6 +364,317 @@ class CziScene(CziFile):
         if self.cziscene_verbose:
             print('\tScene size is %d x %d' % (self.img.shape[0], self.img.shape[1]))
 
+    def read_scene_image_ds(self, ds, reduce=np.mean, dtype=None, window=None, window_percentile=None, lut=None,
+                            rgb=False, max_bytes=None, coarsen=False):
+        """Get the scene image downsampled by an integer factor and optionally converted for display.
+
+        If the scene is not loaded, with pylibczi the scene is downsampled and converted while it is read, the full
+        resolution scene image is never allocated (and it is not loaded afterwards either).
+
+        Args:
+          |  ds (int): Downsampling reduce factor, 1 to only convert.
+
+        Kwargs:
+          |  reduce (func or str): Function to use for block-reduce downsampling, np.mean, np.max or 'stride' (every
+          |      ds-th pixel) are read natively, results are the same as skimage block_reduce followed by astype
+          |      (float32 means up to rounding, see CziFile.downsample_image).
+          |  dtype (numpy dtype): Output data type (uint8, uint16 or float32), defaults to the image data type.
+          |  window (tuple): Intensity window (lo, hi) that is mapped to the output range, see CziFile.convert_image.
+          |  window_percentile (tuple): Percentiles (lo, hi) of the scene intensities to use as the window, see stats.
+          |  lut (1d ndarray): Lookup table from image values to output values.
+          |  rgb (bool): Reverse the channels of color images (BGR to RGB).
+          |  max_bytes (int): Raise MemoryError before reading if the image would be larger than this (see plan_read).
+          |      If the full resolution scene has to be loaded (reduce not native), it is checked against its size.
+          |  coarsen (bool): Instead of raising, increase ds until the downsampled image fits into max_bytes.
+
+        Returns:
+          |  (m/ds,n/ds,nchan ndarray):  The downsampled scene image.
+
+        """
+        if not self.meta_loaded: self.read_scene_meta()
+        native = self.use_pylibczi and not self.scene_loaded and CziFile.native_reduce.get(reduce) is not None
+        if native:
+            box = self._scene_box()
+            if max_bytes is not None:
+                convert = any(x is not None for x in [dtype, window, window_percentile, lut]) or rgb
+                plan = self.plan_read(box, zoom=1./ds, dtype=dtype, reduce=reduce, convert=convert)
+                if coarsen and plan['bytes'] > max_bytes:
+                    # smallest ds for which the image and the buffers of the read fit, the size only depends on the
+                    #   box, the pixel sizes and the reduction.
+                    pixel_bytes = plan['dtype'].itemsize*(plan['shape'][2] if len(plan['shape']) > 2 else 1)
+                    def size(ds):
+                        shape = (-(-int(box[3]) // ds), -(-int(box[2]) // ds)) + plan['shape'][2:]
+                        return shape[0]*shape[1]*pixel_bytes + CziFile._reduce_bytes(shape, plan['image_dtype'], ds,
+                            reduce, convert)
+                    ds = max(ds, int(np.ceil(ds*np.sqrt(plan['bytes'] / max_bytes))) - 1)
+                    while size(ds) > max_bytes and ds < box[2:].max(): ds += 1
+                    CziFile._check_bytes(size(ds), max_bytes)
+                    if self.cziscene_verbose:
+                        print('\tcoarsened to ds %d to fit into %d bytes' % (ds, max_bytes))
+                else:
+                    CziFile._check_bytes(plan['bytes'], max_bytes)
+        elif not self.scene_loaded:
+            self.read_scene_image(max_bytes=max_bytes)
+
+        if window_percentile is not None:
+            pct = self.stats(percentiles=window_percentile)['percentiles']
+            window = (pct[:,0].min(), pct[:,1].max())
+        convert = dict(dtype=dtype, window=window, lut=lut, rgb=rgb)
+
+        if not native:
+            img = CziFile.downsample_image(self.img, ds, reduce=reduce)
+            if any(x is not None for x in [dtype, window, lut]) or rgb:
+                img = CziFile.convert_image(img, **convert)
+            return img
+
+        if self.cziscene_verbose:
+            print('Loading czi image for scene %d downsampled by %d' % (self.scene+1, ds)); t = time.time()
+        img = self.czilib.cziread_scene(self.czi_filename, box, readahead=self.readahead, ds=ds,
+            reduce=CziFile.native_reduce[reduce], max_bytes=max_bytes, progress=self.progress, **convert)
+        if self.cziscene_verbose:
+            print('\tdone in %.4f s' % (time.time() - t, ))
+        return img
+
+    def plan_read(self, scene_or_box=None, zoom=1., channels=None, dtype=None, reduce=np.mean, convert=None):
+        """Estimate the cost of reading the scene without reading any pixels, see CziFile.plan_read.
+
+        Kwargs:
+          |  scene_or_box (int or 1d ndarray): Defaults to the box of the scene (or ribbon) instead of all subblocks.
+
+        """
+        if scene_or_box is None:
+            if not self.meta_loaded: self.read_scene_meta()
+            scene_or_box = self._scene_box()
+        return CziFile.plan_read(self, scene_or_box, zoom=zoom, channels=channels, dtype=dtype, reduce=reduce,
+            convert=convert)
+
+    def stats(self, bins=256, zoom=1., percentiles=(0.1, 1, 50, 99, 99.9), threads=0, catalog=None):
+        """Per channel intensity statistics and histograms of the scene.
+
+        With pylibczi the statistics are accumulated while the subblocks are decoded (in parallel), the scene image
+        is never composed and memory use does not depend on the scene size (so there is no max_bytes, the fine
+        histograms of each thread take 8 bytes per bin and channel). Only pixels covered by subblocks are counted.
+        The histogram range of float images is not known beforehand, so their subblocks are read and decoded twice,
+        first for the min and max. Otherwise (czifile) they are computed from the loaded scene image, whatever its
+        size.
+
+        Kwargs:
+          |  bins (int): Number of histogram bins between the min and max.
+          |  zoom (float): Only use every round(1/zoom)-th row and column, min and max are exact for zoom 1.
+          |  percentiles (list of float): Percentiles to return, from a histogram with one bin per value for integer
+          |      images (exact, lower value as numpy 'inverted_cdf') or 65536 bins for float images (interpolated).
+          |  threads (int): Number of decoding threads, 0 to use all cpus.
+          |  catalog (CziCatalog): Catalog to keep the statistics in, they are only computed again if the file changed.
+
+        Returns:
+          |  (dict):  count, min, max, mean, std (nchan arrays), histogram (nchan,bins), bin_edges (bins+1),
+          |      percentiles (nchan,npercentiles).
+
+        """
+        if not self.meta_loaded: self.read_scene_meta()
+        step = max(1, int(round(1./zoom)))
+        cache = catalog is not None and isinstance(self.czi_filename, str)
+        fine = catalog.query_stats(self.czi_filename, self.scene+1, self.ribbon+1, step) if cache else None
+
+        if fine is None:
+            if self.cziscene_verbose:
+                print('Computing statistics for scene %d' % (self.scene+1,)); t = time.time()
+            if self.use_pylibczi:
+                fine = self.czilib.cziread_stats(self.czi_filename, self._scene_box(), step=step, threads=threads,
+                    readahead=self.readahead, progress=self.progress)
+            else:
+                if not self.scene_loaded: self.read_scene_image()
+                fine = CziScene._image_stats(self.img[::step,::step])
+            if self.cziscene_verbose:
+                print('\tdone in %.4f s' % (time.time() - t, ))
+            if cache: catalog.store_stats(self.czi_filename, self.scene+1, self.ribbon+1, step, fine)
+
+        return CziScene._reduce_stats(fine, bins, percentiles)
+
+    # helper function for stats without pylibczi, same fine histograms as cziread_stats.
+    @staticmethod
+    def _image_stats(img):
+        v = img.reshape(-1, img.shape[2] if img.ndim == 3 else 1)
+        stats = {'count':np.full((v.shape[1],), v.shape[0], dtype=np.int64), 'min':v.min(0).astype(np.double),
+                 'max':v.max(0).astype(np.double), 'mean':v.mean(0, dtype=np.double), 'std':v.std(0, dtype=np.double)}
+        stats['integer'] = issubclass(img.dtype.type, np.integer)
+        if stats['integer']:
+            n = np.iinfo(img.dtype).max + 1
+            stats['histogram'] = np.array([np.bincount(v[:,c], minlength=n) for c in range(v.shape[1])])
+            stats['bin_edges'] = np.arange(n + 1, dtype=np.double)
+        else:
+            lo, hi = stats['min'].min(), stats['max'].max()
+            if not hi > lo: hi = lo + 1
+            stats['bin_edges'] = np.linspace(lo, hi, 65537)
+            stats['histogram'] = np.array([np.histogram(v[:,c], bins=stats['bin_edges'])[0]
+                                           for c in range(v.shape[1])])
+        return stats
+
+    # rebin the fine histograms and get the percentiles from them.
+    @staticmethod
+    def _reduce_stats(fine, bins, percentiles):
+        stats = dict((k, fine[k]) for k in ['count', 'min', 'max', 'mean', 'std'])
+        hist, edges, integer = fine['histogram'], fine['bin_edges'], bool(fine['integer'])
+        valid = stats['count'] > 0
+        lo = stats['min'][valid].min() if valid.any() else 0.
+        hi = stats['max'][valid].max() + (1 if integer else 0) if valid.any() else 1.
+        if not hi > lo: hi = lo + 1
+        stats['bin_edges'] = np.linspace(lo, hi, bins + 1)
+        stats['histogram'] = np.array([np.histogram(edges[:-1], bins=stats['bin_edges'], weights=h)[0]
+                                       for h in hist]).astype(np.int64)
+
+        percentiles = np.atleast_1d(np.asarray(percentiles, dtype=np.double))
+        stats['percentiles'] = np.full((hist.shape[0], percentiles.size), np.nan)
+        for c in range(hist.shape[0]):
+            n = stats['count'][c]
+            if n == 0: continue
+            cum = np.cumsum(hist[c,:])
+            target = np.maximum(np.ceil(percentiles/100*n), 1)
+            i = np.searchsorted(cum, target)
+            if integer:
+                stats['percentiles'][c,:] = edges[i]
+            else:
+                below = np.where(i > 0, cum[np.maximum(i-1, 0)], 0)
+                frac = (target - below)/np.maximum(hist[c,i], 1)
+                stats['percentiles'][c,:] = np.clip(edges[i] + frac*(edges[i+1] - edges[i]), stats['min'][c],
+                                                    stats['max'][c])
+        return stats
+
+    def read_polygons(self, inds=None, rois=False, mask=True, return_mask=False, threads=0, max_bytes=None):
+        """Read tight crops around section (or ROI) polygons without loading the whole scene.
+
+        Kwargs:
+          |  inds (list of int): Indices of the polygons to read, defaults to all polygons.
+          |  rois (bool): Read the ROI polygons instead of the section polygons.
+          |  mask (bool): Set pixels outside of the polygon to zero. With pylibczi this also means only subblocks
+          |      that contain pixels inside of the polygon are read.
+          |  return_mask (bool): Also return the polygon masks.
+          |  threads (int): Number of decoding threads with pylibczi, 0 for all cpus.
+          |  max_bytes (int): Raise MemoryError before reading if the crops and masks could be larger than this (from
+          |      the bounding boxes of the polygons). Only supported with pylibczi.
+
+        Returns:
+          |  (list of m,n,nchan ndarray):  The polygon crops.
+          |  (n,2 ndarray):  Top-left corner of each crop in pixels relative to the scene (as polygons_points).
+          |  (list of m,n bool ndarray):  If return_mask, the masks of pixels inside of the polygons (pixel centers
+          |      inside of the polygon or on its boundary, as skimage.draw.polygon).
+
+        """
+        if not self.meta_loaded: self.read_scene_meta()
+        points = self.rois_points if rois else self.polygons_points
+        if inds is None: inds = range(len(points))
+        if max_bytes is not None:
+            # the crops are at most the pixel bounding boxes of the polygons, plus one byte per pixel for the masks
+            plan = self.plan_read(self._scene_box())
+            pixel_bytes = plan['dtype'].itemsize*(plan['shape'][2] if len(plan['shape']) > 2 else 1) + 1
+            sizes = [np.maximum(np.floor(points[i].max(0)) - np.ceil(points[i].min(0)) + 1, 0) for i in inds]
+            npixels = int(sum(np.prod(x) for x in sizes))
+            CziFile._check_bytes(npixels*pixel_bytes, max_bytes)
+
+        if self.cziscene_verbose:
+            print('Loading %d polygons for scene %d' % (len(inds), self.scene+1,)); t = time.time()
+
+        if self.use_pylibczi:
+            # polygons in the coordinates of the subblocks
+            offset = self._scene_origin_pix() + self.scene_corner_pix
+            imgs, masks, corners = self.czilib.cziread_polygons(self.czi_filename, [points[i] + offset for i in inds],
+                mask=mask, readahead=self.readahead, progress=self.progress, threads=threads)
+            corners = corners - offset
+        else:
+            if not self.scene_loaded: self.read_scene_image()
+            imgs, masks = [None]*len(inds), [None]*len(inds)
+            corners = np.zeros((len(inds),2), dtype=np.int64)
+            for j,i in zip(range(len(inds)), inds):
+                m, corners[j,:] = CziScene._rasterize_polygon(points[i])
+                # pad where the polygon extends outside of the scene
+                img = np.zeros(m.shape + self.img.shape[2:], dtype=self.img.dtype)
+                c = corners[j,:]; b = np.maximum(c, 0); e = np.minimum(c + m.shape[::-1], self.img.shape[1::-1])
+                if (e > b).all():
+                    img[b[1]-c[1]:e[1]-c[1],b[0]-c[0]:e[0]-c[0]] = self.img[b[1]:e[1],b[0]:e[0]]
+                if mask: img[np.logical_not(m)] = 0
+                imgs[j] = img; masks[j] = m if mask else None
+
+        if self.cziscene_verbose:
+            print('\tdone in %.4f s' % (time.time() - t, ))
+
+        return (imgs, corners, masks) if return_mask else (imgs, corners)
+
+    def read_polygon(self, i, rois=False, mask=True, return_mask=False):
+        """Read a tight crop around a single section (or ROI) polygon, see read_polygons.
+
+        Args:
+          |  i (int): Index of the polygon.
+
+        Returns:
+          |  (m,n,nchan ndarray):  The polygon crop.
+          |  (2, array):  Top-left corner of the crop in pixels relative to the scene.
+          |  (m,n bool ndarray):  If return_mask, the mask of pixels inside of the polygon.
+
+        """
+        ret = self.read_polygons(inds=[i], rois=rois, mask=mask, return_mask=return_mask)
+        return tuple(x[0] for x in ret)
+
+    # helper function for read_polygons, offset of the scene pixel coordinates to the subblock coordinates
+    def _scene_box(self):
+        # box (x, y, w, h) of the scene in libCZI pixel coordinates.
+        box = np.concatenate((self._scene_origin_pix() + self.scene_corner_pix, self.scene_size_pix))
+        return box.astype(np.int64)
+
+    def _scene_origin_pix(self):
+        origin = np.zeros((2,), dtype=np.int64)
+        if self.nscenes == 1:
+            # single scenes are cropped from the libCZI scene image, which starts at the first subblock of the scene.
+            index = self.read_subblock_index(); sel = (index.S <= 0)
+            origin[0] = index.x[sel].min(); origin[1] = index.y[sel].min()
+        return origin
+
+    # helper function for read_polygons without pylibczi, same rasterization as cziread_polygons.
+    @staticmethod
+    def _rasterize_polygon(points):
+        # pixel centers are at integer coordinates, pixels are inside if their center is inside (even-odd rule) or
+        #   on the boundary, as with skimage.draw.polygon. the pixels next to the edges are decided with the skimage
+        #   test. returns the mask of the tight bounding box of the polygon pixels and its top-left corner.
+        points = np.asarray(points, dtype=np.double)
+        assert( np.isfinite(points).all() ) # polygon points must be finite
+        tol = 1e-6; vertices = [(float(x), float(y)) for x,y in points]
+        pmin = points.min(0); pmax = points.max(0)
+        x0 = int(np.floor(pmin[0])) - 1; y0 = int(np.ceil(pmin[1] - tol))
+        m = np.zeros((max(int(np.floor(pmax[1] + tol)) + 1 - y0, 0), int(np.ceil(pmax[0])) + 2 - x0), dtype=bool)
+        a = points; b = np.roll(points, -1, axis=0)
+        for row in range(m.shape[0]):
+            y = y0 + row
+            sel = np.logical_or(np.logical_and(a[:,1] <= y, y < b[:,1]), np.logical_and(b[:,1] <= y, y < a[:,1]))
+            xs = np.sort(a[sel,0] + (y - a[sel,1])*(b[sel,0] - a[sel,0])/(b[sel,1] - a[sel,1]))
+            for xa, xb in zip(xs[0::2], xs[1::2]):
+                m[row, int(np.ceil(xa)) - x0:int(np.ceil(xb)) - x0] = True
+            # pixels close to the edges, where rounding decides
+            near = np.logical_and(y >= np.minimum(a[:,1], b[:,1]) - tol, y <= np.maximum(a[:,1], b[:,1]) + tol)
+            for (ax, ay), (bx, by) in zip(a[near], b[near]):
+                lo, hi = min(ax, bx), max(ax, bx)
+                if abs(by - ay) > tol: lo = hi = min(max(ax + (y - ay)*(bx - ax)/(by - ay), lo), hi)
+                for x in range(int(np.floor(lo)) - 1, int(np.ceil(hi)) + 2):
+                    m[row, x - x0] = CziScene._point_in_polygon(vertices, x, y) > 0
+        ys, xs = np.nonzero(m)
+        if ys.size == 0:
+            return np.zeros((0,0), dtype=bool), np.ceil(pmin).astype(np.int64)
+        corner = np.array([x0 + xs.min(), y0 + ys.min()], dtype=np.int64)
+        return m[ys.min():ys.max()+1,xs.min():xs.max()+1], corner
+
+    @staticmethod
+    def _point_in_polygon(vertices, x, y):
+        # position of the point relative to the polygon, computed exactly as skimage point_in_polygon does:
+        #   0 outside, 1 inside, 2 vertex, 3 edge.
+        eps = 1e-12; l_cross = r_cross = 0
+        x1, y1 = vertices[-1][0] - x, vertices[-1][1] - y
+        for px, py in vertices:
+            x0, y0 = px - x, py - y
+            if -eps < x0 < eps and -eps < y0 < eps: return 2
+            if (y0 > 0) != (y1 > 0) and (x0*y1 - x1*y0)/(y1 - y0) > 0: r_cross += 1
+            if (y0 < 0) != (y1 < 0) and (x0*y1 - x1*y0)/(y1 - y0) < 0: l_cross += 1
+            x1, y1 = x0, y0
+        if r_cross % 2 != l_cross % 2: return 3
+        return r_cross % 2
+
     def get_scene_info(self):
         """Access function for returning image and scene information.
 
@@ -360,21 +699,21 @@ class CziScene(CziFile):
         Kwargs:
           |  figno (int): Figure number to use.
           |  doplots_ds (int): Downsampling reduce factor before plotting.
-          |  reduce (func): Function to use for block-reduce downsampling.
+          |  reduce (func or str): Function to use for block-reduce downsampling, see read_scene_image_ds.
           |  interp_string (str): Interpolation string for matplotlib imshow.
           |  show (bool): Whether to show images or return immediately.
 
+        .. note::
+
+            If the scene is not loaded, with pylibczi only the downsampled scene is read.
+
         """
         from matplotlib import pylab as pl
         import matplotlib.patches as patches
-        import skimage.measure as measure
-
-        if not self.scene_loaded: self.read_scene_image()
 
         if self.cziscene_verbose:
             print('\tblock reduce plot'); t = time.time()
-        img_ds = measure.block_reduce(self.img, block_size=(doplots_ds, doplots_ds),
-                                      func=reduce).astype(self.img.dtype) if doplots_ds > 1 else self.img
+        img_ds = self.read_scene_image_ds(doplots_ds, reduce=reduce)
         if self.cziscene_verbose:
             print('\t\tdone in %.4f s' % (time.time() - t, ))
 
@@ -403,18 +742,21 @@ class CziScene(CziFile):
 
         Kwargs:
           |  save_tiff_ds (int): Downsampling reduce factor before exporting.
+          |  reduce (func or str): Function to use for block-reduce downsampling, see read_scene_image_ds.
           |  fn (str): Filename of tiff to export (default to filename provided in init)
 
+        .. note::
+
+            If the scene is not loaded, with pylibczi only the downsampled scene is read.
+
         """
-        import skimage.measure as measure
         import tifffile
 
         if fn is None: fn = self.tifffile_out
         # figure out BIG tiff
         if self.cziscene_verbose:
             print('Writing out imagej tiff'); t = time.time()
-        img_ds = measure.block_reduce(self.img, block_size=(save_tiff_ds, save_tiff_ds), func=reduce)\
-            .astype(self.img.dtype) if save_tiff_ds > 1 else self.img
+        img_ds = self.read_scene_image_ds(save_tiff_ds, reduce=reduce)
         tifffile.imsave(fn,img_ds,imagej=True)
         if self.cziscene_verbose:
             print('\tdone in %.4f s' % (time.time() - t, ))
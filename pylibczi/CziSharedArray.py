@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+# This file is part of pylibczi.
+# Copyright (c) 2018 Center of Advanced European Studies and Research (caesar)
+#
+# pylibczi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pylibczi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
+
+# Transfer of images from worker processes through shared memory instead of pickling the pixels.
+
+import numpy as np
+import functools
+import os
+
+class CziSharedArray(object):
+    """Numpy array in shared memory that pickles as a reference to it, for returning images from worker processes.
+
+    The array is copied once into a new shared memory block, only the block name, shape and dtype are pickled. The
+    process that unpickles it maps the block without another copy and owns it, the block is freed by close (or when
+    the CziSharedArray is deleted there), the memory is released when the arrays from asarray are deleted as well.
+    Requires python 3.8 (multiprocessing.shared_memory).
+
+    Args:
+      |  array (ndarray): The array to share.
+
+    .. note::
+
+       Unpickle each CziSharedArray only once, the block is freed when the first receiver closes it.
+
+    """
+
+    def __init__(self, array):
+        from multiprocessing import shared_memory
+
+        array = np.asarray(array)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.name, self.shape, self.dtype = self._shm.name, array.shape, array.dtype
+        np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)[...] = array
+        # the block belongs to this process until it is pickled, then to the receiving process.
+        self._owner = True
+        self._tracked = os.name == 'posix'
+
+    def __getstate__(self):
+        if self._tracked:
+            # hand the block over to the receiver, which registers it when it maps it. otherwise the resource tracker of
+            #   the sender (own tracker for spawned workers) would try to free it again when the sender exits.
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister('/' + self.name, 'shared_memory')
+            self._tracked = False
+        self._owner = False
+        return (self.name, self.shape, self.dtype)
+
+    def __setstate__(self, state):
+        self.name, self.shape, self.dtype = state
+        self._shm = None
+        self._owner = True
+        self._tracked = False
+
+    def asarray(self):
+        """Map the shared memory block.
+
+        Returns:
+          |  (ndarray):  Array on the shared memory, the mapping is kept as long as the array is referenced.
+
+        """
+        if self._shm is None:
+            from multiprocessing import shared_memory
+            self._shm = shared_memory.SharedMemory(name=self.name)
+        self._owner = True
+        return np.asarray(_SharedBuffer(self._shm, self.shape, self.dtype))
+
+    def close(self):
+        """Free the shared memory block if this process owns it, arrays from asarray stay valid."""
+        if self._owner:
+            if self._shm is None: self.asarray()
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+            self._owner = False
+        # the mapping is closed by the SharedMemory when neither this nor any of the arrays references it.
+        self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        # after the block was sent, the creating process only releases its mapping.
+        if getattr(self, '_owner', False): self.close()
+
+    @staticmethod
+    def share(result):
+        """Wrap the arrays in a result (array, tuple or list, also nested) so that they are sent in shared memory."""
+        if isinstance(result, np.ndarray):
+            return CziSharedArray(result)
+        elif isinstance(result, (tuple, list)):
+            return type(result)(CziSharedArray.share(x) for x in result)
+        return result
+
+    @staticmethod
+    def receive(result):
+        """Replace the CziSharedArrays in a result (see share) with the arrays, freeing the shared memory blocks."""
+        if isinstance(result, CziSharedArray):
+            with result:
+                return result.asarray()
+        elif isinstance(result, (tuple, list)):
+            return type(result)(CziSharedArray.receive(x) for x in result)
+        return result
+
+    @staticmethod
+    def returning(func):
+        """Wrap a worker function so that the arrays it returns are sent back in shared memory (see share).
+
+        Args:
+          |  func (func): Picklable function, e.g. to pass to multiprocessing.Pool.map.
+
+        Returns:
+          |  (func):  Picklable function with the same arguments that returns the shared result.
+
+        """
+        return functools.partial(_call_shared, func)
+
+class _SharedBuffer(object):
+    # exposes the shared memory to numpy through the array interface and keeps the SharedMemory referenced.
+    #   unlike a buffer export this does not prevent the SharedMemory from closing once the arrays are deleted.
+    def __init__(self, shm, shape, dtype):
+        self.shm = shm
+        data = np.frombuffer(shm.buf, dtype=np.uint8).ctypes.data
+        self.__array_interface__ = {'version': 3, 'shape': tuple(shape), 'typestr': np.dtype(dtype).str,
+            'descr': np.dtype(dtype).descr, 'data': (data, False)}
+
+def _call_shared(func, *args, **kwargs):
+    return CziSharedArray.share(func(*args, **kwargs))
@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+
+# This file is part of pylibczi.
+# Copyright (c) 2018 Center of Advanced European Studies and Research (caesar)
+#
+# pylibczi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pylibczi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
+
+# Local http server for DeepZoom and XYZ tiles of czi scenes, read and downsampled on demand.
+
+import numpy as np
+import argparse
+import collections
+import concurrent.futures
+import http.server
+import json
+import os
+import re
+import struct
+import threading
+import time
+import urllib.parse
+import zlib
+
+# xxx - some better way to handle import if running from command line?
+try:
+    from .CziScene import CziScene
+except ImportError as exc:
+    from CziScene import CziScene
+
+class CziTileServer(object):
+    """Serve tiles of czi scenes over http, for browser viewers (e.g. OpenSeadragon or Leaflet) on localhost.
+
+    Tiles are read when they are requested, downsampled while the subblocks are composed (see
+    CziScene.read_scene_image_ds) and converted to 8 bit with an intensity window from the scene statistics. Each file
+    is kept open in a CziReader, encoded tiles are kept in a least recently used cache and requests are handled by
+    a pool of threads (decoding does not hold the GIL). The cache holds the encoded tiles instead of the decoded
+    pixels, a hit is served without reading or encoding again, each tile format and window is cached separately.
+
+    Scenes and channels are the S and C indices of the subblocks (starting at 0, scene 0 for files without scenes),
+    the urls are:
+
+      |  /                                                  json index of the files, scenes, channels and sizes
+      |  /metrics                                           json request latencies and cache statistics
+      |  /file/scene/channel.dzi                            DeepZoom descriptor
+      |  /file/scene/channel_files/level/col_row.png        DeepZoom tile (also .jpg)
+      |  /file/scene/channel/z/x/y.png                      XYZ tile, z 0 is the whole scene in one tile
+
+    Tiles take the query parameter window=lo,hi to override the intensity window. Cross-origin requests (e.g. from
+    a viewer served on another port) are only allowed for the origin given by allow_origin.
+
+    Args:
+      |  czi_filenames (list): Czi files to serve (filenames or any source accepted by CziFile), the file is the index.
+
+    Kwargs:
+      |  host (str): Address to listen on, only localhost by default.
+      |  port (int): Port to listen on, 0 to pick a free port (see url).
+      |  tile_size (int): Size of the tiles in pixels.
+      |  overlap (int): Overlap of the DeepZoom tiles in pixels.
+      |  tile_format (str): Format of the DeepZoom tiles, png or jpg (needs pillow).
+      |  threads (int): Number of request threads, 0 to use all cpus.
+      |  cache_size (int): Maximum size in bytes of the cached encoded tiles.
+      |  window_percentile (tuple): Percentiles (lo, hi) of the scene intensities to use as the default window, None
+      |      to only clip the values to 8 bit.
+      |  readahead (int): Maximum size in bytes of a single sequential read, see CziFile.
+      |  allow_origin (str): Value of the Access-Control-Allow-Origin header (e.g. http://localhost:8080 or * for
+      |      any origin), None to not send it so that browsers block cross-origin requests.
+      |  verbose (bool): Print the requests.
+
+    """
+
+    # number of pixels along the long side of the scene to use for the intensity statistics
+    stats_size = 2048
+
+    # number of request latencies kept for the metrics
+    nlatencies = 10000
+
+    def __init__(self, czi_filenames, host='127.0.0.1', port=0, tile_size=256, overlap=0, tile_format='png',
+            threads=0, cache_size=256*2**20, window_percentile=(0.1, 99.9), readahead=0, allow_origin=None,
+            verbose=False):
+        import _pylibczi
+        self.czilib = _pylibczi
+        self.tile_size, self.overlap = tile_size, overlap
+        self.tile_format = self._tile_format(tile_format)
+        self.window_percentile = window_percentile
+        self.readahead = readahead
+        self.allow_origin = allow_origin
+        self.verbose = verbose
+
+        # the readers are opened on the first request for the file and stay open.
+        self.files = []
+        for x in czi_filenames:
+            reader = x if isinstance(x, self.czilib.CziReader) else self.czilib.CziReader(x, lazy=True)
+            self.files.append({'filename':str(x.source if reader is x else x), 'reader':reader, 'scenes':None})
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.cache = _TileCache(cache_size)
+
+        self.latencies = collections.deque(maxlen=self.nlatencies)
+        self.nrequests, self.nerrors, self.ntiles_read, self.read_time = 0, 0, 0, 0.
+
+        if threads <= 0: threads = os.cpu_count() or 1
+        self.httpd = _PoolHTTPServer((host, port), _TileRequestHandler, threads)
+        self.httpd.tile_server = self
+        self.thread = None
+
+    @property
+    def url(self):
+        """Base url of the server."""
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def serve_forever(self):
+        """Handle requests until shutdown is called (from another thread) or the process is interrupted."""
+        self.httpd.serve_forever()
+
+    def start(self):
+        """Handle requests in a background thread, e.g. for notebooks and tests."""
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def shutdown(self):
+        """Stop handling requests and release the port and the threads."""
+        if self.thread is not None:
+            self.httpd.shutdown()
+            self.thread.join(); self.thread = None
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def scenes(self, file):
+        """Scene bounding boxes and channels of a file, from the subblock directory.
+
+        Args:
+          |  file (int): Index of the file.
+
+        Returns:
+          |  (dict):  For each scene a dict with box (x, y, w, h in pixels), channels (list) and levels (number of
+          |      DeepZoom levels).
+
+        """
+        info = self.files[file]
+        with self.lock:
+            if info['scenes'] is None:
+                index = self.czilib.cziread_subblock_index(info['reader'])
+                # only the full resolution subblocks, the same that the scenes are composed from.
+                sel = (index['pyramid_type'] == 0) & (index['w'] == index['stored_w']) & \
+                    (index['h'] == index['stored_h'])
+                if not sel.any(): sel[:] = True
+                scenes = {}
+                for s in np.unique(index['S'][sel]):
+                    ssel = sel & (index['S'] == s)
+                    x0, y0 = index['x'][ssel].min(), index['y'][ssel].min()
+                    x1, y1 = (index['x'] + index['w'])[ssel].max(), (index['y'] + index['h'])[ssel].max()
+                    box = [int(x0), int(y0), int(x1 - x0), int(y1 - y0)]
+                    channels = [max(int(c), 0) for c in np.unique(index['C'][ssel])]
+                    scenes[max(int(s), 0)] = {'box':box, 'channels':channels,
+                        'levels':int(np.ceil(np.log2(max(box[2], box[3], 1)))) + 1}
+                info['scenes'] = scenes
+            return info['scenes']
+
+    def dzi(self, file, scene, channel):
+        """DeepZoom descriptor of a scene.
+
+        Args:
+          |  file (int): Index of the file.
+          |  scene (int): Scene (S index).
+          |  channel (int): Channel (C index).
+
+        Returns:
+          |  (str):  The dzi xml.
+
+        """
+        box = self._scene(file, scene, channel)['box']
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" ' +
+            'Format="%s" Overlap="%d" TileSize="%d"><Size Width="%d" Height="%d"/></Image>\n') % \
+            (self.tile_format, self.overlap, self.tile_size, box[2], box[3])
+
+    def get_tile(self, file, scene, channel, level, col, row, tile_format=None, window=None, xyz=False):
+        """Get an encoded tile, from the cache or read from the czi file.
+
+        Args:
+          |  file (int): Index of the file.
+          |  scene (int): Scene (S index).
+          |  channel (int): Channel (C index).
+          |  level (int): DeepZoom level (0 is a single pixel) or XYZ zoom (0 is the scene in one tile).
+          |  col (int): Column of the tile.
+          |  row (int): Row of the tile.
+
+        Kwargs:
+          |  tile_format (str): png or jpg, defaults to the server tile_format.
+          |  window (tuple): Intensity window (lo, hi), defaults to the window from the scene statistics.
+          |  xyz (bool): XYZ tiles (always tile_size, without overlap) instead of DeepZoom tiles.
+
+        Returns:
+          |  (bytes):  The encoded tile.
+
+        """
+        tile_format = self._tile_format(tile_format or self.tile_format)
+        sinfo = self._scene(file, scene, channel)
+        if window is None: window = self._window(file, scene, channel)
+        box, ds, pad = self._tile_box(sinfo, level, col, row, xyz)
+        key = (file, scene, channel, level, col, row, xyz, tile_format, None if window is None else tuple(window))
+        return self.cache.get(key, lambda: self._encode(self._read_tile(file, channel, box, ds, window, pad),
+            tile_format))
+
+    def metrics(self):
+        """Request and cache metrics.
+
+        Returns:
+          |  (dict):  requests, errors, latency_ms (mean and percentiles of the last requests), tiles_read,
+          |      read_time_s (total time reading tiles) and cache (hits, misses, hit_rate, entries, bytes, capacity).
+
+        """
+        with self.lock:
+            lat = np.array(self.latencies, dtype=np.double)*1000
+            ret = {'requests':self.nrequests, 'errors':self.nerrors, 'tiles_read':self.ntiles_read,
+                'read_time_s':self.read_time}
+        pct = np.percentile(lat, [50, 90, 99]) if lat.size > 0 else np.zeros((3,))
+        ret['latency_ms'] = {'count':int(lat.size), 'mean':float(lat.mean()) if lat.size > 0 else 0.,
+            'p50':float(pct[0]), 'p90':float(pct[1]), 'p99':float(pct[2]),
+            'max':float(lat.max()) if lat.size > 0 else 0.}
+        ret['cache'] = self.cache.metrics()
+        return ret
+
+    def index(self):
+        """Files with their scenes, see scenes."""
+        return [{'file':i, 'filename':x['filename'], 'scenes':self.scenes(i)} for i,x in enumerate(self.files)]
+
+    def _scene(self, file, scene, channel):
+        if file < 0 or file >= len(self.files): raise KeyError('no file %d' % (file,))
+        sinfo = self.scenes(file).get(scene)
+        if sinfo is None: raise KeyError('no scene %d in file %d' % (scene, file))
+        if channel not in sinfo['channels']: raise KeyError('no channel %d in scene %d' % (channel, scene))
+        return sinfo
+
+    def _window(self, file, scene, channel):
+        # default intensity window of the scene channel, from a subsampled histogram (computed once).
+        if self.window_percentile is None: return None
+        key = (file, scene, channel)
+        with self.lock:
+            window = self.windows.get(key)
+        if window is None:
+            box = self._scene(file, scene, channel)['box']
+            step = max(1, max(box[2], box[3]) // self.stats_size)
+            fine = self.czilib.cziread_stats(self.files[file]['reader'], np.array(box, dtype=np.int64), step=step,
+                channel=channel, readahead=self.readahead)
+            pct = CziScene._reduce_stats(fine, 1, self.window_percentile)['percentiles']
+            window = (float(pct[:,0].min()), float(pct[:,1].max()))
+            if window[1] <= window[0]: window = (window[0], window[0] + 1)
+            with self.lock:
+                self.windows[key] = window
+        return window
+
+    def _tile_box(self, sinfo, level, col, row, xyz):
+        # box of the tile in full resolution pixels, the downsampling and the padded size (xyz tiles).
+        x, y, w, h = sinfo['box']
+        if xyz:
+            nzoom = max(0, int(np.ceil(np.log2(max(w, h) / self.tile_size))))
+            if level < 0 or level > nzoom: raise KeyError('no zoom %d' % (level,))
+            ds = 2**(nzoom - level); overlap = 0
+        else:
+            if level < 0 or level >= sinfo['levels']: raise KeyError('no level %d' % (level,))
+            ds = 2**(sinfo['levels'] - 1 - level); overlap = self.overlap
+        size = [-(-w // ds), -(-h // ds)]
+        beg = [col*self.tile_size - overlap, row*self.tile_size - overlap]
+        if col < 0 or row < 0 or beg[0] + overlap >= size[0] or beg[1] + overlap >= size[1]:
+            raise KeyError('no tile %d_%d at level %d' % (col, row, level))
+        beg = [max(0, beg[0]), max(0, beg[1])]
+        end = [min((col+1)*self.tile_size + overlap, size[0]), min((row+1)*self.tile_size + overlap, size[1])]
+        box = np.array([x + beg[0]*ds, y + beg[1]*ds, (end[0] - beg[0])*ds, (end[1] - beg[1])*ds], dtype=np.int64)
+        return box, ds, (self.tile_size, self.tile_size) if xyz else None
+
+    def _read_tile(self, file, channel, box, ds, window, pad):
+        t = time.time()
+        reader = self.files[file]['reader']
+        # color images are stored as BGR, the tiles are RGB.
+        img = self.czilib.cziread_scene(reader, box, readahead=self.readahead, ds=ds, reduce='mean', dtype=np.uint8,
+            window=window, rgb=True, channel=channel)
+        if pad is not None and img.shape[:2] != pad:
+            tile = np.zeros(pad + img.shape[2:], dtype=img.dtype)
+            tile[:img.shape[0],:img.shape[1]] = img
+            img = tile
+        with self.lock:
+            self.ntiles_read += 1; self.read_time += time.time() - t
+        return img
+
+    @staticmethod
+    def _tile_format(tile_format):
+        tile_format = tile_format.lower()
+        if tile_format == 'jpeg': tile_format = 'jpg'
+        assert( tile_format in ['png', 'jpg'] ) # unsupported tile format
+        return tile_format
+
+    @staticmethod
+    def _encode(img, tile_format):
+        if tile_format == 'jpg':
+            from PIL import Image
+            import io
+            out = io.BytesIO()
+            Image.fromarray(img).save(out, format='JPEG', quality=90)
+            return out.getvalue()
+        return CziTileServer._encode_png(img)
+
+    @staticmethod
+    def _encode_png(img, level=1):
+        # 8 bit gray, rgb or rgba png without filtering, fast compression is enough for tiles on localhost.
+        h, w = img.shape[:2]
+        nchan = img.shape[2] if img.ndim == 3 else 1
+        raw = np.zeros((h, w*nchan + 1), dtype=np.uint8)
+        raw[:,1:] = img.reshape(h, -1)
+        def chunk(tag, data):
+            return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+        header = struct.pack('>IIBBBBB', w, h, 8, {1:0, 3:2, 4:6}[nchan], 0, 0, 0)
+        return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(raw.tobytes(), level)) + \
+            chunk(b'IEND', b'')
+
+    def _record(self, latency, error):
+        with self.lock:
+            self.nrequests += 1; self.nerrors += error
+            self.latencies.append(latency)
+
+    @staticmethod
+    def _addArgs(p):
+        # adds arguments required for this object to specified ArgumentParser object
+        p.add_argument('czi_filenames', nargs='+', type=str, help='Input czi files')
+        p.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+        p.add_argument('--port', type=int, default=8000, help='Port to listen on')
+        p.add_argument('--tile-size', type=int, default=256, help='Size of the tiles in pixels')
+        p.add_argument('--overlap', type=int, default=0, help='Overlap of the DeepZoom tiles in pixels')
+        p.add_argument('--tile-format', type=str, default='png', choices=['png', 'jpg'], help='DeepZoom tile format')
+        p.add_argument('--threads', type=int, default=0, help='Number of request threads, 0 for all cpus')
+        p.add_argument('--cache-size', type=int, default=256*2**20, help='Size in bytes of the tile cache')
+        p.add_argument('--readahead', type=int, default=0, help='Maximum size in bytes of sequential reads')
+        p.add_argument('--allow-origin', type=str, default=None,
+            help='Origin allowed to request tiles from another page (e.g. http://localhost:8080), * for any')
+        p.add_argument('--verbose', action='store_true', help='Print the requests')
+
+class _TileCache(object):
+    # least recently used cache of encoded tiles with a size limit in bytes (encoded tiles are a fraction of the
+    #   size of the decoded pixels and are served as they are).
+    #   concurrent requests for the same tile wait for the thread that reads it instead of reading it again.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.tiles = collections.OrderedDict()
+        self.size = 0
+        self.pending = {}
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+
+    def get(self, key, read):
+        with self.lock:
+            data = self.tiles.get(key)
+            if data is not None:
+                self.tiles.move_to_end(key); self.hits += 1
+                return data
+            self.misses += 1
+            future = self.pending.get(key)
+            reading = future is None
+            if reading: future = self.pending[key] = concurrent.futures.Future()
+        if not reading: return future.result()
+
+        try:
+            data = read()
+        except BaseException as exc:
+            with self.lock:
+                del self.pending[key]
+            future.set_exception(exc)
+            raise
+        with self.lock:
+            del self.pending[key]
+            if len(data) <= self.capacity:
+                self.tiles[key] = data; self.size += len(data)
+                while self.size > self.capacity:
+                    self.size -= len(self.tiles.popitem(last=False)[1])
+        future.set_result(data)
+        return data
+
+    def metrics(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits':self.hits, 'misses':self.misses, 'hit_rate':self.hits / total if total > 0 else 0.,
+                'entries':len(self.tiles), 'bytes':self.size, 'capacity':self.capacity}
+
+class _PoolHTTPServer(http.server.HTTPServer):
+    # http server that handles the requests with a fixed pool of threads.
+    def __init__(self, address, handler, threads):
+        http.server.HTTPServer.__init__(self, address, handler)
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        http.server.HTTPServer.server_close(self)
+        self.pool.shutdown(wait=True)
+
+class _TileRequestHandler(http.server.BaseHTTPRequestHandler):
+    routes = [
+        ('index', re.compile(r'^/(index\.json)?$')),
+        ('metrics', re.compile(r'^/metrics$')),
+        ('dzi', re.compile(r'^/(\d+)/(\d+)/(\d+)\.dzi$')),
+        ('dzi_tile', re.compile(r'^/(\d+)/(\d+)/(\d+)_files/(\d+)/(\d+)_(\d+)\.(png|jpg|jpeg)$')),
+        ('xyz_tile', re.compile(r'^/(\d+)/(\d+)/(\d+)/(\d+)/(\d+)/(\d+)\.(png|jpg|jpeg)$')),
+    ]
+    content_types = {'png':'image/png', 'jpg':'image/jpeg', 'jpeg':'image/jpeg'}
+
+    def do_GET(self):
+        t = time.time()
+        server = self.server.tile_server
+        url = urllib.parse.urlsplit(self.path)
+        status = 200
+        try:
+            matches = [(r, x.match(url.path)) for r, x in self.routes]
+            route, match = next(((r, m) for r, m in matches if m), (None, None))
+            if route is None: raise KeyError('not found')
+            args = match.groups()
+            if route == 'index':
+                body, content_type = json.dumps(server.index()).encode('utf-8'), 'application/json'
+            elif route == 'metrics':
+                body, content_type = json.dumps(server.metrics()).encode('utf-8'), 'application/json'
+            elif route == 'dzi':
+                body, content_type = server.dzi(*[int(x) for x in args]).encode('utf-8'), 'application/xml'
+            else:
+                query = urllib.parse.parse_qs(url.query)
+                window = None
+                if 'window' in query:
+                    try:
+                        window = tuple(float(x) for x in query['window'][0].split(','))
+                        assert( len(window) == 2 )
+                    except (ValueError, AssertionError):
+                        raise ValueError('window must be lo,hi')
+                body = server.get_tile(*[int(x) for x in args[:6]], tile_format=args[6], window=window,
+                    xyz=(route == 'xyz_tile'))
+                content_type = self.content_types[args[6]]
+        except KeyError as exc:
+            status, body, content_type = 404, str(exc.args[0]).encode('utf-8'), 'text/plain'
+        except ValueError as exc:
+            status, body, content_type = 400, str(exc).encode('utf-8'), 'text/plain'
+        except Exception as exc:
+            status, body, content_type = 500, str(exc).encode('utf-8'), 'text/plain'
+        # recorded before responding, so that a client sees its previous requests in the metrics.
+        server._record(time.time() - t, status != 200)
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        # viewers are usually served from another port, which is only allowed for the configured origin.
+        if server.allow_origin is not None:
+            self.send_header('Access-Control-Allow-Origin', server.allow_origin)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.tile_server.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='DeepZoom and XYZ tile server for Zeiss czi files',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    CziTileServer._addArgs(parser)
+    args = parser.parse_args()
+
+    server = CziTileServer(args.czi_filenames, host=args.host, port=args.port, tile_size=args.tile_size,
+        overlap=args.overlap, tile_format=args.tile_format, threads=args.threads, cache_size=args.cache_size,
+        readahead=args.readahead, allow_origin=args.allow_origin, verbose=args.verbose)
+    print('Serving tiles on %s' % (server.url,))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
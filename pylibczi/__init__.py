@@ -14,7 +14,37 @@
 # You should have received a copy of the GNU General Public License
 # along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
 
-__all__ = ["CziFile", "CziScene"]
-from .CziScene import CziScene
-from .CziFile import CziFile
+import importlib
+import sys
+import types
+
+__all__ = ["CziFile", "CziScene", "CziCatalog", "CziSharedArray", "CziTileServer", "CziCanvas"]
 from ._version import __version__
+
+# the classes are only imported on first access, so that importing pylibczi (e.g. in worker processes) is fast.
+if sys.version_info >= (3, 7):
+    class _Package(types.ModuleType):
+        def __setattr__(self, name, value):
+            # the import system binds every imported submodule as an attribute of the package (also for
+            #   from pylibczi.CziScene import CziScene and for the submodules that one imports), bind the class of
+            #   the same name instead, as the eager imports did.
+            if name in __all__ and isinstance(value, types.ModuleType):
+                value = getattr(value, name)
+            super(_Package, self).__setattr__(name, value)
+
+    sys.modules[__name__].__class__ = _Package
+
+    def __getattr__(name):
+        if name in __all__:
+            return getattr(importlib.import_module('.' + name, __name__), name)
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+    def __dir__():
+        return sorted(set(globals().keys()) | set(__all__))
+else:
+    from .CziScene import CziScene
+    from .CziFile import CziFile
+    from .CziCatalog import CziCatalog
+    from .CziSharedArray import CziSharedArray
+    from .CziTileServer import CziTileServer
+    from .CziCanvas import CziCanvas
@@ -23,6 +23,8 @@ import numpy
 import sysconfig
 import platform
 import subprocess
+import re
+import shlex
 
 # several platform specifc build options
 platform_ = platform.system()
@@ -32,12 +34,18 @@ architecture = platform.architecture()
 build_static = (platform_ != 'Windows')
 
 # libczi cloned as submodule, get paths to library and build locations.
+#   the extension is built against this libCZI release (tag v0.67.1 of ZEISS/libczi), its api (raw compression
+#   modes, zstd) needs c++14. the JxrDecode objects are part of the libCZI library, zstd is downloaded and built
+#   by the libCZI build unless an installed zstd is used (PYLIBCZI_CMAKE_ARGS, see build_libCZI).
+libczi_version = (0, 67, 1)
 script_dir = os.path.dirname(os.path.abspath(__file__))
 libczi_dir = os.path.join(script_dir, 'libCZI')
 build_temp = os.path.join(libczi_dir,'build')
 include_libCZI = os.path.join(libczi_dir, 'Src')
+# libCZI_Config.h is generated in the build dir
+include_libCZI_config = os.path.join(build_temp, 'Src', 'libCZI')
 lib_libCZI = os.path.join(build_temp, 'Src', 'libCZI')
-lib_JxrDecode = os.path.join(build_temp, 'Src', 'JxrDecode')
+lib_zstd = os.path.join(build_temp, '_deps', 'zstd-build', 'lib')
 if platform_ == 'Windows':
     if build_static:
         # xxx - does not work, not sure why
@@ -47,18 +55,42 @@ if platform_ == 'Windows':
         libCZI_win_release = 'Release'
     win_arch = 'x64' if architecture[0]=='64bit' else 'x86'
     lib_libCZI = os.path.join(lib_libCZI, libCZI_win_release)
-    lib_JxrDecode = os.path.join(lib_JxrDecode, libCZI_win_release)
+    lib_zstd = os.path.join(lib_zstd, libCZI_win_release)
 
 
+def check_libCZI_version():
+    try:
+        with open(os.path.join(libczi_dir, 'CMakeLists.txt')) as f:
+            match = re.search(r'project\s*\(\s*libCZI\s+VERSION\s+(\d+)\.(\d+)\.(\d+)', f.read())
+    except IOError:
+        raise RuntimeError('libCZI submodule not found, clone with --recurse-submodules or run ' +
+            '"git submodule update --init"')
+    # older libCZI versions do not declare a project version
+    version = tuple(int(x) for x in match.groups()) if match else None
+    if version != libczi_version:
+        tag = 'v%d.%d.%d' % libczi_version
+        raise RuntimeError('pylibczi is built against libCZI %s, the libCZI submodule is %s, check it out with ' %
+            (tag, 'v%d.%d.%d' % version if version else 'older') +
+            '"git submodule sync && git submodule update --init && git -C libCZI fetch --tags && ' +
+            'git -C libCZI checkout %s"' % tag)
+
 def build_libCZI():
+    check_libCZI_version()
     env = os.environ.copy()
-    cmake_args = []
+    # only the libraries, not the unit tests (they download googletest) or the command line tool.
+    cmake_args = ['-DLIBCZI_BUILD_UNITTESTS=OFF', '-DLIBCZI_BUILD_CZICMD=OFF',
+        '-DLIBCZI_BUILD_DYNLIB=' + ('OFF' if build_static else 'ON')]
+    # extra cmake arguments, e.g. to build offline against installed zstd and eigen packages:
+    #   PYLIBCZI_CMAKE_ARGS="-DLIBCZI_BUILD_PREFER_EXTERNALPACKAGE_ZSTD=ON
+    #       -DLIBCZI_BUILD_PREFER_EXTERNALPACKAGE_EIGEN3=ON"
+    cmake_args += shlex.split(env.get('PYLIBCZI_CMAKE_ARGS', ''))
     build_args = []
     if platform_ == 'Windows':
         cmake_args += ['-DCMAKE_GENERATOR_PLATFORM=' + win_arch]
         build_args += ['--config', libCZI_win_release]
     else:
-        cmake_args += ['-DCMAKE_BUILD_TYPE:STRING=Release']
+        # the static libraries are linked into the (shared) extension
+        cmake_args += ['-DCMAKE_BUILD_TYPE:STRING=Release', '-DCMAKE_POSITION_INDEPENDENT_CODE=ON']
     if not os.path.exists(build_temp):
         os.makedirs(build_temp)
     def run_cmake(cmake_exe):
@@ -102,9 +134,9 @@ if platform_ == 'Windows':
     extra_link_args += safe_get_env_var_list('_LINK_')
     extra_compile_args += ['/Ox']
 else:
-    extra_compile_args += ["-std=c++11", "-Wall", "-O3"]
+    extra_compile_args += ["-std=c++14", "-Wall", "-O3"]
     if platform_ == 'Linux':
-        extra_compile_args += ["-fPIC"]
+        extra_compile_args += ["-fPIC", "-pthread"]
         if build_static:
             # need to link with g++ linker for static libstdc++ to work
             os.environ["LDSHARED"] = os.environ["CXX"] if 'CXX' in os.environ else 'g++'
@@ -115,7 +147,7 @@ else:
         extra_compile_args += ["-stdlib=libc++", "-mmacosx-version-min="+mac_ver]
     extra_link_args += extra_compile_args
 
-include_dirs = [numpy.get_include(), include_libCZI]
+include_dirs = [numpy.get_include(), include_libCZI, include_libCZI_config]
 
 static_libraries = []
 static_lib_dirs = []
@@ -123,8 +155,8 @@ libraries = []
 library_dirs = []
 extra_objects = []
 if build_static:
-    static_libraries += ['libCZIStatic', 'JxrDecodeStatic']
-    static_lib_dirs += [lib_libCZI, lib_JxrDecode]
+    static_libraries += ['libCZIStatic', 'zstd']
+    static_lib_dirs += [lib_libCZI, lib_zstd]
 else:
     libraries += ['libCZI']
     library_dirs += [lib_libCZI]
@@ -150,7 +182,7 @@ module1 = Extension('_pylibczi',
                     sources = [os.path.join('_pylibczi',x) for x in sources],
                     extra_compile_args=extra_compile_args,
                     extra_link_args=extra_link_args,
-                    language='c++11',
+                    language='c++14',
                     extra_objects=extra_objects,
                     )
 
@@ -164,6 +196,11 @@ class specialized_build_ext(build_ext):
     def build_extension(self, ext):
         if ext.name==self.special_extension:
             build_libCZI()
+            zstd_static = '{}/lib{}.a'.format(lib_zstd, 'zstd')
+            if build_static and platform_ != 'Windows' and not os.path.isfile(zstd_static):
+                # libCZI was built against an installed zstd, link that one
+                ext.extra_objects.remove(zstd_static)
+                ext.libraries.append('zstd')
             if not build_static:
                 # xxx - hack to copy the dlls in case static build is not working (windows)
                 data_files = [('', glob.glob(os.path.join(lib_libCZI,'*.dll')))]
@@ -0,0 +1,124 @@
+# This file is part of pylibczi.
+# Copyright (c) 2018 Center of Advanced European Studies and Research (caesar)
+#
+# pylibczi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pylibczi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
+
+# Minimal writer of uncompressed czi files for the tests, with full control over the subblock placement, M-index,
+#   pyramid subblocks and the order of the subblocks in the file and in the directory, and optionally the meta data
+#   read by CziScene (pixel size, scenes, calibration markers, ribbons, section and roi polygons).
+
+import numpy as np
+import struct
+
+# czi pixel types of the numpy image types, (dtype, channels)
+pixel_types = {(np.dtype(np.uint8), 1):0, (np.dtype(np.uint16), 1):1, (np.dtype(np.float32), 1):2,
+               (np.dtype(np.uint8), 3):3, (np.dtype(np.uint16), 3):4}
+
+def subblock(data, x, y, C=0, S=None, M=None, w=None, h=None, pyramid_type=0):
+    """A subblock to write, data is the stored (m x n or m x n x 3 BGR) image, w and h the logical size."""
+    return {'data':np.ascontiguousarray(data), 'x':x, 'y':y, 'C':C, 'S':S, 'M':M,
+            'w':data.shape[1] if w is None else w, 'h':data.shape[0] if h is None else h, 'pyramid_type':pyramid_type}
+
+def mosaic(rng, dtype, nchan=1, nscenes=1, nchannels=1, tile=64, step=48, ntiles=4, pyramid=True):
+    """Subblocks and directory order of overlapping tiles with distinct M-indices, stored in a shuffled order that
+    is neither the M-index order nor the directory order. Some tiles do not have an M-index, pyramid subblocks must
+    be ignored. Scene s is offset by (1000*s, 300*s)."""
+    sbs = []
+    for s in range(nscenes):
+        for c in range(nchannels):
+            ms = rng.permutation(ntiles*ntiles)
+            for k in range(ntiles*ntiles):
+                shape = (tile + k % 5, tile + k % 3) + ((nchan,) if nchan > 1 else ())
+                if dtype == np.float32:
+                    data = rng.random(shape, dtype=np.float32)*1000
+                else:
+                    data = rng.integers(1, np.iinfo(dtype).max, shape).astype(dtype)
+                x, y = 1000*s + (k % ntiles)*step, 300*s + (k // ntiles)*step
+                sbs.append(subblock(data, x, y, C=c, S=s if nscenes > 1 else None, M=None if k % 7 == 3 else ms[k]))
+                if pyramid and k % 4 == 0:
+                    sbs.append(subblock(data[::2,::2], x, y, C=c, S=s if nscenes > 1 else None, w=data.shape[1],
+                        h=data.shape[0], pyramid_type=1))
+    order = rng.permutation(len(sbs))
+    return [sbs[i] for i in order], rng.permutation(len(sbs))
+
+def _segment(sid, data):
+    # segments are aligned to 32 bytes
+    data = data + b'\0'*((-len(data)) % 32)
+    return sid.ljust(16, b'\0') + struct.pack('<qq', len(data), len(data)) + data
+
+def _entry(sb, position):
+    data = sb['data']
+    nchan = data.shape[2] if data.ndim == 3 else 1
+    dims = [(b'X', sb['x'], sb['w'], data.shape[1]), (b'Y', sb['y'], sb['h'], data.shape[0]), (b'C', sb['C'], 1, 1)]
+    if sb['S'] is not None: dims.append((b'S', sb['S'], 1, 1))
+    if sb['M'] is not None: dims.append((b'M', sb['M'], 1, 1))
+    entry = struct.pack('<2siqiiB5si', b'DV', pixel_types[(data.dtype, nchan)], position, 0, 0, sb['pyramid_type'],
+        b'', len(dims))
+    for name, start, size, stored in dims:
+        entry += struct.pack('<4siifi', name, start, size, float(start), stored)
+    return entry
+
+def metadata(scenes, scale=1., markers=((0., 0.), (10000., 0.), (0., 5000.)), ribbons=(), sections=(), rois=()):
+    """Meta data xml for CziScene, scenes are (x, y, w, h) and ribbons (left, top, width, height) in stage units
+    (scale is the pixel size in stage units), sections and rois polygon points as (n, 2) arrays."""
+    def polygons(name, points):
+        return '<Layer Name="%s"><Elements>%s</Elements></Layer>' % (name, ''.join(
+            '<Polygon><Geometry><Points>%s</Points></Geometry><Attributes><Rotation>0</Rotation></Attributes>'
+            '</Polygon>' % ' '.join('%r,%r' % (float(x), float(y)) for x, y in p) for p in points))
+    return ('<ImageDocument><Metadata>'
+        '<Scaling><Items><Distance Id="X"><Value>%r</Value></Distance><Distance Id="Y"><Value>%r</Value></Distance>'
+        '</Items></Scaling>' % (scale*1e-6, scale*1e-6) +
+        '<Information><Image><Dimensions><S><Scenes>%s</Scenes></S></Dimensions></Image></Information>' % ''.join(
+            '<Scene Index="%d"><CenterPosition>%r,%r</CenterPosition><ContourSize>%r,%r</ContourSize></Scene>' %
+            (i, x + w/2, y + h/2, float(w), float(h)) for i, (x, y, w, h) in enumerate(scenes)) +
+        '<Experiment><ExperimentBlocks><AcquisitionBlock><SubDimensionSetups><CorrelativeSetup><HolderDocument>'
+        '<Calibration>%s</Calibration>' % ''.join('<Marker%d><X>%r</X><Y>%r</Y></Marker%d>' % (i+1, x, y, i+1)
+            for i, (x, y) in enumerate(markers)) +
+        '</HolderDocument></CorrelativeSetup></SubDimensionSetups></AcquisitionBlock></ExperimentBlocks>'
+        '</Experiment><MetadataNodes><MetadataNode><Layers>' +
+        '<Layer Name="Cat_Ribbon"><Elements>%s</Elements></Layer>' % ''.join(
+            '<Rectangle><Geometry><Left>%r</Left><Top>%r</Top><Width>%r</Width><Height>%r</Height></Geometry>'
+            '</Rectangle>' % tuple(float(x) for x in r) for r in ribbons) +
+        polygons('CAT_Section', sections) + polygons('CAT_ROI', rois) +
+        '</Layers></MetadataNode></MetadataNodes></Metadata></ImageDocument>')
+
+def write_czi(filename, subblocks, directory_order=None, meta=None):
+    """Write the subblocks in list order, directory_order optionally permutes the order of the directory entries,
+    meta is the meta data xml (see metadata)."""
+    header_size = 32 + 512
+    out = bytearray(header_size)
+    metadata_position = 0
+    if meta is not None:
+        metadata_position = len(out)
+        xml = meta.encode('utf-8')
+        out += _segment(b'ZISRAWMETADATA', struct.pack('<ii', len(xml), 0).ljust(256, b'\0') + xml)
+    positions = []
+    for sb in subblocks:
+        positions.append(len(out))
+        data = sb['data'].tobytes()
+        entry = _entry(sb, 0)
+        fixed = struct.pack('<iiq', 0, 0, len(data)) + entry
+        fixed += b'\0'*(max(256, len(fixed)) - len(fixed))
+        out += _segment(b'ZISRAWSUBBLOCK', fixed + data)
+
+    order = range(len(subblocks)) if directory_order is None else directory_order
+    directory = struct.pack('<i124s', len(subblocks), b'') + b''.join(_entry(subblocks[i], positions[i]) for i in order)
+    directory_position = len(out)
+    out += _segment(b'ZISRAWDIRECTORY', directory)
+
+    header = struct.pack('<iiii16s16siqqiq', 1, 0, 0, 0, b'\x01'*16, b'\x01'*16, 0, directory_position,
+        metadata_position, 0, 0)
+    out[:header_size] = _segment(b'ZISRAWFILE', header.ljust(512, b'\0'))
+    with open(filename, 'wb') as f:
+        f.write(bytes(out))
@@ -0,0 +1,80 @@
+# This file is part of pylibczi.
+# Copyright (c) 2018 Center of Advanced European Studies and Research (caesar)
+#
+# pylibczi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pylibczi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
+
+# Tests of the canvas of overlapping scenes, downsampled reads are compared with the downsampled full read.
+
+import numpy as np
+import pytest
+
+from czi_writer import write_czi, subblock, metadata
+
+_pylibczi = pytest.importorskip('_pylibczi')
+pytest.importorskip('lxml')
+pytest.importorskip('scipy')
+from pylibczi import CziCanvas, CziFile
+
+# scenes (stage x, y, w, h) of the files, the later ones overlap the earlier ones at offsets that are not multiples
+#   of the downsampling. the second scene has a gap between its subblocks.
+scenes = [(0, 0, 100, 80), (37, 29, 90, 70), (-13, 61, 60, 45)]
+
+@pytest.fixture(scope='module', params=[(np.uint16, 1), (np.float32, 1), (np.uint8, 3)],
+    ids=['gray16', 'float32', 'bgr24'])
+def czi_files(request, tmp_path_factory):
+    dtype, nchan = request.param
+    rng = np.random.default_rng(17)
+    path = tmp_path_factory.mktemp('canvas')
+    fns = []
+    for i, (x, y, w, h) in enumerate(scenes):
+        tiles = [(0, 0, w//2 + 3, h), (w//2 + (i == 1)*4, 0, w - w//2 - (i == 1)*4, h)]
+        sbs = []
+        for k, (tx, ty, tw, th) in enumerate(tiles):
+            shape = (th, tw) + ((nchan,) if nchan > 1 else ())
+            if dtype == np.float32:
+                data = (rng.random(shape, dtype=np.float32) + 0.5)*1000
+            else:
+                data = rng.integers(1, np.iinfo(dtype).max, shape, endpoint=True).astype(dtype)
+            sbs.append(subblock(data, 500 + tx, 300 + ty, M=k))
+        fns.append(str(path / ('scene%d.czi' % (i,))))
+        write_czi(fns[-1], sbs, meta=metadata([(x, y, w, h)]))
+    return fns
+
+def test_scenes_placed(czi_files):
+    with CziCanvas(czi_files) as canvas:
+        assert list(canvas.box) == [-13, 0, 140, 106]
+        full = canvas.read()
+        # the later scene is on top where the scenes overlap
+        img = _pylibczi.cziread_scene(czi_files[1], np.array([500, 300, 90, 70], dtype=np.int64))
+        covered = (img != 0) if img.ndim == 2 else (img != 0).any(2)
+        # the gap between the subblocks shows the scene below, the last scene is on top of the lower left corner
+        assert not covered[:,48].any()
+        covered[32:,:10] = False
+        assert np.array_equal(full[29:99, 50:140][covered], img[covered])
+        # and the last scene on top of it
+        assert np.array_equal(full[61:99, 50:60], _pylibczi.cziread_scene(czi_files[2],
+            np.array([550, 300, 10, 38], dtype=np.int64)))
+
+@pytest.mark.parametrize('reduce', [np.mean, np.max, 'stride'])
+@pytest.mark.parametrize('ds', [2, 3, 4, 7])
+def test_downsampled_read(czi_files, ds, reduce):
+    # composing the scenes before reducing, also at the seams where a downsampled pixel mixes several scenes
+    with CziCanvas(czi_files) as canvas:
+        for box in [None, [-10, 3, 131, 97], [40, 31, 50, 41]]:
+            full = canvas.read(box)
+            assert np.array_equal(canvas.read(box, ds=ds, reduce=reduce),
+                CziFile.downsample_image(full, ds, reduce=reduce))
+        convert = dict(dtype=np.uint8, window=(100, 50000), rgb=True)
+        assert np.array_equal(canvas.read(ds=ds, reduce=reduce, **convert),
+            CziFile.convert_image(CziFile.downsample_image(canvas.read(), ds, reduce=reduce), **convert))
@@ -0,0 +1,142 @@
+# This file is part of pylibczi.
+# Copyright (c) 2018 Center of Advanced European Studies and Research (caesar)
+#
+# pylibczi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pylibczi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
+
+# Tests of the catalog against CziScene on files with scenes, ribbons, section and roi polygons.
+
+import os
+
+import numpy as np
+import pytest
+
+from czi_writer import write_czi, subblock, metadata
+
+_pylibczi = pytest.importorskip('_pylibczi')
+pytest.importorskip('lxml')
+pytest.importorskip('scipy')
+from pylibczi import CziCatalog, CziScene
+
+def triangle(x, y, size=10):
+    return np.array([[x, y], [x + size, y], [x, y + size]], dtype=np.double)
+
+# two files, the first with two scenes (stage x, y, w, h) and three ribbons, the second with a single scene.
+files = {
+    'scenes.czi':dict(scenes=[(0, 0, 200, 100), (300, 0, 150, 100)],
+        ribbons=[(10, 10, 80, 60), (110, 10, 80, 60), (310, 10, 120, 70)],
+        sections=[triangle(20, 20), triangle(50, 40), triangle(120, 30), triangle(320, 20), triangle(350, 30),
+            triangle(400, 50)],
+        rois=[triangle(130, 20, 5)]),
+    'single.czi':dict(scenes=[(1000, 500, 120, 90)], ribbons=[(5, 5, 50, 40)], sections=[triangle(10, 10)]),
+}
+
+@pytest.fixture
+def czi_dir(tmp_path):
+    rng = np.random.default_rng(21)
+    for fn, meta in files.items():
+        scenes = meta['scenes']
+        corner = np.array(scenes).min(0)[:2]
+        sbs = []
+        for s, (x, y, w, h) in enumerate(scenes):
+            data = rng.integers(1, 65535, (h, w)).astype(np.uint16)
+            sbs.append(subblock(data, x - corner[0], y - corner[1], S=s if len(scenes) > 1 else None))
+        write_czi(str(tmp_path / fn), sbs, meta=metadata(**meta))
+    return tmp_path
+
+@pytest.fixture
+def catalog(czi_dir):
+    with CziCatalog(str(czi_dir / 'catalog.sqlite')) as catalog:
+        assert catalog.update([str(czi_dir)], nworkers=2) == (2, 0, 0)
+        yield catalog
+
+def test_update(czi_dir, catalog):
+    assert catalog.update([str(czi_dir)], nworkers=2) == (0, 2, 0)
+    fn = str(czi_dir / 'single.czi')
+    os.utime(fn, (0, 1))
+    assert catalog.update([str(czi_dir)], nworkers=2) == (1, 1, 0)
+    os.remove(fn)
+    catalog.update([str(czi_dir)], prune=True)
+    assert [x[0] for x in catalog.query('SELECT filename FROM files')] == [str(czi_dir / 'scenes.czi')]
+    assert catalog.query('SELECT COUNT(*) FROM files WHERE error IS NOT NULL')[0][0] == 0
+
+def test_scenes_match_cziscene(catalog, czi_dir):
+    scenes = catalog.query_scenes()
+    assert [(os.path.basename(x[0]), x[1]) for x in scenes] == [('scenes.czi', 1), ('scenes.czi', 2),
+        ('single.czi', 1)]
+    for fn, s, box in scenes:
+        scene = CziScene(fn, scene=s, ribbon=0)
+        scene.read_scene_meta()
+        assert np.array_equal(box, scene._scene_box())
+        assert np.array_equal(catalog.query_polygons(fn, s), scene.polygons_points)
+        assert np.array_equal(catalog.query_polygons(fn, s, kind='roi'), scene.rois_points)
+        scene.read_scene_image()
+        assert np.array_equal(_pylibczi.cziread_scene(fn, box), scene.img)
+    # scenes overlapping a stage region, and with a minimum number of sections
+    assert [x[1] for x in catalog.query_scenes(stage_region=(250, 10, 60, 10))] == [2]
+    assert [x[1] for x in catalog.query_scenes(min_sections=3)] == [1, 2]
+
+def test_max_bytes(czi_dir):
+    # the scene image and the polygon crops with their masks are checked before reading
+    scene = CziScene(str(czi_dir / 'scenes.czi'), scene=1)
+    with pytest.raises(MemoryError):
+        scene.read_scene_image(max_bytes=0)
+    scene.read_scene_image(max_bytes=200*100*2)
+    # three sections of at most 11 x 11 pixels, 2 bytes per pixel and 1 for the mask
+    imgs, _, masks = scene.read_polygons(return_mask=True, max_bytes=3*11*11*3)
+    assert sum(x.nbytes + m.nbytes for x, m in zip(imgs, masks)) <= 3*11*11*3
+    with pytest.raises(MemoryError):
+        scene.read_polygons(max_bytes=3*11*11*3 - 1)
+    assert len(scene.read_polygons(inds=[0], max_bytes=11*11*3)[0]) == 1
+
+def test_ribbons_match_cziscene(catalog):
+    ribbons = catalog.query_ribbons()
+    assert [(os.path.basename(x[0]), x[1], x[2]) for x in ribbons] == [('scenes.czi', 1, 1), ('scenes.czi', 1, 2),
+        ('scenes.czi', 2, 3), ('single.czi', 1, 1)]
+    nsections = {1:2, 2:1, 3:3}
+    for fn, s, r, box in ribbons:
+        # the polygons assigned to the ribbon are the ones cropped with it
+        scene = CziScene(fn, scene=s, ribbon=r)
+        scene.read_scene_meta()
+        polygons = catalog.query_polygons(fn, s, ribbon=r)
+        if fn.endswith('scenes.czi'): assert len(polygons) == nsections[r]
+        assert len(polygons) == scene.npolygons
+        assert len(catalog.query_polygons(fn, s, ribbon=r, kind='roi')) == scene.nROIs
+        # the ribbon box is within the cropped scene
+        crop = scene._scene_box()
+        assert (box[:2] >= crop[:2]).all() and (box[:2] + box[2:] <= crop[:2] + crop[2:]).all()
+    assert [x[2] for x in catalog.query_ribbons(min_sections=2)] == [1, 3]
+
+def test_stats(catalog, czi_dir):
+    fn = str(czi_dir / 'single.czi')
+    stats = _pylibczi.cziread_stats(fn, catalog.query_scenes(filename_like='%single%')[0][2])
+    catalog.store_stats(fn, 1, 0, 1, stats)
+    stored = catalog.query_stats(fn, 1, 0, 1)
+    assert set(stored.keys()) == set(stats.keys())
+    for k in stats:
+        assert np.array_equal(stored[k], stats[k])
+    assert catalog.query_stats(fn, 1, 0, 2) is None
+    # the statistics are not valid anymore once the file changed
+    os.utime(fn, (0, 1))
+    assert catalog.query_stats(fn, 1, 0, 1) is None
+
+def test_store_stats_adds_file(czi_dir, monkeypatch):
+    # store_stats parses a file that is not in the catalog yet, in this process
+    import concurrent.futures
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor', None)
+    fn = str(czi_dir / 'scenes.czi')
+    with CziCatalog(str(czi_dir / 'stats.sqlite')) as catalog:
+        stats = _pylibczi.cziread_stats(fn, np.array([0, 0, 200, 100], dtype=np.int64))
+        catalog.store_stats(fn, 1, 0, 1, stats)
+        assert [x[1] for x in catalog.query_scenes()] == [1, 2]
+        assert np.array_equal(catalog.query_stats(fn, 1, 0, 1)['histogram'], stats['histogram'])
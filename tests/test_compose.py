@@ -0,0 +1,115 @@
+# This file is part of pylibczi.
+# Copyright (c) 2018 Center of Advanced European Studies and Research (caesar)
+#
+# pylibczi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pylibczi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
+
+# Regression tests of the file order composition (RegionComposer) against the libCZI tile accessor.
+
+import numpy as np
+import pytest
+
+from czi_writer import write_czi, subblock, mosaic
+
+_pylibczi = pytest.importorskip('_pylibczi')
+
+@pytest.fixture(scope='module', params=[(np.uint8, 1), (np.uint16, 1), (np.float32, 1), (np.uint8, 3),
+    (np.uint16, 3)], ids=['gray8', 'gray16', 'float32', 'bgr24', 'bgr48'])
+def czi_file(request, tmp_path_factory):
+    dtype, nchan = request.param
+    rng = np.random.default_rng(1234)
+    sbs, directory_order = mosaic(rng, dtype, nchan=nchan, nscenes=2, nchannels=2)
+    fn = str(tmp_path_factory.mktemp('czi') / 'mosaic.czi')
+    write_czi(fn, sbs, directory_order=directory_order)
+    return fn
+
+@pytest.mark.parametrize('scene', [0, 1])
+@pytest.mark.parametrize('channel', [0, 1])
+def test_scene_matches_accessor(czi_file, scene, channel):
+    sel = np.array([scene], dtype=np.int64)
+    img = _pylibczi.cziread_scene(czi_file, sel, channel=channel)
+    ref = _pylibczi.cziread_scene(czi_file, sel, channel=channel, order='directory')
+    assert img.shape == ref.shape
+    assert np.array_equal(img, ref)
+    # readahead only changes how the subblocks are read
+    assert np.array_equal(_pylibczi.cziread_scene(czi_file, sel, channel=channel, readahead=1<<20), ref)
+
+@pytest.mark.parametrize('box', [(0, 0, 230, 230), (-20, -10, 100, 90), (50, 37, 61, 83), (200, 200, 900, 300),
+    (500, 100, 10, 10)])
+def test_box_matches_accessor(czi_file, box):
+    box = np.array(box, dtype=np.int64)
+    ref = _pylibczi.cziread_scene(czi_file, box, order='directory')
+    assert np.array_equal(_pylibczi.cziread_scene(czi_file, box), ref)
+    boxes = _pylibczi.cziread_boxes(czi_file, box.reshape(1, 4), threads=4)
+    assert np.array_equal(boxes[0], ref)
+
+@pytest.mark.parametrize('ds,reduce', [(2, 'mean'), (3, 'max'), (5, 'stride')])
+def test_downsampled_matches_accessor(czi_file, ds, reduce):
+    box = np.array([-5, 3, 211, 197], dtype=np.int64)
+    kw = dict(ds=ds, reduce=reduce)
+    assert np.array_equal(_pylibczi.cziread_scene(czi_file, box, **kw),
+        _pylibczi.cziread_scene(czi_file, box, order='directory', **kw))
+    kw.update(dtype=np.uint8, window=(10, 900), rgb=True)
+    assert np.array_equal(_pylibczi.cziread_scene(czi_file, box, **kw),
+        _pylibczi.cziread_scene(czi_file, box, order='directory', **kw))
+
+def test_many_boxes_match_accessor(czi_file):
+    rng = np.random.default_rng(5)
+    boxes = np.concatenate((rng.integers(-20, 1200, (40, 2)), rng.integers(1, 120, (40, 2))), axis=1)
+    imgs = _pylibczi.cziread_boxes(czi_file, boxes, threads=4)
+    for box, img in zip(boxes, imgs):
+        assert np.array_equal(img, _pylibczi.cziread_scene(czi_file, box, order='directory'))
+
+@pytest.mark.parametrize('channel', [0, 1])
+def test_polygons_match_accessor(czi_file, channel):
+    polygons = [np.array([[10., 5.], [200., 30.], [120., 190.]]), np.array([[1010., 310.], [1150., 310.],
+        [1150., 420.], [1010., 420.]])]
+    imgs, masks, corners = _pylibczi.cziread_polygons(czi_file, polygons, mask=False, threads=4, channel=channel)
+    for img, corner in zip(imgs, corners):
+        box = np.array([corner[0], corner[1], img.shape[1], img.shape[0]], dtype=np.int64)
+        assert np.array_equal(img, _pylibczi.cziread_scene(czi_file, box, channel=channel, order='directory'))
+
+@pytest.mark.parametrize('nchan', [1, 3])
+def test_single_subblock_image(tmp_path, nchan):
+    # read_image of a single subblock returns a contiguous image, as for several subblocks
+    from pylibczi import CziFile
+    rng = np.random.default_rng(9)
+    data = rng.integers(0, 255, (23, 37) + ((nchan,) if nchan > 1 else ())).astype(np.uint8)
+    fn = str(tmp_path / 'single.czi')
+    write_czi(fn, [subblock(data, 5, 7)])
+    img = CziFile(fn).read_image()
+    assert img.flags['C_CONTIGUOUS'] and np.array_equal(img, data)
+
+@pytest.mark.parametrize('box', [(2**31, 0, 10, 10), (0, -2**31 - 5, 10, 10), (0, 0, 2**32 + 10, 10),
+    (2**31 - 5, 0, 10, 10), (0, 0, 10, -1)])
+def test_box_out_of_range(czi_file, box):
+    # boxes that do not fit into the int coordinates of libCZI are refused instead of truncated
+    with pytest.raises(_pylibczi._pylibczi_exception):
+        _pylibczi.cziread_boxes(czi_file, np.array([box], dtype=np.int64))
+    with pytest.raises(_pylibczi._pylibczi_exception):
+        _pylibczi.cziread_stats(czi_file, np.array(box, dtype=np.int64))
+
+def test_decode_raw(czi_file):
+    # the raw subblocks decoded one by one are the subblocks of the normal reads, also the pyramid subblocks
+    from pylibczi import CziFile
+    czi = CziFile(czi_file)
+    index, raws = czi.read_subblocks_raw(lambda x: x.C == 1)
+    assert index.size == len(raws) and (index.C == 1).all()
+    imgs, _ = _pylibczi.cziread_allsubblocks(czi_file, indices=index.index)
+    for record, raw, img in zip(index, raws, imgs):
+        tile = CziFile.decode_subblock(memoryview(raw), record)
+        assert tile.shape[:2] == (record.stored_h, record.stored_w)
+        assert np.array_equal(tile, img)
+    for i in [0, index.size // 2, index.size - 1]:
+        assert np.array_equal(CziFile.decode_subblock(raws[i], index[i]),
+            czi.read_image(lambda x: x.index == index.index[i]))
@@ -0,0 +1,70 @@
+# This file is part of pylibczi.
+# Copyright (c) 2018 Center of Advanced European Studies and Research (caesar)
+#
+# pylibczi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pylibczi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
+
+# Parity of the czifile backend with the native composition of cziread_scene.
+
+import numpy as np
+import pytest
+
+from czi_writer import write_czi, mosaic, metadata
+
+_pylibczi = pytest.importorskip('_pylibczi')
+pytest.importorskip('czifile')
+pytest.importorskip('lxml')
+pytest.importorskip('scipy')
+from pylibczi import CziFile, CziScene
+
+# stage boxes of the two scenes of the mosaic, the second scene is offset by (1000, 300) pixels
+scenes = [(0, 0, 230, 230), (1000, 300, 230, 230)]
+
+@pytest.fixture(scope='module', params=[(np.uint8, 1), (np.uint16, 1), (np.float32, 1), (np.uint8, 3),
+    (np.uint16, 3)], ids=['gray8', 'gray16', 'float32', 'bgr24', 'bgr48'])
+def czi_file(request, tmp_path_factory):
+    dtype, nchan = request.param
+    rng = np.random.default_rng(99)
+    # overlapping tiles in shuffled M-index and directory order, some without M-index, with pyramid subblocks
+    sbs, directory_order = mosaic(rng, dtype, nchan=nchan, nscenes=2, nchannels=2)
+    fn = str(tmp_path_factory.mktemp('czi') / 'czifile.czi')
+    write_czi(fn, sbs, directory_order=directory_order, meta=metadata(scenes))
+    return fn
+
+@pytest.mark.parametrize('scene', [0, 1])
+def test_scene_filter(czi_file, scene):
+    # only the subblocks of the scene, drawn in M-index order, in the BGR order of libCZI
+    img, box = CziFile(czi_file, use_pylibczi=False)._czifile_read(scene=scene)
+    ref = _pylibczi.cziread_scene(czi_file, np.array([scene], dtype=np.int64))
+    assert img.dtype == ref.dtype and np.array_equal(img, ref)
+    assert list(box[:2]) == [1000*scene, 300*scene]
+
+@pytest.mark.parametrize('box', [(0, 0, 230, 230), (-20, -10, 100, 90), (50, 37, 61, 83), (200, 200, 900, 300),
+    (500, 100, 10, 10)])
+def test_box(czi_file, box):
+    box = np.array(box, dtype=np.int64)
+    img, _ = CziFile(czi_file, use_pylibczi=False)._czifile_read(box, threads=4)
+    assert np.array_equal(img, _pylibczi.cziread_scene(czi_file, box))
+
+def test_channel(czi_file):
+    img, _ = CziFile(czi_file, use_pylibczi=False)._czifile_read(scene=1, channel=1, threads=1)
+    assert np.array_equal(img, _pylibczi.cziread_scene(czi_file, np.array([1], dtype=np.int64), channel=1))
+
+@pytest.mark.parametrize('scene', [1, 2])
+def test_read_scene_image(czi_file, scene):
+    imgs = []
+    for use_pylibczi in [True, False]:
+        czi = CziScene(czi_file, scene=scene, use_pylibczi=use_pylibczi)
+        czi.read_scene_image()
+        imgs.append(czi.img)
+    assert imgs[0].shape == imgs[1].shape and np.array_equal(imgs[0], imgs[1])
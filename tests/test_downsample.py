@@ -0,0 +1,122 @@
+# This file is part of pylibczi.
+# Copyright (c) 2018 Center of Advanced European Studies and Research (caesar)
+#
+# pylibczi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pylibczi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
+
+# Parity of the native downsampling (mean, max and stride) with skimage block_reduce followed by astype.
+
+import numpy as np
+import pytest
+
+from czi_writer import write_czi, subblock
+
+_pylibczi = pytest.importorskip('_pylibczi')
+measure = pytest.importorskip('skimage.measure')
+
+reduces = {'mean':np.mean, 'max':np.max}
+
+def image(rng, dtype, shape):
+    if dtype == np.float32:
+        # also negative values, so that the zero padding of incomplete blocks matters for the max
+        return (rng.random(shape, dtype=np.float32) - 0.25)*1000
+    return rng.integers(0, np.iinfo(dtype).max, shape, endpoint=True).astype(dtype)
+
+def reference(img, ds, reduce):
+    if reduce == 'stride': return img[::ds,::ds]
+    return measure.block_reduce(img, block_size=(ds, ds) + (1,)*(img.ndim-2), func=reduces[reduce]).astype(img.dtype)
+
+def assert_parity(img, ref, full, ds, reduce):
+    assert img.shape == ref.shape and img.dtype == ref.dtype
+    if ref.dtype == np.float32 and reduce == 'mean':
+        # float means are summed in double natively, numpy sums in float32. the native mean is the double block
+        #   mean rounded to float32, it only differs from block_reduce by the rounding errors of the float32 sums.
+        np.testing.assert_array_max_ulp(img, reference(full.astype(np.float64), ds, reduce).astype(np.float32),
+            maxulp=1)
+        np.testing.assert_allclose(img, ref, rtol=1e-5, atol=1e-2)
+    else:
+        assert np.array_equal(img, ref)
+
+dtypes = pytest.mark.parametrize('dtype,nchan', [(np.uint8, 1), (np.uint16, 1), (np.float32, 1), (np.uint8, 3),
+    (np.uint16, 3)], ids=['gray8', 'gray16', 'float32', 'bgr24', 'bgr48'])
+
+@dtypes
+@pytest.mark.parametrize('reduce', ['mean', 'max', 'stride'])
+@pytest.mark.parametrize('ds', [2, 3, 5, 16])
+def test_downsample(dtype, nchan, reduce, ds):
+    rng = np.random.default_rng(ds)
+    # ragged edges, neither size is a multiple of ds
+    img = image(rng, dtype, (97, 131) + ((nchan,) if nchan > 1 else ()))
+    assert_parity(_pylibczi.downsample(img, ds, reduce=reduce), reference(img, ds, reduce), img, ds, reduce)
+
+@pytest.mark.parametrize('dtype,nchan', [(np.uint8, 1), (np.uint16, 1), (np.uint16, 3)])
+def test_integer_means_exact(dtype, nchan):
+    # constant blocks of the largest value, the block sums must not overflow
+    img = np.full((70, 45) + ((nchan,) if nchan > 1 else ()), np.iinfo(dtype).max, dtype=dtype)
+    for ds in [2, 16, 17, 257, 300]:
+        assert np.array_equal(_pylibczi.downsample(img, ds, reduce='mean'), reference(img, ds, 'mean'))
+
+@dtypes
+@pytest.mark.parametrize('reduce', ['mean', 'max', 'stride'])
+def test_read_downsampled(tmp_path, dtype, nchan, reduce):
+    # downsampling while composing subblocks, also pixels without subblocks count as zero
+    rng = np.random.default_rng(7)
+    shape = lambda h, w: (h, w) + ((nchan,) if nchan > 1 else ())
+    sbs = [subblock(image(rng, dtype, shape(60, 70)), 0, 0), subblock(image(rng, dtype, shape(45, 51)), 83, 20),
+           subblock(image(rng, dtype, shape(33, 40)), 10, 71)]
+    fn = str(tmp_path / 'ds.czi')
+    write_czi(fn, sbs)
+    box = np.array([-3, -1, 140, 107], dtype=np.int64)
+    full = _pylibczi.cziread_scene(fn, box)
+    for ds in [2, 3, 4, 9]:
+        assert_parity(_pylibczi.cziread_scene(fn, box, ds=ds, reduce=reduce), reference(full, ds, reduce), full, ds,
+            reduce)
+
+@dtypes
+@pytest.mark.parametrize('reduce', ['mean', 'max', 'stride'])
+def test_max_bytes(tmp_path, dtype, nchan, reduce):
+    # plan_read counts the buffers of the downsampled read as cziread_scene does for max_bytes
+    from pylibczi import CziFile
+    rng = np.random.default_rng(11)
+    fn = str(tmp_path / 'bytes.czi')
+    write_czi(fn, [subblock(image(rng, dtype, (50, 70) + ((nchan,) if nchan > 1 else ())), 0, 0)])
+    czi, box = CziFile(fn), np.array([0, 0, 70, 50], dtype=np.int64)
+    for ds in [1, 2, 3, 20]:
+        for out_dtype in [None, np.uint8, np.float32]:
+            nbytes = czi.plan_read(box, zoom=1./ds, dtype=out_dtype, reduce=reduce)['bytes']
+            kw = dict(ds=ds, reduce=reduce, dtype=out_dtype)
+            img = _pylibczi.cziread_scene(fn, box, max_bytes=nbytes, **kw)
+            if ds > 1 and reduce == 'mean': assert nbytes > img.nbytes
+            with pytest.raises(MemoryError):
+                _pylibczi.cziread_scene(fn, box, max_bytes=nbytes - 1, **kw)
+
+def test_max_bytes_zero(tmp_path):
+    # max_bytes None does not limit the read, zero is a limit
+    from pylibczi import CziFile
+    fn = str(tmp_path / 'zero.czi')
+    write_czi(fn, [subblock(np.ones((20, 30), dtype=np.uint16), 0, 0)])
+    box = np.array([0, 0, 30, 20], dtype=np.int64)
+    assert _pylibczi.cziread_scene(fn, box, max_bytes=None).shape == (20, 30)
+    assert _pylibczi.cziread_scene(fn, box, max_bytes=np.int64(1200)).shape == (20, 30)
+    for max_bytes in [0, 1199]:
+        with pytest.raises(MemoryError):
+            _pylibczi.cziread_scene(fn, box, max_bytes=max_bytes)
+    with pytest.raises(OverflowError):
+        _pylibczi.cziread_scene(fn, box, max_bytes=-1)
+    # the boxes together, also where they overlap
+    czi, boxes = CziFile(fn), np.array([[0, 0, 10, 10], [5, 5, 10, 10]], dtype=np.int64)
+    assert len(czi.read_boxes(boxes, max_bytes=400)) == 2
+    with pytest.raises(MemoryError):
+        czi.read_boxes(boxes, max_bytes=399)
+    with pytest.raises(MemoryError):
+        czi.read_boxes(boxes, dtype=np.uint8, max_bytes=199)
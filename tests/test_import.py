@@ -0,0 +1,49 @@
+# This file is part of pylibczi.
+# Copyright (c) 2018 Center of Advanced European Studies and Research (caesar)
+#
+# pylibczi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pylibczi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
+
+# Tests of the lazy package imports, each in a fresh interpreter so that the import order is the tested one.
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+import pylibczi
+
+names = ['CziFile', 'CziScene', 'CziCatalog', 'CziSharedArray', 'CziTileServer', 'CziCanvas']
+
+def run(code):
+    env = dict(os.environ)
+    # the same pylibczi as the one imported here
+    root = os.path.dirname(os.path.dirname(os.path.abspath(pylibczi.__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([root] + [x for x in [env.get('PYTHONPATH')] if x])
+    subprocess.check_call([sys.executable, '-c', code], env=env)
+
+def check_classes(first):
+    # after the first statement every name of the package is the class, whether it was imported already or not
+    return first + '\nimport pylibczi\n' + '\n'.join(
+        'from pylibczi import {0}\nassert isinstance({0}, type) and pylibczi.{0} is {0}, {0}'.format(x)
+        for x in names)
+
+@pytest.mark.parametrize('first', ['import pylibczi', 'from pylibczi import CziFile',
+    'from pylibczi.CziScene import CziScene', 'import pylibczi.CziCanvas', 'from pylibczi.CziFile import CziFile'])
+def test_names_are_classes(first):
+    run(check_classes(first))
+
+def test_dir_lists_classes_once():
+    run('import pylibczi\nfrom pylibczi.CziScene import CziScene\nd = dir(pylibczi)\n' +
+        'assert all(d.count(x) == 1 for x in %r), d' % (names,))
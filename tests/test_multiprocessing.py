@@ -0,0 +1,137 @@
+# This file is part of pylibczi.
+# Copyright (c) 2018 Center of Advanced European Studies and Research (caesar)
+#
+# pylibczi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pylibczi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
+
+# Tests of passing readers to worker processes (pickled or inherited over fork) and of returning shared arrays.
+
+import multiprocessing
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from czi_writer import write_czi, subblock
+
+_pylibczi = pytest.importorskip('_pylibczi')
+
+from pylibczi import CziFile, CziScene, CziSharedArray
+
+methods = [x for x in ['fork', 'spawn'] if x in multiprocessing.get_all_start_methods()]
+
+# reader inherited by forked workers
+inherited = None
+
+@pytest.fixture(scope='module')
+def czi_file(tmp_path_factory):
+    rng = np.random.default_rng(7)
+    sbs = [subblock(rng.integers(0, 65535, (40, 50)).astype(np.uint16), x, y, M=m)
+        for m, (x, y) in enumerate([(0, 0), (40, 10), (15, 30)])]
+    fn = str(tmp_path_factory.mktemp('czi') / 'workers.czi')
+    write_czi(fn, sbs)
+    return fn
+
+def read_scene(source):
+    return _pylibczi.cziread_scene(source, np.array([0, 0, 90, 70], dtype=np.int64))
+
+def read_image(czi):
+    return czi.read_image()
+
+def read_inherited(_):
+    try:
+        return read_scene(inherited)
+    except TypeError as e:
+        return str(e)
+
+def open_files(fn):
+    # number of file descriptors of this process on the file
+    fds = os.listdir('/proc/self/fd')
+    return sum(os.path.realpath(os.path.join('/proc/self/fd', x)) == os.path.realpath(fn) for x in fds)
+
+def read_inherited_files(fn):
+    # the inherited reader is released (and its file closed) when it is opened again in the child
+    img = read_scene(inherited)
+    return img, open_files(fn)
+
+def pool(method):
+    return multiprocessing.get_context(method).Pool(2)
+
+@pytest.mark.parametrize('method', methods)
+@pytest.mark.parametrize('cls', [CziFile, CziScene])
+def test_pickled_czi(czi_file, method, cls):
+    czi = cls(czi_file)
+    ref = czi.read_image()
+    assert pickle.loads(pickle.dumps(czi))._init_args() == czi._init_args()
+    with pool(method) as p:
+        for img in p.map(read_image, [czi]*3):
+            assert np.array_equal(img, ref)
+
+@pytest.mark.parametrize('method', methods)
+@pytest.mark.parametrize('lazy', [False, True])
+def test_pickled_reader(czi_file, method, lazy):
+    ref = read_scene(czi_file)
+    with open(czi_file, 'rb') as f: data = f.read()
+    with _pylibczi.CziReader(czi_file, lazy=lazy) as reader, _pylibczi.CziReader(data, lazy=lazy) as buffered, \
+            pool(method) as p:
+        for img in p.map(read_scene, [reader, buffered]*2):
+            assert np.array_equal(img, ref)
+        # the readers of the parent are still usable
+        assert np.array_equal(read_scene(reader), ref) and np.array_equal(read_scene(buffered), ref)
+    with open(czi_file, 'rb') as f, _pylibczi.CziReader(f) as reader:
+        with pytest.raises(TypeError, match='can not be pickled'):
+            pickle.dumps(reader)
+
+@pytest.mark.skipif('fork' not in methods, reason='fork not available')
+@pytest.mark.parametrize('lazy', [False, True])
+def test_forked_reader(czi_file, lazy):
+    # a reader inherited by forked workers is opened again there, a reader on a file-like object is refused
+    global inherited
+    ref = read_scene(czi_file)
+    try:
+        with _pylibczi.CziReader(czi_file, lazy=lazy) as inherited:
+            if not lazy: read_scene(inherited)
+            with pool('fork') as p:
+                for img in p.map(read_inherited, range(4)):
+                    assert np.array_equal(img, ref)
+            assert np.array_equal(read_scene(inherited), ref)
+            if os.path.isdir('/proc/self/fd'):
+                with pool('fork') as p:
+                    img, nfiles = p.apply(read_inherited_files, (czi_file,))
+                assert np.array_equal(img, ref) and nfiles == 1
+        with open(czi_file, 'rb') as f, _pylibczi.CziReader(f, lazy=lazy) as inherited:
+            if not lazy: read_scene(inherited)
+            with pool('fork') as p:
+                for msg in p.map(read_inherited, range(2)):
+                    assert msg == 'CziReader on a file-like object can not be used in another process'
+            # the parent still reads from it
+            assert np.array_equal(read_scene(inherited), ref)
+    finally:
+        inherited = None
+
+@pytest.mark.parametrize('method', methods)
+def test_shared_array(czi_file, method):
+    from multiprocessing import shared_memory
+    ref = read_scene(czi_file)
+    with pool(method) as p:
+        shared = p.map(CziSharedArray.returning(read_scene), [czi_file]*2)
+        names = [x.name for x in shared]
+        imgs = CziSharedArray.receive(shared)
+    for img, name in zip(imgs, names):
+        assert np.array_equal(img, ref)
+        # the block was freed by the receiver, the array stays valid
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+    del shared
+    assert all(np.array_equal(img, ref) for img in imgs)
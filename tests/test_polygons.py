@@ -0,0 +1,100 @@
+# This file is part of pylibczi.
+# Copyright (c) 2018 Center of Advanced European Studies and Research (caesar)
+#
+# pylibczi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pylibczi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
+
+# Tests of the polygon rasterization of cziread_polygons and of the CziScene fallback against skimage.
+
+import numpy as np
+import pytest
+
+from czi_writer import write_czi, subblock
+
+_pylibczi = pytest.importorskip('_pylibczi')
+draw = pytest.importorskip('skimage.draw')
+from pylibczi.CziScene import CziScene
+
+# the polygons stay inside of the subblock and inside of the skimage mask after shifting by offset
+origin = (-60, -60); size = 420; offset = np.array([60, 60])
+
+def polygons():
+    rng = np.random.default_rng(42)
+    polys = [[[0, 0], [10, 0], [10, 10], [0, 10]], [[.5, .5], [3.5, .5], [.5, 3.5]],
+             [[0, 0], [100, .3], [0, .6]], [[0, 0], [10, 10], [20, 20]], [[.2, .2], [.8, .2], [.5, .8]],
+             [[0, 0], [20, 20], [20, 0], [0, 20]], [[-10.5, 3], [40, 3], [40, 3.5], [-10.5, 30]],
+             [[5, 5], [50, 5], [50, 40], [30, 40], [30, 20], [15, 20], [15, 40], [5, 40]]]
+    for n in [3, 4, 5, 8, 12]:
+        polys.append(rng.uniform(-40, 250, (n, 2)))
+        polys.append(rng.integers(-40, 250, (n, 2)))
+        polys.append(rng.integers(-80, 500, (n, 2))/2)
+    return [np.array(p, dtype=np.double) for p in polys]
+
+@pytest.fixture(scope='module')
+def czi_file(tmp_path_factory):
+    rng = np.random.default_rng(3)
+    data = rng.integers(1, 255, (size, size)).astype(np.uint8)
+    fn = str(tmp_path_factory.mktemp('czi') / 'polygons.czi')
+    write_czi(fn, [subblock(data, *origin)])
+    return fn, data
+
+def reference(points):
+    return draw.polygon2mask((size, size), (points + offset)[:,::-1])
+
+def paste(mask, corner):
+    full = np.zeros((size, size), dtype=bool)
+    c = corner + offset
+    full[c[1]:c[1]+mask.shape[0],c[0]:c[0]+mask.shape[1]] = mask
+    return full
+
+def check_tight(mask):
+    if mask.size:
+        assert mask[0,:].any() and mask[-1,:].any() and mask[:,0].any() and mask[:,-1].any()
+
+def test_native_matches_skimage(czi_file):
+    fn, data = czi_file
+    polys = polygons()
+    imgs, masks, corners = _pylibczi.cziread_polygons(fn, polys, threads=2)
+    for points, img, mask, corner in zip(polys, imgs, masks, corners):
+        check_tight(mask)
+        assert np.array_equal(paste(mask, corner), reference(points))
+        # the crop is the image inside of the mask and zero outside
+        c = corner - origin
+        assert np.array_equal(img, np.where(mask, data[c[1]:c[1]+img.shape[0],c[0]:c[0]+img.shape[1]], 0))
+
+def test_examples():
+    # boundary pixels are inside, as in skimage
+    assert CziScene._rasterize_polygon(np.array([[0., 0.], [10., 0.], [10., 10.], [0., 10.]]))[0].sum() == 121
+    mask, corner = CziScene._rasterize_polygon(np.array([[.5, .5], [3.5, .5], [.5, 3.5]]))
+    assert np.array_equal(mask, np.tril(np.ones((3, 3), dtype=bool))[::-1]) and tuple(corner) == (1, 1)
+
+def test_fallback_matches_native(czi_file):
+    fn, _ = czi_file
+    polys = polygons()
+    _, masks, corners = _pylibczi.cziread_polygons(fn, polys, threads=2)
+    for points, mask, corner in zip(polys, masks, corners):
+        m, c = CziScene._rasterize_polygon(points)
+        check_tight(m)
+        assert np.array_equal(paste(m, c), reference(points))
+        if mask.size:
+            assert np.array_equal(m, mask) and np.array_equal(c, corner)
+
+@pytest.mark.parametrize('bad', [np.nan, np.inf, -np.inf, 1e12])
+def test_nonfinite_points_rejected(czi_file, bad):
+    fn, _ = czi_file
+    points = np.array([[0., 0.], [10., 0.], [10., bad]])
+    with pytest.raises(_pylibczi._pylibczi_exception):
+        _pylibczi.cziread_polygons(fn, [points])
+    if not np.isfinite(bad):
+        with pytest.raises(AssertionError):
+            CziScene._rasterize_polygon(points)
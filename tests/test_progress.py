@@ -0,0 +1,95 @@
+# This file is part of pylibczi.
+# Copyright (c) 2018 Center of Advanced European Studies and Research (caesar)
+#
+# pylibczi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pylibczi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
+
+# Tests of following and cancelling reads with ReadProgress.
+
+import numpy as np
+import pytest
+
+from czi_writer import write_czi, subblock
+
+_pylibczi = pytest.importorskip('_pylibczi')
+
+# number of subblocks of the test file, a grid of tiles
+ntiles = 16
+box = np.array([0, 0, 4*30, 4*30], dtype=np.int64)
+
+@pytest.fixture(scope='module')
+def czi_file(tmp_path_factory):
+    rng = np.random.default_rng(3)
+    sbs = [subblock(rng.integers(0, 65535, (30, 30)).astype(np.uint16), 30*(k % 4), 30*(k // 4), M=k)
+        for k in range(ntiles)]
+    fn = str(tmp_path_factory.mktemp('czi') / 'progress.czi')
+    write_czi(fn, sbs)
+    return fn
+
+def read(fn, progress):
+    return _pylibczi.cziread_boxes(fn, box.reshape(1, 4), threads=4, progress=progress)[0]
+
+def test_counters(czi_file):
+    progress = _pylibczi.ReadProgress()
+    ref = read(czi_file, None)
+    assert np.array_equal(read(czi_file, progress), ref)
+    assert (progress.done, progress.total, progress.bytes) == (ntiles, ntiles, ntiles*30*30*2)
+    # the counters add up over reads until reset
+    read(czi_file, progress)
+    assert (progress.done, progress.total) == (2*ntiles, 2*ntiles)
+    progress.reset()
+    assert (progress.done, progress.total, progress.bytes) == (0, 0, 0)
+
+def test_cancel(czi_file):
+    progress = _pylibczi.ReadProgress()
+    ref = read(czi_file, None)
+    progress.cancel()
+    assert progress.cancelled
+    # the cancellation stays for later reads until the progress is reset
+    for _ in range(2):
+        with pytest.raises(_pylibczi._pylibczi_cancelled):
+            read(czi_file, progress)
+    with pytest.raises(_pylibczi._pylibczi_exception):
+        _pylibczi.cziread_scene(czi_file, box, progress=progress)
+    progress.reset()
+    assert not progress.cancelled
+    assert np.array_equal(read(czi_file, progress), ref)
+    assert progress.done == ntiles
+
+def test_callback_cancels(czi_file):
+    calls = []
+    def callback(done, total, nbytes):
+        calls.append((done, total))
+        return len(calls) == 3
+    progress = _pylibczi.ReadProgress(callback, interval=0)
+    with pytest.raises(_pylibczi._pylibczi_cancelled):
+        read(czi_file, progress)
+    assert progress.cancelled and len(calls) == 3 and progress.done < ntiles
+    assert all(0 <= done <= total == ntiles for done, total in calls)
+    # not cancelled again after the reset, the last call is at the end of the read
+    progress.reset()
+    assert np.array_equal(read(czi_file, progress), read(czi_file, None))
+    assert calls[-1] == (ntiles, ntiles)
+
+def test_callback_error(czi_file):
+    fail = [True]
+    def callback(done, total, nbytes):
+        if fail[0] and done > 0: raise ValueError('callback failed')
+    progress = _pylibczi.ReadProgress(callback, interval=0)
+    # the error of the callback stops the read and is raised in the calling thread
+    with pytest.raises(ValueError, match='callback failed'):
+        read(czi_file, progress)
+    assert not progress.cancelled
+    # it is raised once, the progress reads again
+    fail[0] = False
+    assert np.array_equal(read(czi_file, progress), read(czi_file, None))
@@ -0,0 +1,97 @@
+# This file is part of pylibczi.
+# Copyright (c) 2018 Center of Advanced European Studies and Research (caesar)
+#
+# pylibczi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pylibczi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
+
+# Tests of the scene statistics accumulated while decoding against numpy on the composed scene image.
+
+import numpy as np
+import pytest
+
+from czi_writer import write_czi, subblock, metadata
+
+_pylibczi = pytest.importorskip('_pylibczi')
+pytest.importorskip('lxml')
+pytest.importorskip('scipy')
+from pylibczi import CziScene
+
+# stage box of the scene, covered by two overlapping subblocks
+scene = (0, 0, 150, 90)
+
+@pytest.fixture(scope='module', params=[(np.uint8, 1), (np.uint16, 1), (np.float32, 1), (np.uint8, 3),
+    (np.uint16, 'offset'), (np.float32, 'offset')], ids=['gray8', 'gray16', 'float32', 'bgr24', 'gray16-offset',
+    'float32-offset'])
+def czi_file(request, tmp_path_factory):
+    dtype, kind = request.param
+    nchan = kind if kind != 'offset' else 1
+    rng = np.random.default_rng(11)
+    sbs = []
+    for m, (x, w) in enumerate([(0, 80), (70, 80)]):
+        shape = (scene[3], w) + ((nchan,) if nchan > 1 else ())
+        if kind == 'offset':
+            # large values with a small spread, the variance is lost in a sum of squares
+            data = (rng.integers(0, 4, shape) + (60000 if dtype == np.uint16 else 10000000)).astype(dtype)
+        elif dtype == np.float32:
+            data = rng.normal(500, 100, shape).astype(np.float32)
+        else:
+            data = rng.integers(0, np.iinfo(dtype).max, shape, endpoint=True).astype(dtype)
+        sbs.append(subblock(data, 200 + x, 100, M=m))
+    fn = str(tmp_path_factory.mktemp('stats') / 'stats.czi')
+    write_czi(fn, sbs, meta=metadata([scene]))
+    return fn
+
+def scene_image(fn, step=1):
+    return _pylibczi.cziread_scene(fn, np.array([200, 100, scene[2], scene[3]], dtype=np.int64))[::step,::step]
+
+def values(img):
+    return img.reshape(-1, img.shape[2] if img.ndim == 3 else 1)
+
+@pytest.mark.parametrize('step', [1, 3])
+def test_moments(czi_file, step):
+    img = scene_image(czi_file, step); v = values(img)
+    fine = _pylibczi.cziread_stats(czi_file, np.array([200, 100, scene[2], scene[3]], dtype=np.int64), step=step,
+        threads=4)
+    assert np.array_equal(fine['count'], np.full(v.shape[1], v.shape[0]))
+    assert np.array_equal(fine['min'], v.min(0)) and np.array_equal(fine['max'], v.max(0))
+    assert np.allclose(fine['mean'], v.mean(0, dtype=np.double), rtol=1e-12)
+    assert np.allclose(fine['std'], v.std(0, dtype=np.double), rtol=1e-9)
+    assert fine['integer'] == issubclass(v.dtype.type, np.integer)
+    # the same fine statistics as computed without pylibczi
+    ref = CziScene._image_stats(img)
+    assert set(fine.keys()) == set(ref.keys())
+    if fine['integer']:
+        assert np.array_equal(fine['histogram'], ref['histogram'])
+        assert np.array_equal(fine['bin_edges'], ref['bin_edges'])
+    else:
+        assert np.allclose(fine['bin_edges'], ref['bin_edges'])
+        # values on a bin edge may be counted in the neighbouring bin
+        assert np.abs(fine['histogram'] - ref['histogram']).sum() <= 0.001*v.shape[0]
+
+def test_scene_stats(czi_file):
+    v = values(scene_image(czi_file))
+    percentiles = [0.1, 1, 50, 99, 99.9]
+    stats = CziScene(czi_file, scene=1).stats(bins=64, percentiles=percentiles)
+    assert np.array_equal(stats['min'], v.min(0)) and np.array_equal(stats['max'], v.max(0))
+    assert np.allclose(stats['std'], v.std(0, dtype=np.double), rtol=1e-9)
+    assert stats['histogram'].shape == (v.shape[1], 64) and np.array_equal(stats['histogram'].sum(1), stats['count'])
+    if issubclass(v.dtype.type, np.integer):
+        # one fine bin per value, the histograms and percentiles are exact
+        for c in range(v.shape[1]):
+            assert np.array_equal(stats['histogram'][c], np.histogram(v[:,c], bins=stats['bin_edges'])[0])
+            assert np.array_equal(stats['percentiles'][c], np.percentile(v[:,c], percentiles, method='inverted_cdf'))
+    else:
+        # interpolated within the fine bins, between the neighbouring values
+        v = v.astype(np.double); width = (v.max() - v.min())/65536
+        assert (stats['percentiles'] >= np.percentile(v, percentiles, axis=0, method='lower').T - width).all()
+        assert (stats['percentiles'] <= np.percentile(v, percentiles, axis=0, method='higher').T + width).all()
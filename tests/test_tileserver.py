@@ -0,0 +1,172 @@
+# This file is part of pylibczi.
+# Copyright (c) 2018 Center of Advanced European Studies and Research (caesar)
+#
+# pylibczi is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pylibczi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pylibczi.  If not, see <https://www.gnu.org/licenses/>.
+
+# Tests of the tile server on localhost, the tiles are compared with direct reads of the same boxes.
+
+import json
+import struct
+import urllib.error
+import urllib.request
+import xml.etree.ElementTree as ET
+import zlib
+
+import numpy as np
+import pytest
+
+from czi_writer import write_czi, subblock
+
+_pylibczi = pytest.importorskip('_pylibczi')
+from pylibczi import CziTileServer
+
+tile_size = 128
+
+# scene boxes (x, y, w, h) of the test file, each with channels 0 and 1
+scene_boxes = {0:(0, 0, 300, 200), 1:(1000, 500, 520, 130)}
+
+def decode_png(data):
+    # the server writes 8 bit png without filtering
+    assert data[:8] == b'\x89PNG\r\n\x1a\n'
+    pos, chunks = 8, {}
+    while pos < len(data):
+        n, tag = struct.unpack('>I4s', data[pos:pos+8])
+        chunks[tag] = chunks.get(tag, b'') + data[pos+8:pos+8+n]
+        pos += n + 12
+    w, h, depth, color = struct.unpack('>IIBB', chunks[b'IHDR'][:10])
+    assert depth == 8
+    nchan = {0:1, 2:3, 6:4}[color]
+    raw = np.frombuffer(zlib.decompress(chunks[b'IDAT']), dtype=np.uint8).reshape(h, w*nchan + 1)
+    assert (raw[:,0] == 0).all()
+    img = raw[:,1:].reshape(h, w, nchan)
+    return img[:,:,0] if nchan == 1 else img
+
+@pytest.fixture(scope='module', params=[(np.uint16, 1), (np.uint8, 3)], ids=['gray16', 'bgr24'])
+def czi_file(request, tmp_path_factory):
+    dtype, nchan = request.param
+    rng = np.random.default_rng(3)
+    sbs = []
+    for s, (x, y, w, h) in scene_boxes.items():
+        for c in range(2):
+            # two overlapping tiles per scene channel
+            for k, (dx, dy) in enumerate([(0, 0), (w//3, h//4)]):
+                shape = (h - dy, w - dx) + ((nchan,) if nchan > 1 else ())
+                data = rng.integers(0, 1000 if dtype == np.uint16 else 255, shape).astype(dtype)
+                sbs.append(subblock(data, x + dx, y + dy, C=c, S=s, M=k))
+    fn = str(tmp_path_factory.mktemp('czi') / 'tiles.czi')
+    write_czi(fn, sbs)
+    return fn
+
+@pytest.fixture(scope='module')
+def server(czi_file):
+    with CziTileServer([czi_file], tile_size=tile_size, threads=4).start() as server:
+        yield server
+
+def get(server, path):
+    try:
+        with urllib.request.urlopen(server.url + path) as response:
+            return response.status, response.headers['Content-Type'], response.read()
+    except urllib.error.HTTPError as exc:
+        return exc.code, exc.headers['Content-Type'], exc.read()
+
+def direct(czi_file, box, ds, window):
+    return _pylibczi.cziread_scene(czi_file, np.array(box, dtype=np.int64), ds=ds, reduce='mean', dtype=np.uint8,
+        window=window, rgb=True, channel=1)
+
+def test_index_and_dzi(server):
+    status, content_type, body = get(server, '/')
+    assert status == 200 and content_type == 'application/json'
+    scenes = json.loads(body)[0]['scenes']
+    for s, box in scene_boxes.items():
+        assert scenes[str(s)]['box'] == list(box) and scenes[str(s)]['channels'] == [0, 1]
+
+    status, content_type, body = get(server, '/0/1/1.dzi')
+    assert status == 200 and content_type == 'application/xml'
+    image = ET.fromstring(body)
+    assert image.get('TileSize') == str(tile_size) and image.get('Overlap') == '0' and image.get('Format') == 'png'
+    size = image.find('{http://schemas.microsoft.com/deepzoom/2008}Size')
+    assert (int(size.get('Width')), int(size.get('Height'))) == scene_boxes[1][2:]
+
+@pytest.mark.parametrize('window', [None, (20., 200.)])
+def test_dzi_tiles(server, czi_file, window):
+    x, y, w, h = scene_boxes[1]
+    query = '' if window is None else '?window=%g,%g' % window
+    if window is None: window = server._window(0, 1, 1)
+    levels = int(np.ceil(np.log2(max(w, h)))) + 1
+    for level in [levels - 1, levels - 2, levels - 4, 0]:
+        ds = 2**(levels - 1 - level)
+        sw, sh = -(-w // ds), -(-h // ds)
+        for row in range(-(-sh // tile_size)):
+            for col in range(-(-sw // tile_size)):
+                status, content_type, body = get(server, '/0/1/1_files/%d/%d_%d.png%s' % (level, col, row, query))
+                assert status == 200 and content_type == 'image/png'
+                tw, th = min(tile_size, sw - col*tile_size), min(tile_size, sh - row*tile_size)
+                box = (x + col*tile_size*ds, y + row*tile_size*ds, tw*ds, th*ds)
+                assert np.array_equal(decode_png(body), direct(czi_file, box, ds, window))
+
+def test_xyz_tiles(server, czi_file):
+    x, y, w, h = scene_boxes[1]
+    window = server._window(0, 1, 1)
+    nzoom = int(np.ceil(np.log2(max(w, h) / tile_size)))
+    for z in range(nzoom + 1):
+        ds = 2**(nzoom - z)
+        sw, sh = -(-w // ds), -(-h // ds)
+        for row in range(-(-sh // tile_size)):
+            for col in range(-(-sw // tile_size)):
+                status, _, body = get(server, '/0/1/1/%d/%d/%d.png' % (z, col, row))
+                assert status == 200
+                tile = decode_png(body)
+                # xyz tiles always have the tile size, padded with zeros
+                assert tile.shape[:2] == (tile_size, tile_size)
+                tw, th = min(tile_size, sw - col*tile_size), min(tile_size, sh - row*tile_size)
+                box = (x + col*tile_size*ds, y + row*tile_size*ds, tw*ds, th*ds)
+                assert np.array_equal(tile[:th,:tw], direct(czi_file, box, ds, window))
+                assert not tile[th:].any() and not tile[:,tw:].any()
+
+@pytest.mark.parametrize('path,status', [
+    ('/1/0/0.dzi', 404),                        # no file
+    ('/0/2/0.dzi', 404),                        # no scene
+    ('/0/0/2.dzi', 404),                        # no channel
+    ('/0/0/0_files/20/0_0.png', 404),           # no level
+    ('/0/0/0_files/9/5_0.png', 404),            # no tile
+    ('/0/0/0/9/0/0.png', 404),                  # no zoom
+    ('/0/0/0.tif', 404),                        # unknown route
+    ('/0/0/0_files/9/0_0.png?window=1', 400),   # bad window
+    ('/0/0/0/0/0/0.png?window=a,b', 400),
+])
+def test_errors(server, path, status):
+    assert get(server, path)[0] == status
+
+def test_metrics(server):
+    before = json.loads(get(server, '/metrics')[2])
+    assert get(server, '/0/0/0_files/0/0_0.png')[0] == 200
+    assert get(server, '/0/0/0_files/0/0_0.png')[0] == 200
+    assert get(server, '/0/0/9.dzi')[0] == 404
+    status, content_type, body = get(server, '/metrics')
+    assert status == 200 and content_type == 'application/json'
+    after = json.loads(body)
+    # the three requests and the first metrics request
+    assert after['requests'] == before['requests'] + 4
+    assert after['errors'] == before['errors'] + 1
+    assert after['latency_ms']['count'] == min(before['latency_ms']['count'] + 4, CziTileServer.nlatencies)
+    # the second request for the same tile is served from the cache
+    assert after['cache']['hits'] >= before['cache']['hits'] + 1
+    assert after['tiles_read'] <= before['tiles_read'] + 1
+
+@pytest.mark.parametrize('allow_origin', [None, '*', 'http://localhost:8080'])
+def test_allow_origin(czi_file, allow_origin):
+    # cross-origin requests are only allowed when an origin is configured
+    with CziTileServer([czi_file], tile_size=tile_size, threads=1, allow_origin=allow_origin).start() as server:
+        with urllib.request.urlopen(server.url + '/') as response:
+            assert response.headers['Access-Control-Allow-Origin'] == allow_origin
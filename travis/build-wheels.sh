@@ -18,20 +18,15 @@
 
 set -e -x
 
-# Install system packages required by our library
-yum install -y libpng-devel zlib-devel
+# Install system packages required by our library (git for the libCZI checkout and the zstd download)
+yum install -y libpng-devel zlib-devel git
 
-# Install newer devtools that work on manylinux
-#GCCLOC=https://github.com/squeaky-pl/centos-devtools/releases/download/6.3
-#GCCAR=gcc-6.3.0-binutils-2.27-x86_64.tar.bz2
-#export CC=/opt/devtools-6.3/bin/gcc
-#export CXX=/opt/devtools-6.3/bin/g++
-GCCLOC=https://github.com/Noctem/pogeo-toolchain/releases/download/v1.5
-GCCAR=gcc-7.3-centos5-x86-64.tar.bz2
-export CC=/toolchain/bin/gcc
-export CXX=/toolchain/bin/g++
-curl -o ${GCCAR} -L ${GCCLOC}/${GCCAR}
-tar xvjf ${GCCAR}
+# manylinux2014 provides a c++14 compiler (devtoolset), cmake comes with the dev-requirements.
+# Check out the libCZI release pylibczi is built against, if the submodule was not cloned.
+LIBCZI_TAG=v0.67.1
+if [ ! -f /io/libCZI/CMakeLists.txt ]; then
+    git clone --depth 1 --branch ${LIBCZI_TAG} https://github.com/ZEISS/libczi.git /io/libCZI
+fi
 
 # Compile wheels
 for PYBIN in /opt/python/cp3*/bin; do
@@ -48,4 +43,8 @@ done
 for PYBIN in /opt/python/cp3*/bin/; do
     "${PYBIN}/pip" install pylibczi --no-index -f /io/wheelhouse
     #(cd "$HOME"; "${PYBIN}/nosetests" pymanylinuxdemo)
+    # importing pylibczi must stay cheap for worker processes
+    (cd "$HOME"; "${PYBIN}/python" /io/benchmarks/bench_import.py --check)
+    # the package names stay the classes whichever submodule is imported first
+    (cd "$HOME"; "${PYBIN}/python" -m pytest -q /io/tests/test_import.py)
 done